@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# Benchmark compact_mbtiles against the original one-tile-at-a-time loop
+# (INSERT INTO images, catch the unique index error, REPLACE INTO map).
+#
+# $ python bench/bench_compact.py --tiles 200000 --workers 4
+
+import os, sys, time, random, shutil, hashlib, tempfile, sqlite3, logging
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mbutil import mbtiles_setup, optimize_connection
+from mbutil.util_compact import compact_mbtiles, compaction_prepare, compaction_finalize
+
+def make_tiles(path, count, blob_size, duplicate_ratio):
+    con = sqlite3.connect(path)
+    cur = con.cursor()
+    mbtiles_setup(cur)
+    unique_blobs = max(1, int(count * (1.0 - duplicate_ratio)))
+    blobs = [os.urandom(blob_size) for i in range(min(unique_blobs, 1000))]
+    z = 0
+    while (4 ** z) < count:
+        z += 1
+    side = 2 ** z
+    rows = []
+    for i in range(count):
+        if i < unique_blobs:
+            # make every unique tile distinct without generating megabytes of randomness
+            data = blobs[i % len(blobs)] + str(i).encode()
+        else:
+            data = blobs[random.randrange(len(blobs))] + str(random.randrange(unique_blobs)).encode()
+        rows.append((z, i % side, i // side, sqlite3.Binary(data)))
+        if len(rows) == 10000:
+            cur.executemany("insert into tiles values (?, ?, ?, ?)", rows)
+            rows = []
+    cur.executemany("insert into tiles values (?, ?, ?, ?)", rows)
+    con.commit()
+    con.close()
+
+def legacy_compact(path):
+    con = sqlite3.connect(path)
+    cur = con.cursor()
+    optimize_connection(cur)
+    compaction_prepare(cur)
+    chunk = 100
+    max_rowid = con.execute("SELECT max(rowid) FROM tiles").fetchone()[0]
+    for i in range((max_rowid // chunk) + 1):
+        cur.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE rowid > ? AND rowid <= ?""",
+            ((i * chunk), ((i + 1) * chunk)))
+        for z, x, y, tile_data in cur.fetchall():
+            m = hashlib.md5()
+            m.update(tile_data)
+            tile_id = m.hexdigest()
+            try:
+                cur.execute("""INSERT INTO images (tile_id, tile_data) VALUES (?, ?)""",
+                    (tile_id, sqlite3.Binary(tile_data)))
+            except:
+                pass
+            cur.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
+                (z, x, y, tile_id))
+    compaction_finalize(cur)
+    con.commit()
+    con.close()
+
+def run(label, source, tmp, count, func):
+    path = os.path.join(tmp, 'run.mbtiles')
+    shutil.copy(source, path)
+    start = time.time()
+    func(path)
+    elapsed = time.time() - start
+    os.remove(path)
+    print("%-34s %8.2fs %10.0f tiles/sec" % (label, elapsed, count / elapsed))
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--tiles', dest='tiles', type='int', default=200000,
+        help='Number of synthetic tiles')
+    parser.add_option('--blob-size', dest='blob_size', type='int', default=8192,
+        help='Size of every tile in bytes')
+    parser.add_option('--duplicates', dest='duplicates', type='float', default=0.5,
+        help='Fraction of tiles that duplicate another tile')
+    parser.add_option('--workers', dest='workers', type='int', default=4,
+        help='Hashing threads for the parallel runs')
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    random.seed(1)
+    tmp = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmp, 'source.mbtiles')
+        make_tiles(source, options.tiles, options.blob_size, options.duplicates)
+        run('legacy loop', source, tmp, options.tiles, legacy_compact)
+        run('compact_mbtiles, 1 worker', source, tmp, options.tiles,
+            lambda path: compact_mbtiles(path))
+        run('compact_mbtiles, %d workers' % options.workers, source, tmp, options.tiles,
+            lambda path: compact_mbtiles(path, workers=options.workers))
+        run('compact_mbtiles, %d workers, sha1' % options.workers, source, tmp, options.tiles,
+            lambda path: compact_mbtiles(path, workers=options.workers, hash_function='sha1'))
+    finally:
+        shutil.rmtree(tmp)
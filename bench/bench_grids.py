@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Benchmark UTFGrid export: the old one-query-per-grid lookup of grid_data
+# against the ordered merge-join done by mbutil.util.iter_grids.
+#
+# $ python bench/bench_grids.py --grids 100000
+
+import os, sys, time, json, zlib, random, shutil, tempfile, sqlite3
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mbutil import mbtiles_setup, iter_grids
+
+def make_grids(path, count, keys_per_grid, with_index):
+    con = sqlite3.connect(path)
+    cur = con.cursor()
+    mbtiles_setup(cur)
+    if not with_index:
+        cur.execute("drop index grid_index")
+        cur.execute("drop index grid_data_index")
+    z = 0
+    while (4 ** z) < count:
+        z += 1
+    side = 2 ** z
+    cells = random.sample(range(side * side), count)
+    grid = zlib.compress(json.dumps({'grid': [' ' * 64] * 64,
+        'keys': [''] + [str(k) for k in range(keys_per_grid)]}).encode())
+    grids = []
+    grid_data = []
+    for cell in cells:
+        x, y = cell % side, cell // side
+        grids.append((z, x, y, sqlite3.Binary(grid)))
+        for k in range(keys_per_grid):
+            grid_data.append((z, x, y, str(k), json.dumps({'id': cell, 'key': k})))
+    # grid_data arrives in a different order than grids, like a real import
+    random.shuffle(grid_data)
+    cur.executemany("insert into grids values (?, ?, ?, ?)", grids)
+    cur.executemany("insert into grid_data values (?, ?, ?, ?, ?)", grid_data)
+    con.commit()
+    con.close()
+
+def per_grid_queries(con):
+    grids = con.execute('select zoom_level, tile_column, tile_row, grid from grids;')
+    for zoom_level, tile_column, y, grid in grids:
+        cursor = con.execute('''select key_name, key_json FROM
+            grid_data WHERE
+            zoom_level = %(zoom_level)d and
+            tile_column = %(tile_column)d and
+            tile_row = %(y)d;''' % locals())
+        data = {}
+        for key_name, key_json in cursor:
+            data[key_name] = json.loads(key_json)
+        yield zoom_level, tile_column, y, grid, data
+
+def run(label, path, reader, max_seconds):
+    con = sqlite3.connect(path)
+    start = time.time()
+    done = 0
+    for g in reader(con):
+        done += 1
+        if max_seconds and time.time() - start > max_seconds:
+            break
+    elapsed = time.time() - start
+    con.close()
+    print("%-36s %8d grids %8.2fs %10.0f grids/sec" % (label, done, elapsed, done / elapsed))
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--grids', dest='grids', type='int', default=100000,
+        help='Number of synthetic grids')
+    parser.add_option('--keys', dest='keys', type='int', default=4,
+        help='Number of grid_data keys per grid')
+    parser.add_option('--max-seconds', dest='max_seconds', type='float', default=60,
+        help='Stop a single run after this many seconds (0 for no limit)')
+    (options, args) = parser.parse_args()
+
+    random.seed(1)
+    tmp = tempfile.mkdtemp()
+    try:
+        indexed = os.path.join(tmp, 'indexed.mbtiles')
+        plain = os.path.join(tmp, 'plain.mbtiles')
+        make_grids(indexed, options.grids, options.keys, True)
+        make_grids(plain, options.grids, options.keys, False)
+        run('per-grid queries, no index', plain, per_grid_queries, options.max_seconds)
+        run('per-grid queries, grid_data_index', indexed, per_grid_queries, options.max_seconds)
+        run('merge-join, no index', plain, iter_grids, options.max_seconds)
+        run('merge-join, grid_data_index', indexed, iter_grids, options.max_seconds)
+    finally:
+        shutil.rmtree(tmp)
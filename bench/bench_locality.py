@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# Benchmark tile locality: replays a seeded walk of a map viewport panning
+# and zooming over a synthetic file (see generate.py), stored flat in the
+# order it was generated and as compacted copies in default (z, x, y),
+# zorder and hilbert order. Every layout is read through the same small
+# SQLite page cache; the pages read from the file (rchar of /proc/self/io
+# over the page size) show how often the cache misses.
+#
+# $ python bench/bench_locality.py --tiles 200000 --blob-size 800
+# $ python bench/bench_locality.py --steps 5000 --cache-pages 50 --viewport 5x4
+
+import os, sys, time, random, shutil, tempfile, sqlite3, logging
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from generate import add_options, dataset_params, make_mbtiles
+from mbutil.util_compact import compact_mbtiles_to_file
+
+ORDERS = [None, 'zorder', 'hilbert']
+
+def io_read_bytes():
+    """ Bytes this process read through read() calls, where /proc tells """
+    try:
+        f = open('/proc/self/io')
+        counters = dict(line.split(': ') for line in f.read().splitlines())
+        f.close()
+        return int(counters['rchar'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+def zoom_extents(path, min_tiles):
+    """ {z: (max x, max y)} of the zooms of path holding at least min_tiles tiles """
+    con = sqlite3.connect(path)
+    extents = dict([(z, (x, y)) for z, count, x, y in con.execute("""SELECT zoom_level,
+        count(*), max(tile_column), max(tile_row) FROM tiles GROUP BY zoom_level""")
+        if count >= min_tiles])
+    con.close()
+    return extents
+
+def viewport_walk(extents, steps, width, height, zoom_ratio=0.1, seed=1):
+    """
+    Yield the tiles of a viewport of width x height tiles for every step of
+    a walk: mostly pans of a tile or two, keeping their heading for a while
+    like a dragged map, now and then a zoom in or out around the centre of
+    the viewport.
+    """
+    rand = random.Random(seed)
+    z = max(extents)
+    x = rand.randint(0, extents[z][0])
+    y = rand.randint(0, extents[z][1])
+    heading = (1, 0)
+    for step in range(steps):
+        move = rand.random()
+        if move < zoom_ratio / 2 and z + 1 in extents:
+            z, x, y = z + 1, x * 2, y * 2
+        elif move < zoom_ratio and z - 1 in extents:
+            z, x, y = z - 1, x // 2, y // 2
+        else:
+            if move > 0.8:
+                heading = (rand.randint(-2, 2), rand.randint(-2, 2))
+            x += heading[0]
+            y += heading[1]
+        if not 0 <= x <= extents[z][0] or not 0 <= y <= extents[z][1]:
+            # bounce off the edges of the data
+            heading = (-heading[0], -heading[1])
+        x = min(max(x, 0), extents[z][0])
+        y = min(max(y, 0), extents[z][1])
+        tiles = []
+        for dx in range(width):
+            for dy in range(height):
+                tiles.append((z, x - width // 2 + dx, y - height // 2 + dy))
+        yield tiles
+
+def replay(path, walk, cache_pages):
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA cache_size = %d" % cache_pages)
+    page_size = con.execute("PRAGMA page_size").fetchone()[0]
+    start_bytes = io_read_bytes()
+    start = time.time()
+    found = 0
+    for tiles in walk:
+        for z, x, y in tiles:
+            row = con.execute("""SELECT tile_data FROM tiles WHERE zoom_level = ?
+                AND tile_column = ? AND tile_row = ?""", (z, x, y)).fetchone()
+            if row is not None:
+                found += 1
+    elapsed = time.time() - start
+    read = io_read_bytes()
+    con.close()
+    pages = None
+    if start_bytes is not None and read is not None:
+        pages = (read - start_bytes) // page_size
+    return {'seconds': elapsed, 'pages': pages, 'tiles': found}
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    add_options(parser)
+    parser.set_defaults(blob_size=800, duplicates=0.0, tiles=100000)
+    parser.add_option('--steps', dest='steps', type='int', default=2000,
+        help='Number of viewports of the walk')
+    parser.add_option('--viewport', dest='viewport', default='8x6',
+        help='Viewport size in tiles, WIDTHxHEIGHT')
+    parser.add_option('--cache-pages', dest='cache_pages', type='int', default=50,
+        help='SQLite page cache size of the reading connection, in pages')
+    parser.add_option('--work-dir', dest='work_dir',
+        help='Directory for the generated files, a temporary one by default')
+    (options, args) = parser.parse_args()
+    width, height = [int(v) for v in options.viewport.split('x')]
+
+    logging.basicConfig(level=logging.WARNING)
+    work = options.work_dir or tempfile.mkdtemp(prefix='mbutil-locality-')
+    if not os.path.isdir(work):
+        os.makedirs(work)
+    try:
+        source = os.path.join(work, 'flat.mbtiles')
+        if not os.path.exists(source):
+            make_mbtiles(source, **dataset_params(options))
+        layouts = [('flat', source)]
+        for order in ORDERS:
+            name = 'compact %s' % (order or 'default')
+            path = os.path.join(work, 'compact-%s.mbtiles' % (order or 'default'))
+            if not os.path.exists(path):
+                compact_mbtiles_to_file(source, path, tile_order=order)
+            layouts.append((name, path))
+
+        extents = zoom_extents(source, width * height)
+        print('%d viewports of %dx%d tiles, %d page cache, zooms %d-%d' % (options.steps,
+            width, height, options.cache_pages, min(extents), max(extents)))
+        print('%-18s %12s %12s %10s %10s' % ('layout', 'size', 'pages read', 'pages/view', 'seconds'))
+        for name, path in layouts:
+            walk = viewport_walk(extents, options.steps, width, height, seed=options.seed)
+            result = replay(path, walk, options.cache_pages)
+            pages = result['pages']
+            print('%-18s %12d %12s %10s %10.2f' % (name, os.path.getsize(path),
+                pages if pages is not None else '-',
+                '%.1f' % (float(pages) / options.steps) if pages is not None else '-',
+                result['seconds']))
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+# Synthetic datasets for the benchmarks: an MBTiles file, or a tile
+# directory in any of the schemes mb-util imports. The same options and
+# seed always produce the same tiles.
+#
+# $ python bench/generate.py --tiles 100000 --max-zoom 10 --duplicates 0.3 out.mbtiles
+# $ python bench/generate.py --tiles 100000 --scheme zyx tiles/
+
+import os, sys, json, zlib, random, sqlite3
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mbutil import mbtiles_setup, flip_y, tile_path
+
+SCHEMES = ['xyz', 'tms', 'zyx', 'wms', 'ags']
+
+def zoom_counts(tiles, max_zoom):
+    """
+    Spread tiles over zooms 0 to max_zoom like a pyramid: every zoom gets
+    a share proportional to its size, capped at 4 ** z, and what the
+    capped zooms cannot hold goes to the deepest ones.
+    """
+    weights = [4 ** z for z in range(max_zoom + 1)]
+    counts = [max(1, min(4 ** z, int(tiles * w / float(sum(weights))))) for z, w in enumerate(weights)]
+    left = tiles - sum(counts)
+    for z in range(max_zoom, -1, -1):
+        extra = max(min(left, 4 ** z - counts[z]), -counts[z])
+        counts[z] += extra
+        left -= extra
+    return counts
+
+def synthetic_tiles(tiles=10000, max_zoom=None, duplicates=0.0, blob_size=4096, seed=1):
+    """
+    Yield (z, x, y, data) for a synthetic pyramid, y being the TMS row.
+    Each zoom is filled in a square block from its origin. A fraction
+    duplicates of the tiles reuse the image of an earlier tile.
+    """
+    rand = random.Random(seed)
+    if max_zoom is None:
+        max_zoom = 0
+        while sum([4 ** z for z in range(max_zoom + 1)]) < tiles:
+            max_zoom += 1
+    # a pool of random blocks, made unique per image by a suffix, keeps
+    # generation fast whatever the blob size
+    pool = [bytes(bytearray(rand.getrandbits(8) for i in range(blob_size))) for j in range(16)]
+    unique = max(1, int(tiles * (1.0 - duplicates)))
+    n = 0
+    for z, count in enumerate(zoom_counts(tiles, max_zoom)):
+        side = 1
+        while side * side < count:
+            side *= 2
+        for i in range(count):
+            image = n if n < unique else rand.randrange(unique)
+            data = pool[image % len(pool)][:max(blob_size - 12, 0)] + ('%012d' % image).encode()
+            yield z, i % side, i // side, data
+            n += 1
+
+def synthetic_grid(z, x, y, keys):
+    grid = {'grid': [' ' * 64] * 64, 'keys': [''] + [str(k) for k in range(keys)]}
+    data = dict((str(k), {'z': z, 'x': x, 'y': y, 'key': k}) for k in range(keys))
+    return grid, data
+
+def has_grid(z, x, y, grid_density):
+    return grid_density > 0 and random.Random(z * 1000003 + x * 1009 + y).random() < grid_density
+
+def make_mbtiles(path, tiles=10000, max_zoom=None, duplicates=0.0, blob_size=4096,
+        grid_density=0.0, grid_keys=4, seed=1, image_format='png'):
+    con = sqlite3.connect(path)
+    cur = con.cursor()
+    mbtiles_setup(cur)
+    cur.executemany("insert into metadata (name, value) values (?, ?)",
+        [('name', 'synthetic'), ('format', image_format), ('version', '1')])
+    rows = []
+    grids = []
+    grid_data = []
+    for z, x, y, data in synthetic_tiles(tiles, max_zoom, duplicates, blob_size, seed):
+        rows.append((z, x, y, sqlite3.Binary(data)))
+        if has_grid(z, x, y, grid_density):
+            grid, keys = synthetic_grid(z, x, y, grid_keys)
+            grids.append((z, x, y, sqlite3.Binary(zlib.compress(json.dumps(grid).encode()))))
+            grid_data.extend([(z, x, y, k, json.dumps(v)) for k, v in keys.items()])
+        if len(rows) >= 10000:
+            cur.executemany("insert into tiles values (?, ?, ?, ?)", rows)
+            cur.executemany("insert into grids values (?, ?, ?, ?)", grids)
+            cur.executemany("insert into grid_data values (?, ?, ?, ?, ?)", grid_data)
+            rows, grids, grid_data = [], [], []
+    cur.executemany("insert into tiles values (?, ?, ?, ?)", rows)
+    cur.executemany("insert into grids values (?, ?, ?, ?)", grids)
+    cur.executemany("insert into grid_data values (?, ?, ?, ?, ?)", grid_data)
+    con.commit()
+    con.close()
+
+def tree_path(z, x, y, ext, scheme):
+    """ Relative path of a tile (TMS row) in a directory of scheme """
+    if scheme == 'zyx':
+        return os.path.join(str(z), str(flip_y(z, y)), '%s.%s' % (x, ext))
+    if scheme == 'ags':
+        return os.path.join('L%02d' % z, 'R%08x' % flip_y(z, y), 'C%08x.%s' % (x, ext))
+    return tile_path(z, x, y, ext, scheme)
+
+def make_tree(directory_path, tiles=10000, max_zoom=None, duplicates=0.0, blob_size=4096,
+        grid_density=0.0, grid_keys=4, seed=1, scheme='xyz', image_format='png'):
+    os.makedirs(directory_path)
+    f = open(os.path.join(directory_path, 'metadata.json'), 'w')
+    json.dump({'name': 'synthetic', 'format': image_format, 'version': '1'}, f)
+    f.close()
+    dirs = set()
+    for z, x, y, data in synthetic_tiles(tiles, max_zoom, duplicates, blob_size, seed):
+        paths = [(tree_path(z, x, y, image_format, scheme), data)]
+        # mb-util has no UTFGrid layout for wms directories
+        if scheme != 'wms' and has_grid(z, x, y, grid_density):
+            grid, keys = synthetic_grid(z, x, y, grid_keys)
+            grid['data'] = keys
+            paths.append((tree_path(z, x, y, 'grid.json', scheme), json.dumps(grid).encode()))
+        for relpath, content in paths:
+            path = os.path.join(directory_path, relpath)
+            parent = os.path.dirname(path)
+            if parent not in dirs:
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                dirs.add(parent)
+            f = open(path, 'wb')
+            f.write(content)
+            f.close()
+
+def add_options(parser):
+    parser.add_option('--tiles', dest='tiles', type='int', default=10000,
+        help='Number of tiles')
+    parser.add_option('--max-zoom', dest='max_zoom', type='int',
+        help='Deepest zoom level, by default the smallest pyramid holding --tiles')
+    parser.add_option('--duplicates', dest='duplicates', type='float', default=0.3,
+        help='Fraction of tiles reusing the image of another tile')
+    parser.add_option('--blob-size', dest='blob_size', type='int', default=4096,
+        help='Size of every tile in bytes')
+    parser.add_option('--grid-density', dest='grid_density', type='float', default=0.0,
+        help='Fraction of tiles that have a UTFGrid')
+    parser.add_option('--grid-keys', dest='grid_keys', type='int', default=4,
+        help='Number of keys of every UTFGrid')
+    parser.add_option('--scheme', dest='scheme', type='choice', choices=SCHEMES, default='xyz',
+        help='Directory scheme of generated tile trees: %s' % ', '.join(SCHEMES))
+    parser.add_option('--seed', dest='seed', type='int', default=1,
+        help='Random seed')
+
+def dataset_params(options):
+    return {'tiles': options.tiles, 'max_zoom': options.max_zoom,
+        'duplicates': options.duplicates, 'blob_size': options.blob_size,
+        'grid_density': options.grid_density, 'grid_keys': options.grid_keys,
+        'seed': options.seed}
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options] output.mbtiles|output_directory")
+    add_options(parser)
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or os.path.exists(args[0]):
+        parser.error('specify one output file or directory that does not exist yet')
+    if args[0].endswith('.mbtiles'):
+        make_mbtiles(args[0], **dataset_params(options))
+    else:
+        make_tree(args[0], scheme=options.scheme, **dataset_params(options))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# Load test for mb-util serve. Requests random tiles of an mbtiles file
+# from concurrent keep-alive clients, optionally revalidating tiles with
+# If-None-Match, and reports latency percentiles and requests/sec.
+#
+# Serve a file in-process and test it:
+# $ python bench/loadtest.py --mbtiles world.mbtiles --concurrency 8
+#
+# Test a server that is already running:
+# $ python bench/loadtest.py --mbtiles world.mbtiles --url http://127.0.0.1:8080
+#
+# Without --mbtiles a compacted file of synthetic tiles is generated.
+
+import os, sys, time, random, shutil, tempfile, sqlite3, threading, logging
+from optparse import OptionParser
+
+try:
+    from httplib import HTTPConnection
+    from urlparse import urlparse
+except ImportError:
+    from http.client import HTTPConnection
+    from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mbutil import mbtiles_setup, flip_y
+from mbutil.util_compact import compact_mbtiles_to_file
+from mbutil.util_serve import make_tile_server
+
+def make_tiles(path, count, blob_size, duplicate_ratio):
+    flat = path + '.flat'
+    con = sqlite3.connect(flat)
+    cur = con.cursor()
+    mbtiles_setup(cur)
+    unique_blobs = max(1, int(count * (1.0 - duplicate_ratio)))
+    blobs = [os.urandom(blob_size) + str(i).encode() for i in range(unique_blobs)]
+    z = 0
+    while (4 ** z) < count:
+        z += 1
+    side = 2 ** z
+    cur.executemany("insert into tiles values (?, ?, ?, ?)",
+        [(z, i % side, i // side, sqlite3.Binary(blobs[i % unique_blobs])) for i in range(count)])
+    cur.execute("insert into metadata values ('format', 'png')")
+    con.commit()
+    con.close()
+    compact_mbtiles_to_file(flat, path)
+    os.remove(flat)
+
+def tile_paths(path, limit):
+    con = sqlite3.connect(path)
+    rows = con.execute("SELECT zoom_level, tile_column, tile_row FROM tiles LIMIT ?", (limit,)).fetchall()
+    con.close()
+    return ['/%d/%d/%d.png' % (z, x, flip_y(z, y)) for z, x, y in rows]
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def client(host, port, paths, count, conditional, latencies, statuses, lock):
+    con = HTTPConnection(host, port)
+    etags = {}
+    mine = []
+    counts = {}
+    for i in range(count):
+        path = random.choice(paths)
+        headers = {}
+        if path in etags and random.random() < conditional:
+            headers['If-None-Match'] = etags[path]
+        start = time.time()
+        con.request('GET', path, headers=headers)
+        response = con.getresponse()
+        response.read()
+        mine.append(time.time() - start)
+        counts[response.status] = counts.get(response.status, 0) + 1
+        if response.getheader('ETag'):
+            etags[path] = response.getheader('ETag')
+    con.close()
+    lock.acquire()
+    latencies.extend(mine)
+    for status, n in counts.items():
+        statuses[status] = statuses.get(status, 0) + n
+    lock.release()
+
+def run(label, host, port, paths, options):
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    per_client = options.requests // options.concurrency
+    threads = [threading.Thread(target=client, args=(host, port, paths, per_client,
+        options.conditional, latencies, statuses, lock)) for i in range(options.concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    print("%-28s %7d requests %8.0f req/sec  p50 %6.2fms  p99 %6.2fms  max %6.2fms  %s" % (
+        label, len(latencies), len(latencies) / elapsed,
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        latencies[-1] * 1000,
+        " ".join(["%d:%d" % s for s in sorted(statuses.items())])))
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--mbtiles', dest='mbtiles',
+        help='File to request tiles of (and to serve unless --url is given)')
+    parser.add_option('--url', dest='url',
+        help='Base URL of a running server, e.g. http://127.0.0.1:8080')
+    parser.add_option('--tiles', dest='tiles', type='int', default=20000,
+        help='Number of synthetic tiles when no --mbtiles is given')
+    parser.add_option('--blob-size', dest='blob_size', type='int', default=16384,
+        help='Size of every synthetic tile in bytes')
+    parser.add_option('--requests', dest='requests', type='int', default=20000,
+        help='Total number of requests per run')
+    parser.add_option('--concurrency', dest='concurrency', type='int', default=8,
+        help='Number of concurrent keep-alive clients')
+    parser.add_option('--conditional', dest='conditional', type='float', default=0.5,
+        help='Fraction of repeated requests sent with If-None-Match')
+    parser.add_option('--workers', dest='workers', type='int', default=8,
+        help='Threads of the in-process server')
+    parser.add_option('--cache-size', dest='cache_size', type='int', default=4096,
+        help='Tile cache entries of the in-process server')
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    random.seed(1)
+    tmp = tempfile.mkdtemp()
+    server = None
+    try:
+        mbtiles = options.mbtiles
+        if not mbtiles:
+            mbtiles = os.path.join(tmp, 'synthetic.mbtiles')
+            make_tiles(mbtiles, options.tiles, options.blob_size, 0.3)
+        paths = tile_paths(mbtiles, 1000000)
+
+        if options.url:
+            url = urlparse(options.url)
+            host, port = url.hostname, url.port or 80
+        else:
+            server = make_tile_server(mbtiles, '127.0.0.1', 0, workers=max(options.workers, options.concurrency),
+                cache_size=options.cache_size)
+            host, port = server.server_address
+            t = threading.Thread(target=server.serve_forever)
+            t.daemon = True
+            t.start()
+
+        conditional = options.conditional
+        options.conditional = 0
+        run('unconditional', host, port, paths, options)
+        options.conditional = conditional
+        run('%d%% If-None-Match' % (conditional * 100), host, port, paths, options)
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+            server.reader.close()
+        shutil.rmtree(tmp)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# Benchmark suite: times disk_to_mbtiles, mbtiles_to_disk, compact_mbtiles,
+# compact_mbtiles_to_file and optimize_database_file on synthetic data
+# (see generate.py) and records tiles/sec, peak RSS and bytes written as
+# JSON. Every operation runs in a fresh process so peak RSS is its own.
+#
+# $ python bench/suite.py --tiles 100000 --output before.json
+# $ python bench/suite.py --tiles 100000 --output after.json --compare before.json
+
+import os, sys, json, time, shutil, tempfile, subprocess, platform, sqlite3, logging
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from generate import add_options, dataset_params, make_mbtiles, make_tree
+
+OPERATIONS = ['import', 'export', 'compact', 'compact_to_file', 'optimize']
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def io_write_bytes():
+    """ Bytes this process caused to be written to storage, where /proc tells """
+    try:
+        f = open('/proc/self/io')
+        counters = dict(line.split(': ') for line in f.read().splitlines())
+        f.close()
+        return int(counters['write_bytes'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+def output_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+def run_operation(op, work, scheme, workers):
+    """ Runs one operation on the prepared datasets in work, in this process """
+    from mbutil import disk_to_mbtiles, mbtiles_to_disk, optimize_database_file
+    from mbutil.util_compact import compact_mbtiles, compact_mbtiles_to_file
+    logging.basicConfig(level=logging.ERROR)
+    source = os.path.join(work, 'source.mbtiles')
+    if op in ('compact', 'optimize'):
+        output = os.path.join(work, '%s.mbtiles' % op)
+        shutil.copy(source, output)
+    io_before = io_write_bytes()
+    start = time.time()
+    if op == 'import':
+        output = os.path.join(work, 'imported.mbtiles')
+        disk_to_mbtiles(os.path.join(work, 'tree'), output, scheme=scheme, workers=workers)
+    elif op == 'export':
+        output = os.path.join(work, 'exported')
+        mbtiles_to_disk(source, output, scheme=scheme, workers=workers)
+    elif op == 'compact':
+        compact_mbtiles(output, workers=workers)
+    elif op == 'compact_to_file':
+        output = os.path.join(work, 'compact_copy.mbtiles')
+        compact_mbtiles_to_file(source, output, workers=workers)
+    elif op == 'optimize':
+        optimize_database_file(output)
+    seconds = time.time() - start
+    io_after = io_write_bytes()
+    result = {'seconds': seconds, 'peak_rss_kb': peak_rss_kb(),
+        'output_bytes': output_size(output),
+        'io_write_bytes': io_after - io_before if io_before is not None else None}
+    if os.path.isdir(output):
+        shutil.rmtree(output)
+    else:
+        os.remove(output)
+    return result
+
+def run_child(op, work, scheme, workers, tiles):
+    command = [sys.executable, os.path.abspath(__file__), '--child', op, '--work', work,
+        '--scheme', scheme, '--workers', str(workers)]
+    child = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = child.communicate()
+    result = {'operation': op}
+    if child.returncode != 0:
+        lines = err.decode('utf-8', 'replace').strip().splitlines()
+        result['error'] = lines[-1] if lines else 'exit status %d' % child.returncode
+        return result
+    result.update(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+    result['tiles_per_sec'] = tiles / max(result['seconds'], 1e-9)
+    return result
+
+def print_results(results, previous=None):
+    before = {}
+    if previous:
+        before = dict((r['operation'], r) for r in previous['results'] if 'error' not in r)
+    for r in results:
+        if 'error' in r:
+            print("%-16s failed: %s" % (r['operation'], r['error']))
+            continue
+        line = "%-16s %8.2fs %10.0f tiles/sec %8.1f MB peak RSS %10.1f MB written" % (
+            r['operation'], r['seconds'], r['tiles_per_sec'], (r['peak_rss_kb'] or 0) / 1024.0,
+            (r['io_write_bytes'] if r['io_write_bytes'] is not None else r['output_bytes']) / 1e6)
+        if r['operation'] in before:
+            line += "   %+6.1f%% tiles/sec" % (
+                100.0 * (r['tiles_per_sec'] / before[r['operation']]['tiles_per_sec'] - 1))
+        print(line)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    add_options(parser)
+    parser.add_option('--workers', dest='workers', type='int', default=1,
+        help='workers passed to every operation')
+    parser.add_option('--operations', dest='operations', default=','.join(OPERATIONS),
+        help='Comma separated operations to run: %s' % ', '.join(OPERATIONS))
+    parser.add_option('--output', dest='output',
+        help='Write the results to this JSON file')
+    parser.add_option('--compare', dest='compare',
+        help='JSON file of an earlier run to compare tiles/sec with')
+    parser.add_option('--tmp-dir', dest='tmp_dir',
+        help='Where to generate datasets, by default the system temporary directory')
+    parser.add_option('--child', dest='child', help='(internal) run one operation')
+    parser.add_option('--work', dest='work', help='(internal) dataset directory')
+    (options, args) = parser.parse_args()
+
+    if options.child:
+        result = run_operation(options.child, options.work, options.scheme, options.workers)
+        # the operations may leave an unterminated progress line on stdout
+        print('\n' + json.dumps(result))
+        sys.exit(0)
+
+    operations = [op for op in options.operations.split(',') if op]
+    for op in operations:
+        if op not in OPERATIONS:
+            parser.error('unknown operation %s' % op)
+    params = dataset_params(options)
+    work = tempfile.mkdtemp(dir=options.tmp_dir)
+    try:
+        start = time.time()
+        make_mbtiles(os.path.join(work, 'source.mbtiles'), **params)
+        if 'import' in operations:
+            make_tree(os.path.join(work, 'tree'), scheme=options.scheme, **params)
+        print("generated %d tiles in %.1fs" % (options.tiles, time.time() - start))
+        results = [run_child(op, work, options.scheme, options.workers, options.tiles)
+            for op in operations]
+    finally:
+        shutil.rmtree(work)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'dataset': dict(params, scheme=options.scheme),
+        'workers': options.workers,
+        'results': results,
+    }
+    try:
+        report['revision'] = subprocess.Popen(['git', 'describe', '--always', '--dirty'],
+            cwd=BENCH_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            ).communicate()[0].decode('utf-8').strip() or None
+    except OSError:
+        report['revision'] = None
+
+    previous = None
+    if options.compare:
+        f = open(options.compare)
+        previous = json.load(f)
+        f.close()
+    print_results(results, previous)
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump(report, f, indent=4, sort_keys=True)
+        f.close()
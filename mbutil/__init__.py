@@ -1 +1,9 @@
 from mbutil.util import *
+from mbutil.util_merge import merge_mbtiles
+from mbutil.util_diff import diff_mbtiles
+from mbutil.util_split import split_mbtiles, merge_shards
+from mbutil.util_verify import verify_mbtiles
+from mbutil.util_gc import gc_mbtiles
+from mbutil.util_stats import mbtiles_stats
+from mbutil.util_order import reorder_tiles, ordered_tiles
+from mbutil.util_reader import MBTilesReader
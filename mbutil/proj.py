@@ -171,6 +171,11 @@ Library.
 from math import pi, sin, log, exp, atan, tan
 from gettext import gettext as _
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 DEG_TO_RAD = pi/180
 RAD_TO_DEG = 180/pi
 MAX_LATITUDE = 85.0511287798
@@ -232,6 +237,36 @@ class GoogleProjection(object):
             h = - h
         return (f,h)
 
+    def project_pixels_many(self, lngs, lats, zoom):
+        """
+        Vectorized project_pixels for sequences of longitudes and latitudes.
+        Returns a pair of NumPy arrays, or of lists when NumPy is missing.
+        """
+        if numpy is None:
+            pixels = [self.project_pixels(ll, zoom) for ll in zip(lngs, lats)]
+            return [p[0] for p in pixels], [p[1] for p in pixels]
+        d = self.zc[zoom]
+        lngs = numpy.asarray(lngs, dtype=numpy.float64)
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        e = d[0] + lngs * self.Bc[zoom]
+        f = numpy.clip(numpy.sin(DEG_TO_RAD * lats), -0.9999, 0.9999)
+        g = d[1] + 0.5 * numpy.log((1 + f) / (1 - f)) * -self.Cc[zoom]
+        # round half away from zero, like the builtin round of Python 2
+        return (numpy.sign(e) * numpy.floor(numpy.abs(e) + 0.5),
+            numpy.sign(g) * numpy.floor(numpy.abs(g) + 0.5))
+
+    def tiles_at_many(self, lngs, lats, zoom):
+        """
+        Vectorized tile_at: returns the tile columns and rows (in the
+        projection's pixel orientation, y growing southwards) of many points.
+        """
+        x, y = self.project_pixels_many(lngs, lats, zoom)
+        if numpy is None:
+            return ([int(v / self.tilesize) for v in x],
+                [int(v / self.tilesize) for v in y])
+        return ((x / self.tilesize).astype(numpy.int64),
+            (y / self.tilesize).astype(numpy.int64))
+
     def tile_at(self, zoom, position):
         """
         Returns a tuple of (z, x, y)
@@ -267,7 +302,7 @@ class GoogleProjection(object):
         lat = 2 * atan(exp(y/EARTH_RADIUS)) - pi/2 * RAD_TO_DEG
         return (lng, lat)
 
-    def tileslist(self, bbox):
+    def check_bbox(self, bbox):
         if len(bbox) != 4:
             raise InvalidCoverageError(_("Wrong format of bounding box."))
         xmin, ymin, xmax, ymax = bbox
@@ -278,52 +313,96 @@ class GoogleProjection(object):
         if xmin >= xmax or ymin >= ymax:
             raise InvalidCoverageError(_("Bounding box format is (xmin, ymin, xmax, ymax)"))
 
-        ll0 = (xmin, ymax)  # left top
-        ll1 = (xmax, ymin)  # right bottom
-
-        l = []
+    def zoom_tile_bounds(self, bbox, z):
+        """
+        Returns the inclusive (xmin, xmax, ymin, ymax) tile indexes covering
+        bbox at zoom z, clipped to the grid, in the projection's pixel
+        orientation (before any tms flip), or None if nothing is covered.
+        """
+        xmin, ymin, xmax, ymax = bbox
+        px0 = self.project_pixels((xmin, ymax), z) # left top
+        px1 = self.project_pixels((xmax, ymin), z) # right bottom
+        x0 = max(int(px0[0]/self.tilesize), 0)
+        x1 = min(int(px1[0]/self.tilesize), 2**z - 1)
+        y0 = max(int(px0[1]/self.tilesize), 0)
+        y1 = min(int(px1[1]/self.tilesize), 2**z - 1)
+        if x0 > x1 or y0 > y1:
+            return None
+        return (x0, x1, y0, y1)
+
+    def itertiles(self, bbox):
+        """
+        Lazily yields the same (z, x, y) tuples, in the same order, as
+        tileslist, without building the whole list.
+        """
+        self.check_bbox(bbox)
         for z in self.levels:
-            px0 = self.project_pixels(ll0,z)
-            px1 = self.project_pixels(ll1,z)
-
-            for x in range(int(px0[0]/self.tilesize),
-                           int(px1[0]/self.tilesize)+1):
-                if (x < 0) or (x >= 2**z):
-                    continue
-                for y in range(int(px0[1]/self.tilesize),
-                               int(px1[1]/self.tilesize)+1):
-                    if (y < 0) or (y >= 2**z):
-                        continue
+            bounds = self.zoom_tile_bounds(bbox, z)
+            if bounds is None:
+                continue
+            x0, x1, y0, y1 = bounds
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
                     if self.scheme == 'tms':
                         y = ((2**z-1) - y)
-                    l.append((z, x, y))
-        return l
+                    yield (z, x, y)
 
-    def tileranges(self, bbox):
-        if len(bbox) != 4:
-            raise InvalidCoverageError(_("Wrong format of bounding box."))
-        xmin, ymin, xmax, ymax = bbox
-        if abs(xmin) > 180 or abs(xmax) > 180 or \
-           abs(ymin) > 90 or abs(ymax) > 90:
-            raise InvalidCoverageError(_("Some coordinates exceed [-180,+180], [-90, 90]."))
-
-        if xmin >= xmax or ymin >= ymax:
-            raise InvalidCoverageError(_("Bounding box format is (xmin, ymin, xmax, ymax)"))
+    def tileschunks(self, bbox, chunk_size=65536):
+        """
+        Yields the tiles of tileslist in chunks of at most chunk_size rows:
+        (n, 3) integer NumPy arrays of z, x, y, or lists of tuples when
+        NumPy is missing. Memory use is bounded by chunk_size whatever the
+        coverage.
+        """
+        if numpy is None:
+            chunk = []
+            for tile in self.itertiles(bbox):
+                chunk.append(tile)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+            return
+
+        self.check_bbox(bbox)
+        for z in self.levels:
+            bounds = self.zoom_tile_bounds(bbox, z)
+            if bounds is None:
+                continue
+            x0, x1, y0, y1 = bounds
+            rows = y1 - y0 + 1
+            total = (x1 - x0 + 1) * rows
+            for start in range(0, total, chunk_size):
+                index = numpy.arange(start, min(start + chunk_size, total), dtype=numpy.int64)
+                chunk = numpy.empty((len(index), 3), dtype=numpy.int64)
+                chunk[:, 0] = z
+                chunk[:, 1] = x0 + index // rows
+                chunk[:, 2] = y0 + index % rows
+                if self.scheme == 'tms':
+                    chunk[:, 2] = (2**z-1) - chunk[:, 2]
+                yield chunk
 
-        ll0 = (xmin, ymax)  # left top
-        ll1 = (xmax, ymin)  # right bottom
+    def tileslist(self, bbox):
+        return list(self.itertiles(bbox))
 
+    def tileranges(self, bbox):
+        """
+        Returns {z: {'x': (xmin, xmax), 'y': [ymin, ymax]}}, the tile ranges
+        of itertiles at every zoom level the bbox covers, padded by a tile
+        on the east and south edges as the ranges always were.
+        """
+        self.check_bbox(bbox)
         l = {}
         for z in self.levels:
-            l[z] = {}
-            px0 = self.project_pixels(ll0,z)
-            px1 = self.project_pixels(ll1,z)
-
-            x_range = (int(px0[0]/self.tilesize), int(px1[0]/self.tilesize) + 1)
-            y_range = [int(px0[1]/self.tilesize), int(px1[1]/self.tilesize) + 1]
+            bounds = self.zoom_tile_bounds(bbox, z)
+            if bounds is None:
+                continue
+            x0, x1, y0, y1 = bounds
+            x_range = (x0, x1 + 1)
+            y_range = [y0, y1 + 1]
             if self.scheme == 'tms':
                 y_range = [((2**z-1) - y) for y in y_range]
                 y_range.reverse()
-            l[z]['x'] = x_range
-            l[z]['y'] = y_range
+            l[z] = {'x': x_range, 'y': y_range}
         return l
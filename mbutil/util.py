@@ -9,15 +9,43 @@
 # for additional reference on schema see:
 # https://github.com/mapbox/node-mbtiles/blob/master/lib/schema.sql
 
-import sqlite3, uuid, sys, logging, time, os, json, zlib, re
+import sqlite3, uuid, sys, logging, time, os, json, zlib, re, threading, hashlib, errno
+import multiprocessing
+from collections import deque
 from proj import GoogleProjection
+from util_archive import archive_kind, archive_members, ArchiveWriter
+from util_progress import make_progress
+from util_transform import make_pipeline, chunked
+from util_order import reorder_tiles
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 logger = logging.getLogger(__name__)
 
 def flip_y(zoom, y):
     return (2**zoom-1) - y
 
+def incremental_vacuum_setup(cur):
+    """
+    Let space freed by deleting tiles be returned with PRAGMA
+    incremental_vacuum instead of a VACUUM rewriting the whole file. Only
+    takes effect before the first table of a new file is created.
+    """
+    cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
 def mbtiles_setup(cur):
+    incremental_vacuum_setup(cur)
     cur.execute("""
         create table tiles (
             zoom_level integer,
@@ -34,6 +62,211 @@ def mbtiles_setup(cur):
     cur.execute("""create unique index name on metadata (name);""")
     cur.execute("""create unique index tile_index on tiles
         (zoom_level, tile_column, tile_row);""")
+    cur.execute("""create unique index grid_index on grids
+        (zoom_level, tile_column, tile_row);""")
+    cur.execute("""create unique index grid_data_index on grid_data
+        (zoom_level, tile_column, tile_row, key_name);""")
+
+def table_type(cur, name):
+    """ Returns 'table', 'view' or None; name may be prefixed with a schema """
+    schema = 'main'
+    if '.' in name:
+        schema, name = name.split('.', 1)
+    row = cur.execute("""SELECT type FROM %s.sqlite_master
+        WHERE type IN ('table', 'view') AND name = ?""" % schema, (name,)).fetchone()
+    return row[0] if row else None
+
+def table_exists(cur, name):
+    return table_type(cur, name) is not None
+
+def image_key(cur):
+    """
+    Returns the column joining map to images in a compacted file: 'tile_id'
+    for the md5-keyed layout, 'image_id' for files written by
+    compact_mbtiles_to_file, or None for a flat file.
+    """
+    if not table_exists(cur, 'images') or not table_exists(cur, 'map'):
+        return None
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(map)").fetchall()]
+    return 'image_id' if 'image_id' in columns else 'tile_id'
+
+def index_exists(cur, name):
+    return cur.execute("""SELECT count(name) FROM sqlite_master
+        WHERE type = 'index' AND name = ?""", (name,)).fetchone()[0] > 0
+
+def has_image_hashes(cur):
+    """ True if images can be looked up by their tile_id hash """
+    key = image_key(cur)
+    return key == 'tile_id' or (key == 'image_id' and index_exists(cur, 'images_id'))
+
+# metadata name of the digest the tile_ids of a compacted file are made with
+HASH_KEY = 'mbutil_hash'
+
+def image_hash_function(cur, schema='main'):
+    """
+    The hashlib digest the tile_ids of a compacted file were made with:
+    the one compaction recorded in metadata, or md5, which files compacted
+    before it was recorded (and by node-mbtiles) use.
+    """
+    try:
+        row = cur.execute("""select value from %s.metadata where name = ?;""" % schema,
+            (HASH_KEY,)).fetchone()
+    except sqlite3.OperationalError:
+        return 'md5'
+    return row[0] if row and row[0] else 'md5'
+
+def record_hash_function(cur, hash_function):
+    """ Record the digest the tile_ids of a compacted file are made with """
+    cur.execute("""replace into metadata (name, value) values (?, ?);""",
+        (HASH_KEY, hash_function))
+
+def check_hash_functions(*connections):
+    """
+    Exit unless the compacted files of connections that keep image hashes
+    all make them with the same digest: their tile_ids cannot be compared
+    otherwise. Returns that digest, or None.
+    """
+    names = set([image_hash_function(con) for con in connections if has_image_hashes(con)])
+    if len(names) > 1:
+        logger.error("The files hash their images with different digests (%s), recompact "
+            "them with the same --hash" % ', '.join(sorted(names)))
+        sys.exit(1)
+    if names:
+        return names.pop()
+    return None
+
+def tile_filter(bbox=None, zoom_range=None):
+    """
+    Returns a (where, params) pair restricting zoom_level, tile_column and
+    tile_row (TMS) to a W,S,E,N bbox and/or a zoom range.
+    """
+    if bbox:
+        proj = GoogleProjection(256, zoom_range or range(0, 22), "tms")
+        tile_range = proj.tileranges(bbox)
+        clauses = []
+        params = []
+        for z in sorted(tile_range.keys()):
+            clauses.append("""(zoom_level = ? AND tile_column BETWEEN ? AND ?
+                AND tile_row BETWEEN ? AND ?)""")
+            params.extend([z, tile_range[z]['x'][0], tile_range[z]['x'][1],
+                tile_range[z]['y'][0], tile_range[z]['y'][1]])
+        if not clauses:
+            return "0", []
+        return "(%s)" % " OR ".join(clauses), params
+    if zoom_range:
+        return "zoom_level BETWEEN ? AND ?", [min(zoom_range), max(zoom_range)]
+    return "1", []
+
+def metadata_and_grids_setup(cur):
+    cur.execute("""create table if not exists metadata
+        (name text, value text);""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS grids (zoom_level integer, tile_column integer,
+    tile_row integer, grid blob);""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS grid_data (zoom_level integer, tile_column
+    integer, tile_row integer, key_name text, key_json text);""")
+    cur.execute("""create unique index if not exists name on metadata (name);""")
+    # grids and grid_data are views over grid_utfgrid/keymap in files
+    # compacted by node-mbtiles
+    if table_type(cur, 'grids') == 'table':
+        cur.execute("""create unique index if not exists grid_index on grids
+            (zoom_level, tile_column, tile_row);""")
+    if table_type(cur, 'grid_data') == 'table':
+        cur.execute("""create unique index if not exists grid_data_index on grid_data
+            (zoom_level, tile_column, tile_row, key_name);""")
+
+def tile_index_setup(cur):
+    """
+    Add the unique tile_index a flat tiles table needs for replace into to
+    replace tiles rather than append them. Files written by other tools may
+    lack it and hold a tile more than once; the last row written wins.
+    """
+    if table_type(cur, 'tiles') != 'table' or index_exists(cur, 'tile_index'):
+        return
+    duplicates = cur.execute("""select sum(n - 1) from (select count(*) as n from tiles
+        group by zoom_level, tile_column, tile_row having n > 1);""").fetchone()[0]
+    if duplicates:
+        logger.warning("%d duplicate tiles found, keeping the last written of each" % duplicates)
+        cur.execute("""delete from tiles where rowid not in (select max(rowid) from tiles
+            group by zoom_level, tile_column, tile_row);""")
+    cur.execute("""create unique index tile_index on tiles
+        (zoom_level, tile_column, tile_row);""")
+
+def mbtiles_upgrade(cur):
+    """
+    Prepare an existing MBTiles file, flat or compacted, for an incremental
+    import: add whatever tables and unique indexes the upserts rely on.
+    """
+    if not table_exists(cur, 'tiles'):
+        mbtiles_setup(cur)
+    else:
+        metadata_and_grids_setup(cur)
+        tile_index_setup(cur)
+    cur.execute("""create table if not exists import_manifest (
+        path text primary key,
+        size integer,
+        mtime real,
+        hash text);""")
+
+# metadata name of the statistics mb-util stats --write-stats stores
+STATS_KEY = 'mbutil_stats'
+
+def cached_stats(cur, schema='main'):
+    """ The statistics stored by mbtiles_stats(write_stats=True), or None """
+    try:
+        row = cur.execute("""select value from %s.metadata where name = ?;""" % schema,
+            (STATS_KEY,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    try:
+        return row and json.loads(row[0])
+    except ValueError:
+        return None
+
+def invalidate_stats(cur):
+    """ Drop the stored statistics of a file whose tiles are being changed """
+    cur.execute("""delete from metadata where name = ?;""", (STATS_KEY,))
+
+def count_tiles(cur, schema='main'):
+    """ The number of tiles, from the stored statistics when there are some """
+    stats = cached_stats(cur, schema)
+    if stats and 'tiles' in stats:
+        return stats['tiles']
+    return cur.execute("""select count(zoom_level) from %s.tiles;""" % schema).fetchone()[0]
+
+def checkpoint_setup(cur):
+    """
+    Checkpoints record how far an interrupted operation got, committed in
+    the same transactions as its output so --resume neither repeats nor
+    misses tiles: the last compacted rowid of compact_mbtiles, the tile
+    directories disk_to_mbtiles has finished importing.
+    """
+    cur.execute("""create table if not exists checkpoints (
+        operation text,
+        position text,
+        unique (operation, position));""")
+
+def read_checkpoints(cur, operation):
+    """ The positions recorded for operation, or None if the file has no checkpoints table """
+    if not table_exists(cur, 'checkpoints'):
+        return None
+    rows = cur.execute("""select position from checkpoints where operation = ?;""",
+        (operation,)).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+def write_checkpoint(cur, operation, position, replace=True):
+    """ Record position for operation, replacing earlier positions unless replace is False """
+    if replace:
+        cur.execute("""delete from checkpoints where operation = ?;""", (operation,))
+    cur.execute("""insert or ignore into checkpoints (operation, position) values (?, ?);""",
+        (operation, json.dumps(position)))
+
+def clear_checkpoints(cur, operation):
+    """ Forget the checkpoints of a finished operation """
+    if not table_exists(cur, 'checkpoints'):
+        return
+    cur.execute("""delete from checkpoints where operation = ?;""", (operation,))
+    if cur.execute("""select count(*) from checkpoints;""").fetchone()[0] == 0:
+        cur.execute("""drop table checkpoints;""")
 
 def mbtiles_connect(mbtiles_file):
     try:
@@ -62,49 +295,941 @@ def optimize_connection(cur, wal_journal=False, synchronous_off=False, exclusive
     if synchronous_off:
         cur.execute("PRAGMA synchronous = OFF")
 
-def optimize_database(cur, skip_analyze=False, skip_vacuum=False):
+def optimize_database(cur, skip_analyze=False, skip_vacuum=False, progress=None):
     if not skip_analyze:
         logger.info('analyzing db')
+        start = time.time()
         cur.execute("""ANALYZE""")
+        if progress:
+            progress.add_time('analyze', time.time() - start)
 
     if not skip_vacuum:
         logger.info('cleaning db')
+        start = time.time()
         cur.execute("""VACUUM""")
+        if progress:
+            progress.add_time('vacuum', time.time() - start)
 
-def optimize_database_file(mbtiles_file, skip_analyze=False, skip_vacuum=False, wal_journal=False):
+def optimize_database_file(mbtiles_file, skip_analyze=False, skip_vacuum=False, wal_journal=False, **kwargs):
+    progress = make_progress('optimize', kwargs)
     con = mbtiles_connect(mbtiles_file)
     cur = con.cursor()
     optimize_connection(cur, wal_journal)
-    optimize_database(cur, skip_analyze, skip_vacuum)
+    optimize_database(cur, skip_analyze, skip_vacuum, progress)
     con.commit()
     con.close()
+    progress.done()
+
+class ListedEntry(object):
+    """ The parts of os.DirEntry mbutil uses, for Pythons without scandir """
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+def scan_dir(path):
+    """
+    Iterate over the entries of directory path. With scandir (os.scandir,
+    or the scandir package on Python 2) entries come as the directory is
+    read and is_dir() needs no stat call on most file systems.
+    """
+    if scandir is not None:
+        return scandir(path)
+    return (ListedEntry(path, name) for name in os.listdir(path))
 
 def getDirs(path):
-    return [name for name in os.listdir(path)
-        if os.path.isdir(os.path.join(path, name))]
+    return [entry.name for entry in scan_dir(path) if entry.is_dir()]
+
+_STOP = object()
+
+class WorkerError(object):
+    """ Wraps an exception raised inside a parallel_imap worker """
+    def __init__(self, exception):
+        self.exception = exception
+
+def parallel_imap(func, iterable, workers=1, queue_size=None):
+    """
+    Yield func(item) for every item in iterable, in completion order.
+
+    The iterable is consumed by the calling thread, so it may safely be a
+    sqlite cursor, while func runs on a pool of worker threads. At most
+    queue_size items are queued ahead of the workers, which keeps memory
+    flat however long the input is. With a single worker no threads are
+    started and results come back in input order.
+    """
+    if workers is None or workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    if not queue_size:
+        queue_size = workers * 4
+    jobs = Queue(queue_size)
+    results = Queue()
+
+    def work():
+        while True:
+            item = jobs.get()
+            if item is _STOP:
+                results.put(_STOP)
+                return
+            try:
+                results.put(func(item))
+            except Exception as e:
+                results.put(WorkerError(e))
+
+    for i in range(workers):
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+
+    for item in iterable:
+        jobs.put(item)
+        while not results.empty():
+            r = results.get()
+            if isinstance(r, WorkerError):
+                raise r.exception
+            yield r
+
+    for i in range(workers):
+        jobs.put(_STOP)
+    finished = 0
+    while finished < workers:
+        r = results.get()
+        if r is _STOP:
+            finished += 1
+        elif isinstance(r, WorkerError):
+            raise r.exception
+        else:
+            yield r
+
+def ordered_imap(func, iterable, workers=1, queue_size=None):
+    """
+    parallel_imap, with the results coming back in input order. At most
+    queue_size items are in flight or waiting for an earlier one to finish,
+    so a slow item holds up the input instead of letting the results after
+    it pile up in memory.
+    """
+    if workers is None or workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    if not queue_size:
+        queue_size = workers * 2
+    jobs = Queue()
+
+    def work():
+        while True:
+            job = jobs.get()
+            if job is _STOP:
+                return
+            item, result = job
+            try:
+                result.put(func(item))
+            except Exception as e:
+                result.put(WorkerError(e))
+
+    for i in range(workers):
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+
+    def next_result(pending):
+        r = pending.popleft().get()
+        if isinstance(r, WorkerError):
+            raise r.exception
+        return r
+
+    pending = deque()
+    try:
+        for item in iterable:
+            result = Queue(1)
+            jobs.put((item, result))
+            pending.append(result)
+            if len(pending) >= queue_size:
+                yield next_result(pending)
+        while pending:
+            yield next_result(pending)
+    finally:
+        for i in range(workers):
+            jobs.put(_STOP)
+
+_process_func = None
+
+def _process_init(func):
+    global _process_func
+    _process_func = func
+
+def _process_call(item):
+    return _process_func(item)
+
+def process_imap(func, iterable, workers=1, queue_size=None):
+    """
+    Like parallel_imap, for CPU bound work: func runs in a pool of worker
+    processes and results come back in input order. func is handed to the
+    workers when they start instead of with every item, so where processes
+    are forked it need not be picklable. At most queue_size items are in
+    flight. The pool is started before the first item is taken from
+    iterable, so no other threads exist yet when it forks.
+    """
+    if workers is None or workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    if not queue_size:
+        queue_size = workers * 2
+    pool = multiprocessing.Pool(workers, _process_init, (func,))
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(_process_call, (item,)))
+            if len(pending) >= queue_size:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def process_chunks(func, chunks, workers=1, progress=None, stage='transform'):
+    """
+    Yield [func(item) for item in chunk] for every chunk, in order, using
+    process_imap. The time the workers spend is added to stage of progress.
+    """
+    def run(chunk):
+        start = time.time()
+        out = [func(item) for item in chunk]
+        return time.time() - start, out
+    for seconds, out in process_imap(run, chunks, workers):
+        if progress:
+            progress.add_time(stage, seconds)
+        yield out
+
+class TileBatchWriter(object):
+    """
+    Buffers tiles and grids and writes them with executemany, committing
+    once every batch_size rows so no transaction grows without bound.
+
+    With upsert=True existing tiles and grids are replaced, and tiles go
+    into map/images when the target file is compacted. With track_orphans
+    the image keys that replaced map rows pointed at are collected in
+    self.orphans, so unreferenced images can be removed afterwards. Time
+    spent writing and committing is added to the stages of progress.
+    """
+    def __init__(self, con, batch_size=1000, upsert=False, track_orphans=False, progress=None):
+        self.con = con
+        self.progress = progress
+        self.cur = con.cursor()
+        self.batch_size = max(1, batch_size or 1)
+        self.upsert = upsert
+        self.compacted = upsert and image_key(self.cur)
+        self.hash_function = image_hash_function(self.cur) if self.compacted else 'md5'
+        self.dedup = self.compacted and index_exists(self.cur, 'images_id')
+        self.grid_views = upsert and table_type(self.cur, 'grids') == 'view'
+        self.orphans = set() if track_orphans and self.compacted else None
+        if self.orphans is not None:
+            # the map rows a batch replaces are looked up in one join
+            self.cur.execute("""create temp table if not exists replaced_tiles (zoom_level
+                integer, tile_column integer, tile_row integer);""")
+        self.tiles = []
+        self.grids = []
+        self.grid_data = []
+        self.manifest = []
+        self.checkpoints = []
+        self.stats_invalidated = False
+
+    def add_tile(self, z, x, y, tile_data, tile_id=None):
+        """
+        tile_id is the hex digest of tile_data, by the hash_function of
+        the target file, when the caller already knows it. tile_data may then be None if a compacted target is known
+        to hold that image already.
+        """
+        self.tiles.append((z, x, y, tile_data, tile_id))
+        if len(self.tiles) + len(self.grids) >= self.batch_size:
+            self.flush()
+
+    def add_grid(self, z, x, y, grid, grid_data):
+        self.grids.append((z, x, y, sqlite3.Binary(grid)))
+        for key_name, key_json in grid_data:
+            self.grid_data.append((z, x, y, key_name, key_json))
+        if len(self.tiles) + len(self.grids) >= self.batch_size:
+            self.flush()
+
+    def update_map(self, column, rows):
+        # update then insert, so the other map column (tile_id or grid_id)
+        # of an existing row survives
+        self.cur.executemany("""update map set %s = ? where zoom_level = ?
+            and tile_column = ? and tile_row = ?;""" % column,
+            [(r[3], r[0], r[1], r[2]) for r in rows])
+        self.cur.executemany("""insert or ignore into map (zoom_level,
+            tile_column, tile_row, %s) values (?, ?, ?, ?);""" % column, rows)
+
+    def collect_orphans(self, rows):
+        self.cur.executemany("""insert into temp.replaced_tiles (zoom_level, tile_column,
+            tile_row) values (?, ?, ?);""", [r[:3] for r in rows])
+        self.orphans.update([r[0] for r in self.cur.execute("""select map.%(key)s
+            from temp.replaced_tiles t cross join map on map.zoom_level = t.zoom_level
+            and map.tile_column = t.tile_column and map.tile_row = t.tile_row
+            where map.%(key)s is not null;""" % {'key': self.compacted}).fetchall()])
+        self.cur.execute("""delete from temp.replaced_tiles;""")
+
+    def flush_image_ids(self, rows):
+        map_rows = []
+        for z, x, y, tile_id, data in rows:
+            image_id = None
+            if self.dedup:
+                row = self.cur.execute("""select image_id from images
+                    where tile_id = ?;""", (tile_id,)).fetchone()
+                image_id = row and row[0]
+            if image_id is None:
+                self.cur.execute("""insert into images (tile_data, tile_id)
+                    values (?, ?);""", (sqlite3.Binary(data), tile_id if self.dedup else None))
+                image_id = self.cur.lastrowid
+            map_rows.append((z, x, y, image_id))
+        self.update_map('image_id', map_rows)
+
+    def flush_grid_views(self):
+        keys = {}
+        for z, x, y, key_name, key_json in self.grid_data:
+            keys.setdefault((z, x, y), []).append((key_name, key_json))
+        map_rows = []
+        grid_keys = []
+        keymap = []
+        utfgrids = []
+        for z, x, y, grid in self.grids:
+            grid_keys_json = keys.get((z, x, y), [])
+            m = hashlib.md5(grid)
+            m.update(json.dumps(grid_keys_json).encode())
+            grid_id = m.hexdigest()
+            utfgrids.append((grid_id, grid))
+            map_rows.append((z, x, y, grid_id))
+            for key_name, key_json in grid_keys_json:
+                grid_keys.append((grid_id, key_name))
+                keymap.append((key_name, key_json))
+        self.cur.executemany("""insert or ignore into grid_utfgrid (grid_id,
+            grid_utfgrid) values (?, ?);""", utfgrids)
+        self.cur.executemany("""insert or ignore into grid_key (grid_id,
+            key_name) values (?, ?);""", grid_keys)
+        self.cur.executemany("""replace into keymap (key_name, key_json)
+            values (?, ?);""", keymap)
+        self.update_map('grid_id', map_rows)
+
+    def invalidate_stats(self):
+        if not self.stats_invalidated:
+            invalidate_stats(self.cur)
+            self.stats_invalidated = True
+
+    def delete_tiles(self, rows):
+        """ Delete the tiles (and grids) at the (z, x, y) of rows """
+        self.flush()
+        self.invalidate_stats()
+        if self.compacted:
+            if self.orphans is not None:
+                self.collect_orphans(rows)
+            self.cur.executemany("""delete from map where zoom_level = ?
+                and tile_column = ? and tile_row = ?;""", rows)
+        else:
+            self.cur.executemany("""delete from tiles where zoom_level = ?
+                and tile_column = ? and tile_row = ?;""", rows)
+        if not self.grid_views:
+            for table in ('grids', 'grid_data'):
+                self.cur.executemany("""delete from %s where zoom_level = ?
+                    and tile_column = ? and tile_row = ?;""" % table, rows)
+        self.con.commit()
+
+    def add_manifest(self, path, size, mtime, digest):
+        self.manifest.append((path, size, mtime, digest))
+
+    def add_checkpoint(self, operation, position):
+        """ Record position, committed with the tiles added before it """
+        self.checkpoints.append((operation, position))
+
+    def flush(self):
+        start = time.time()
+        verb = 'replace' if self.upsert else 'insert'
+        if self.tiles or self.grids:
+            self.invalidate_stats()
+        if self.tiles and self.compacted:
+            rows = [(z, x, y, tile_id or hashlib.new(self.hash_function, data).hexdigest(), data)
+                for z, x, y, data, tile_id in self.tiles]
+            if self.orphans is not None:
+                self.collect_orphans(rows)
+            if self.compacted == 'tile_id':
+                self.cur.executemany("""insert or ignore into images (tile_id, tile_data)
+                    values (?, ?);""", [(r[3], sqlite3.Binary(r[4])) for r in rows if r[4] is not None])
+                self.update_map('tile_id', [r[:4] for r in rows])
+            else:
+                self.flush_image_ids(rows)
+        elif self.tiles:
+            self.cur.executemany("""%s into tiles (zoom_level,
+                tile_column, tile_row, tile_data) values
+                (?, ?, ?, ?);""" % verb, [(z, x, y, sqlite3.Binary(data))
+                for z, x, y, data, tile_id in self.tiles])
+        if self.grids and self.grid_views:
+            self.flush_grid_views()
+        elif self.grids:
+            if self.upsert:
+                self.cur.executemany("""delete from grid_data where zoom_level = ?
+                    and tile_column = ? and tile_row = ?;""", [g[:3] for g in self.grids])
+            self.cur.executemany("""%s into grids (zoom_level, tile_column, tile_row, grid) values (?, ?, ?, ?) """ % verb, self.grids)
+            self.cur.executemany("""insert into grid_data (zoom_level, tile_column, tile_row, key_name, key_json) values (?, ?, ?, ?, ?);""", self.grid_data)
+        if self.manifest:
+            self.cur.executemany("""replace into import_manifest (path, size,
+                mtime, hash) values (?, ?, ?, ?);""", self.manifest)
+        for operation, position in self.checkpoints:
+            write_checkpoint(self.cur, operation, position, replace=False)
+        written = time.time()
+        self.con.commit()
+        if self.progress:
+            self.progress.add_time('write', written - start)
+            self.progress.add_time('commit', time.time() - written)
+        self.tiles = []
+        self.grids = []
+        self.grid_data = []
+        self.manifest = []
+        self.checkpoints = []
+
+def map_key_index(cur, key):
+    """
+    Make sure map has an index on its image column, so each image is
+    looked up in map instead of map being scanned for it. Returns the name
+    of an index built for the occasion, or None if there was one already.
+    """
+    for row in cur.execute("PRAGMA index_list(map)").fetchall():
+        columns = [c[2] for c in cur.execute("PRAGMA index_info(%s)" % row[1]).fetchall()]
+        if columns and columns[0] == key:
+            return None
+    name = 'map_%s_gc' % key
+    logger.info("indexing map.%s" % key)
+    cur.execute("CREATE INDEX %s ON map (%s)" % (name, key))
+    return name
+
+def remove_orphan_images(cur, key, candidates, keep_index=False):
+    """
+    Delete the images among candidates (values of map's key column) that no
+    map row references anymore. Each candidate is looked up through an
+    index on map's key column, built for the run if the file has none and
+    dropped afterwards unless keep_index is set, as gc_mbtiles does.
+    Returns the number of deleted images.
+    """
+    index = map_key_index(cur, key)
+    if index:
+        cur.connection.commit()
+    cur.execute("""CREATE TEMP TABLE orphan_candidates (id PRIMARY KEY)""")
+    cur.executemany("""INSERT OR IGNORE INTO orphan_candidates (id) VALUES (?)""",
+        [(c,) for c in candidates])
+    cur.execute("""DELETE FROM images WHERE %(key)s IN (SELECT id FROM orphan_candidates)
+        AND NOT EXISTS (SELECT 1 FROM map WHERE map.%(key)s = images.%(key)s)""" % {'key': key})
+    removed = cur.rowcount
+    cur.execute("""DROP TABLE orphan_candidates""")
+    if index and not keep_index:
+        cur.execute("DROP INDEX %s" % index)
+    return removed
+
+def ensure_dir(path, created_dirs):
+    """
+    Create path unless it is already in created_dirs, so exporting only
+    touches the filesystem once per directory.
+    """
+    if path in created_dirs:
+        return
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    created_dirs.add(path)
+
+def write_file(job):
+    path, data = job
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+    return len(data)
+
+# where mbtiles_to_disk records how far it got, removed once it is done
+EXPORT_CHECKPOINT = '.mbutil-checkpoint.json'
+
+def read_export_checkpoint(directory_path):
+    """ {'position': ...} from an interrupted export to directory_path, or None """
+    try:
+        f = open(os.path.join(directory_path, EXPORT_CHECKPOINT))
+    except IOError:
+        return None
+    checkpoint = json.load(f)
+    f.close()
+    return checkpoint
+
+def write_export_checkpoint(directory_path, position):
+    """ Replace the checkpoint of directory_path, so it is never found half written """
+    path = os.path.join(directory_path, EXPORT_CHECKPOINT)
+    f = open(path + '.tmp', 'w')
+    json.dump({'position': position}, f)
+    f.close()
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(path + '.tmp', path)
+
+def resumable_tiles(con, after=None):
+    """
+    Yield (position, z, x, y, tile_data) for the tiles of con following
+    position after: by rowid from a tiles table, or by (z, x, y), which
+    the map index delivers in order, from the tiles view of a compacted
+    file.
+    """
+    if table_type(con, 'tiles') == 'table':
+        where, params = ('rowid > ?', (after,)) if after is not None else ('1', ())
+        for row in con.execute("""select rowid, zoom_level, tile_column, tile_row, tile_data
+                from tiles where %s order by rowid;""" % where, params):
+            yield row
+        return
+    where, params = '1', ()
+    if after is not None:
+        z, x, y = after
+        where = """zoom_level > ? or (zoom_level = ? and tile_column > ?)
+            or (zoom_level = ? and tile_column = ? and tile_row > ?)"""
+        params = (z, z, x, z, x, y)
+    for z, x, y, tile_data in con.execute("""select zoom_level, tile_column, tile_row, tile_data
+            from tiles where %s order by zoom_level, tile_column, tile_row;""" % where, params):
+        yield ([z, x, y], z, x, y, tile_data)
+
+class DuplicateLinker(object):
+    """
+    Export worker for --link-duplicates. Jobs are ('write', path, data) for
+    the first tile of an image and ('link', path, target) for every other
+    tile using it, which becomes a hardlink (or symlink) to target.
+
+    Images are written under a temporary name and renamed into place, so
+    a hardlink whose target does not exist yet only has to wait for the
+    rename. If the write fails, the links waiting for it fail as well
+    instead of waiting forever. When a file reaches the filesystem's
+    hardlink limit, the next tile gets a full copy that further links are
+    made to.
+    """
+    def __init__(self, link_type='hard'):
+        self.link_type = link_type
+        self.written = threading.Condition()
+        self.replacements = {}
+        self.failed = set()
+
+    def __call__(self, job):
+        kind, path, value = job
+        if kind == 'write':
+            try:
+                size = write_file((path + '.tmp', value))
+                os.rename(path + '.tmp', path)
+            except Exception:
+                self.written.acquire()
+                self.failed.add(path)
+                self.written.notify_all()
+                self.written.release()
+                raise
+            self.written.acquire()
+            self.written.notify_all()
+            self.written.release()
+            return size
+        if self.link_type == 'symlink':
+            os.symlink(os.path.relpath(value, os.path.dirname(path)), path)
+            return 0
+        while True:
+            target = self.replacements.get(value, value)
+            try:
+                os.link(target, path)
+                return 0
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    self.written.acquire()
+                    try:
+                        if value in self.failed:
+                            raise OSError(errno.ENOENT, "%s was not written, so it "
+                                "cannot be linked to" % value, path)
+                        if not os.path.exists(target):
+                            self.written.wait(1)
+                    finally:
+                        self.written.release()
+                elif e.errno == errno.EMLINK:
+                    self.written.acquire()
+                    try:
+                        if self.replacements.get(value, value) == target:
+                            f = open(target, 'rb')
+                            size = write_file((path, f.read()))
+                            f.close()
+                            self.replacements[value] = path
+                            return size
+                    finally:
+                        self.written.release()
+                else:
+                    raise
+
+def duplicate_tile_jobs(con, base_path, image_format, scheme=None, coverage=None):
+    """
+    Yield DuplicateLinker jobs for the tiles of a compacted file. The map
+    is read ordered by image, so the tiles of one image come together and
+    only the current image's first path has to be remembered.
+    """
+    key = image_key(con)
+    rows = con.execute("""SELECT zoom_level, tile_column, tile_row, %(key)s FROM map
+        WHERE %(key)s IS NOT NULL ORDER BY %(key)s""" % {'key': key})
+    current = None
+    target = None
+    for z, x, y, image in rows:
+        if coverage and not coverage.contains(z, x, y):
+            continue
+        path = os.path.join(base_path, tile_path(z, x, y, image_format, scheme))
+        if image != current:
+            current = image
+            target = path
+            data = con.execute("SELECT tile_data FROM images WHERE %s = ?" % key, (image,)).fetchone()
+            yield ('write', path, data[0] if data else b'')
+        else:
+            yield ('link', path, target)
+
+def tile_dir_bounds(z, names, scheme=None):
+    """
+    The ((min x, max x), (min y, max y)) of the tiles, in TMS rows, that
+    can be found under the directory reached through names below the
+    directory of zoom z, a range being None while the path says nothing
+    about it. Returns None if names are not directories of scheme.
+    """
+    try:
+        if scheme == 'wms':
+            # x and y are split into groups of three digits, the last
+            # group of y being the file name
+            digits = [int(name) for name in names]
+            xs, ys = digits[:3], digits[3:]
+            x_range = y_range = None
+            if xs:
+                scale = 1000 ** (3 - len(xs))
+                low = sum([d * 1000 ** (2 - i) for i, d in enumerate(xs)])
+                x_range = (low, low + scale - 1)
+            if ys:
+                low = ys[0] * 1000000 + (ys[1] * 1000 if len(ys) > 1 else 0)
+                y_range = (low, low + 1000 ** (3 - len(ys)) - 1)
+            return (x_range, y_range)
+        if not names:
+            return (None, None)
+        if scheme == 'ags':
+            y = flip_y(z, int(names[0].replace("R", ""), 16))
+            return (None, (y, y))
+        if scheme == 'zyx':
+            y = flip_y(z, int(names[0]))
+            return (None, (y, y))
+        x = int(names[0])
+        return ((x, x), None)
+    except ValueError:
+        return None
+
+def tile_dir_wanted(z, bounds, tile_range=None, coverage=None):
+    """ False if no tile in bounds (see tile_dir_bounds) is in tile_range or coverage """
+    x_range, y_range = bounds
+    if tile_range:
+        r = tile_range.get(z)
+        if not r:
+            return False
+        if x_range and (x_range[1] < r['x'][0] or x_range[0] > r['x'][1]):
+            return False
+        if y_range and (y_range[1] < r['y'][0] or y_range[0] > r['y'][1]):
+            return False
+    if coverage:
+        if x_range and x_range[0] == x_range[1] and not coverage.covers_column(z, x_range[0]):
+            return False
+        if y_range and y_range[0] == y_range[1] and not coverage.covers_row(z, y_range[0]):
+            return False
+    return True
+
+def walk_tile_dir(path, z, names, depth, scheme=None, tile_range=None, coverage=None,
+        skip_dirs=None):
+    """
+    Yield (names, entry) for the files in the directories depth levels
+    below the tile directory, names being the directory names leading to
+    path (the zoom directory first), followed by (names, None) once a
+    directory of files has been listed. Directories whose tiles
+    tile_dir_wanted rules out are skipped before they are listed, as are
+    the '/'-joined names in skip_dirs. Directories are read as they are
+    walked, so a tree is never listed whole.
+    """
+    for entry in scan_dir(path):
+        if len(names) == depth:
+            yield names, entry
+            continue
+        if not entry.is_dir():
+            continue
+        child = names + [entry.name]
+        bounds = tile_dir_bounds(z, child[1:], scheme)
+        if bounds is None:
+            logger.debug("Skipping dir %s" % entry.path)
+            continue
+        if not tile_dir_wanted(z, bounds, tile_range, coverage):
+            continue
+        if skip_dirs and len(child) == depth and '/'.join(child) in skip_dirs:
+            continue
+        for item in walk_tile_dir(entry.path, z, child, depth, scheme, tile_range, coverage,
+                skip_dirs):
+            yield item
+    if len(names) == depth:
+        yield names, None
+
+def disk_tiles(directory_path, image_format, tile_range=None, skip_dirs=None,
+        mark_dirs=False, **kwargs):
+    """
+    Walk a tile directory of any scheme and yield (z, x, y, path, ext) for
+    every tile or grid file that should be imported. Zoom levels outside
+    tile_range, and directories whose tiles lie outside tile_range or a
+    TileCoverage passed as coverage, are pruned before they are listed.
+    Files that are not tiles are skipped.
+
+    The directories holding tile files ('z/x' for most schemes) named in
+    skip_dirs are not read. With mark_dirs, ('checkpoint', 'z/x') follows
+    the tiles of each of them.
+    """
+    scheme = kwargs.get("scheme")
+    coverage = kwargs.get('coverage')
+    for zoom_entry in scan_dir(directory_path):
+        if not zoom_entry.is_dir():
+            continue
+        zoomDir = zoom_entry.name
+        if scheme == 'ags':
+            if not "L" in zoomDir:
+                logger.warning("You appear to be using an ags scheme on an non-arcgis Server cache.")
+        elif "L" in zoomDir:
+            logger.warning("You appear to be using a %s scheme on an arcgis Server cache. Try using --scheme=ags instead" % scheme)
+        try:
+            z = int(zoomDir.replace("L", "") if scheme == 'ags' else zoomDir)
+        except ValueError:
+            logger.info("Skipping dir " + zoomDir)
+            continue
+
+        if tile_range and not z in tile_range:
+            logger.debug('Skipping zoom level %i' % (z,))
+            continue
+
+        depth = 6 if scheme == 'wms' else 2
+        for names, entry in walk_tile_dir(zoom_entry.path, z, [zoomDir], depth, scheme,
+                tile_range, coverage, skip_dirs):
+            if entry is None:
+                if mark_dirs:
+                    yield ('checkpoint', '/'.join(names))
+                continue
+            tile = parse_tile_path('/'.join(names + [entry.name]), scheme)
+            if tile is None:
+                logger.debug("Skipping file %s" % entry.path)
+                continue
+            z, x, y, ext = tile
+            if ext != image_format and ext != 'grid.json':
+                continue
+            if tile_range:
+                r = tile_range.get(z)
+                if not r or x < r['x'][0] or x > r['x'][1] or y < r['y'][0] or y > r['y'][1]:
+                    logger.debug(' Skipping tile Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
+                    continue
+            if coverage and not coverage.contains(z, x, y):
+                continue
+            yield (z, x, y, entry.path, ext)
+
+def tile_path(z, x, y, ext, scheme=None):
+    """ Relative path of tile z/x/y (TMS row) in a tile directory of scheme """
+    if scheme == 'xyz':
+        y = flip_y(z, y)
+    elif scheme == 'wms':
+        return os.path.join("%02d" % (z),
+            "%03d" % (x // 1000000), "%03d" % ((x // 1000) % 1000), "%03d" % (x % 1000),
+            "%03d" % (y // 1000000), "%03d" % ((y // 1000) % 1000),
+            "%03d.%s" % (y % 1000, ext))
+    return os.path.join(str(z), str(x), '%s.%s' % (y, ext))
+
+def parse_tile_path(path, scheme=None):
+    """
+    The reverse of tile_path: returns (z, x, y, ext) for a relative path
+    in a tile directory of scheme, y being the TMS row, or None if path is
+    not a tile.
+    """
+    parts = path.replace('\\', '/').split('/')
+    if parts[0] == '.':
+        parts = parts[1:]
+    if len(parts) != (7 if scheme == 'wms' else 3) or '.' not in parts[-1]:
+        return None
+    file_name, ext = parts[-1].split('.', 1)
+    try:
+        if scheme == 'ags':
+            z = int(parts[0].replace("L", ""))
+            y = flip_y(z, int(parts[1].replace("R", ""), 16))
+            x = int(file_name.replace("C", ""), 16)
+        elif scheme == 'zyx':
+            z = int(parts[0])
+            y = flip_y(z, int(parts[1]))
+            x = int(file_name)
+        elif scheme == 'wms':
+            z = int(parts[0])
+            x = int(parts[1]) * 1000000 + int(parts[2]) * 1000 + int(parts[3])
+            y = int(parts[4]) * 1000000 + int(parts[5]) * 1000 + int(file_name)
+        else:
+            z, x, y = int(parts[0]), int(parts[1]), int(file_name)
+            if scheme == 'xyz':
+                y = flip_y(z, y)
+    except ValueError:
+        return None
+    return (z, x, y, ext)
+
+def archive_tiles(archive_path, image_format, tile_range=None, metadata_callback=None, **kwargs):
+    """
+    Like disk_tiles for a tar or zip archive: yields (z, x, y, ext, data)
+    for every tile or grid member, read in archive order. metadata.json is
+    handed to metadata_callback as it is met, which returns the image
+    format to import from then on (mbtiles_to_disk writes it first).
+    """
+    coverage = kwargs.get('coverage')
+    for name, data in archive_members(archive_path):
+        if os.path.basename(name) == 'metadata.json':
+            if metadata_callback:
+                image_format = metadata_callback(json.loads(data.decode('utf-8'))) or image_format
+            continue
+        tile = parse_tile_path(name, kwargs.get('scheme'))
+        if tile is None:
+            continue
+        z, x, y, ext = tile
+        if ext != image_format and ext != 'grid.json':
+            continue
+        if tile_range:
+            r = tile_range.get(z)
+            if not r or x < r['x'][0] or x > r['x'][1] or y < r['y'][0] or y > r['y'][1]:
+                continue
+        if coverage and not coverage.contains(z, x, y):
+            continue
+        yield (z, x, y, ext, data)
+
+def read_archive_tile(job, progress=None):
+    z, x, y, ext, file_content = job
+    return parse_disk_tile(z, x, y, ext, file_content, progress)
+
+def manifest_jobs(cur, directory_path, jobs):
+    """
+    Attach each file's relative path and its import_manifest entry, if any,
+    to the jobs coming from disk_tiles.
+    """
+    for z, x, y, path, ext in jobs:
+        relpath = os.path.relpath(path, directory_path)
+        known = cur.execute("""select size, mtime, hash from import_manifest
+            where path = ?""", (relpath,)).fetchone()
+        yield (z, x, y, path, ext, relpath, known)
+
+def read_disk_tile(job, progress=None):
+    """
+    Read one file found by disk_tiles and turn it into the rows to insert.
+    Returns ('tile', (z, x, y, data)) or ('grid', (z, x, y, grid, grid_data)).
+    """
+    z, x, y, path, ext = job
+    start = time.time()
+    f = open(path, 'rb')
+    file_content = f.read()
+    f.close()
+    if progress:
+        progress.add_time('read', time.time() - start)
+    return parse_disk_tile(z, x, y, ext, file_content, progress)
+
+def read_changed_disk_tile(job, use_hash=False, progress=None):
+    """
+    Like read_disk_tile, for incremental imports. job carries the file's
+    import_manifest entry; files whose size and mtime (or md5 when
+    use_hash is set) match it come back as ('skip', manifest_row) without
+    being parsed. Otherwise returns (kind, row, manifest_row).
+    """
+    z, x, y, path, ext, relpath, known = job
+    start = time.time()
+    st = os.stat(path)
+    if known and not use_hash and known[0] == st.st_size and known[1] == st.st_mtime:
+        if progress:
+            progress.add_time('read', time.time() - start)
+        return ('skip', None)
+    f = open(path, 'rb')
+    file_content = f.read()
+    f.close()
+    digest = None
+    if progress:
+        progress.add_time('read', time.time() - start)
+    if use_hash:
+        start = time.time()
+        digest = hashlib.md5(file_content).hexdigest()
+        if progress:
+            progress.add_time('hash', time.time() - start)
+        if known and known[2] == digest:
+            if known[0] == st.st_size and known[1] == st.st_mtime:
+                return ('skip', None)
+            return ('skip', (relpath, st.st_size, st.st_mtime, digest))
+    kind, row = parse_disk_tile(z, x, y, ext, file_content, progress)
+    return (kind, row, (relpath, st.st_size, st.st_mtime, digest))
+
+def parse_disk_tile(z, x, y, ext, file_content, progress=None):
+    if ext != 'grid.json':
+        logger.debug(' Read tile from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
+        return ('tile', (z, x, y, file_content))
+
+    logger.debug(' Read grid from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
+    start = time.time()
+    # Remove potential callback with regex
+    file_content = file_content.decode('utf-8')
+    has_callback = re.match(r'[\w\s=+-/]+\(({(.|\n)*})\);?', file_content)
+    if has_callback:
+        file_content = has_callback.group(1)
+    utfgrid = json.loads(file_content)
+
+    data = utfgrid.pop('data')
+    grid_keys = [k for k in utfgrid['keys'] if k != ""]
+    grid_data = [(key_name, json.dumps(data[key_name])) for key_name in grid_keys]
+    encoded = json.dumps(utfgrid).encode()
+    parsed = time.time()
+    compressed = zlib.compress(encoded)
+    if progress:
+        progress.add_time('grid', parsed - start)
+        progress.add_time('compress', time.time() - parsed)
+    return ('grid', (z, x, y, compressed, grid_data))
 
 def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
     logger.info("Importing disk to MBTiles")
     logger.debug("%s --> %s" % (directory_path, mbtiles_file))
+    incremental = kwargs.get('incremental', False)
+    archive = os.path.isfile(directory_path) and archive_kind(directory_path)
+    # directories finished by an interrupted import are skipped on --resume;
+    # incremental imports skip unchanged files anyway
+    resume = kwargs.get('resume', False) and not incremental
+    if resume and archive:
+        logger.error("Imports from archives cannot be resumed")
+        sys.exit(1)
     con = mbtiles_connect(mbtiles_file)
     cur = con.cursor()
     optimize_connection(cur)
-    mbtiles_setup(cur)
+    done_dirs = None
+    if incremental:
+        mbtiles_upgrade(cur)
+    elif resume:
+        done_dirs = read_checkpoints(cur, 'import')
+        if done_dirs is None:
+            logger.error("%s has no import checkpoint to resume from" % mbtiles_file)
+            sys.exit(1)
+        logger.info("resuming, %d tile directories were imported already" % len(done_dirs))
+    else:
+        mbtiles_setup(cur)
+        checkpoint_setup(cur)
     #~ image_format = 'png'
-    image_format = kwargs.get('format', 'png')
-    try:
-        metadata = json.load(open(os.path.join(directory_path, 'metadata.json'), 'r'))
-        image_format = kwargs.get('format')
+    image_format = kwargs.get('format') or 'png'
+
+    def restore_metadata(metadata):
         for name, value in metadata.items():
-            cur.execute('insert into metadata (name, value) values (?, ?)',
+            cur.execute('replace into metadata (name, value) values (?, ?)',
                 (name, value))
         logger.info('metadata from metadata.json restored')
-    except IOError:
-        logger.warning('metadata.json not found')
+        return kwargs.get('format') or metadata.get('format', image_format)
 
-    count = 0
-    start_time = time.time()
-    msg = ""
+    if not archive:
+        try:
+            image_format = restore_metadata(json.load(open(os.path.join(directory_path, 'metadata.json'), 'r')))
+        except IOError:
+            logger.warning('metadata.json not found')
 
     tile_range = None
     if 'bbox' in kwargs and kwargs['bbox'] is not None:
@@ -120,178 +1245,237 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
             logger.info("z:%i x:%i-%i y:%i-%i" % (z,
                 tile_range[z]['x'][0], tile_range[z]['x'][1],
                 tile_range[z]['y'][0], tile_range[z]['y'][1]))
+    con.commit()
 
-    for zoomDir in getDirs(directory_path):
-        if kwargs.get("scheme") == 'ags':
-            if not "L" in zoomDir:
-                logger.warning("You appear to be using an ags scheme on an non-arcgis Server cache.")
-            z = int(zoomDir.replace("L", ""))
+    workers = kwargs.get('workers') or 1
+    progress = make_progress('import', kwargs)
+    # tiles of a directory whose checkpoint was not committed may have been
+    # written already, so a resumed import replaces them
+    writer = TileBatchWriter(con, kwargs.get('batch_size') or 1000,
+        upsert=incremental or resume, track_orphans=True, progress=progress)
+    use_manifest = incremental and not archive
+    use_checkpoints = not incremental and not archive
+    if archive:
+        # archive members carry no mtime worth comparing, so an incremental
+        # import from an archive upserts every tile it holds
+        jobs = archive_tiles(directory_path, image_format, tile_range, restore_metadata, **kwargs)
+        read = lambda job: read_archive_tile(job, progress)
+    elif use_manifest:
+        use_hash = kwargs.get('manifest') == 'hash'
+        read = lambda job: read_changed_disk_tile(job, use_hash, progress)
+        jobs = manifest_jobs(cur, directory_path,
+            disk_tiles(directory_path, image_format, tile_range, **kwargs))
+    else:
+        jobs = disk_tiles(directory_path, image_format, tile_range, skip_dirs=set(done_dirs or []),
+            mark_dirs=True, **kwargs)
+        read = lambda job: job if job[0] == 'checkpoint' else read_disk_tile(job, progress)
+    # listing directories (or reading archive members) is the scan stage
+    jobs = progress.timed_iter('scan', jobs)
+    if use_checkpoints:
+        # a directory's checkpoint must not overtake its tiles
+        results = ordered_imap(read, jobs, workers)
+    else:
+        results = parallel_imap(read, jobs, workers)
+    pipeline = make_pipeline(kwargs, image_format)
+    if pipeline:
+        logger.info('transforming tiles with %s' % ', '.join([str(s) for s in pipeline.specs]))
+        results = (result for chunk in process_chunks(pipeline.transform_result,
+            chunked(results, 100), workers, progress) for result in chunk)
+    for result in results:
+        kind, row = result[:2]
+        if use_manifest:
+            manifest_row = result[-1]
+            if manifest_row:
+                writer.add_manifest(*manifest_row)
+        if kind == 'checkpoint':
+            writer.add_checkpoint('import', row)
+        elif kind == 'skip':
+            progress.update(skipped=1)
+        elif kind == 'tile':
+            writer.add_tile(*row)
+            progress.update(1, len(row[3]))
         else:
-            if "L" in zoomDir:
-                logger.warning("You appear to be using a %s scheme on an arcgis Server cache. Try using --scheme=ags instead" % kwargs.get("scheme"))
-            try:
-                z = int(zoomDir)
-            except:
-                logger.info("Skipping dir " + zoomDir)
-                continue
+            writer.add_grid(*row)
+            progress.update(0, len(row[3]), grids=1)
+    writer.flush()
+    if writer.orphans:
+        # images of compacted files that changed tiles pointed at
+        removed = remove_orphan_images(cur, writer.compacted, writer.orphans,
+            kwargs.get('keep_index'))
+        con.commit()
+        logger.info('%d orphaned images removed' % removed)
+    if use_checkpoints:
+        clear_checkpoints(cur, 'import')
+        con.commit()
+    if kwargs.get('tile_order'):
+        reorder_tiles(cur, kwargs['tile_order'], progress)
 
-        if tile_range and not z in tile_range:
-            logger.debug('Skipping zoom level %i' % (z,))
-            continue
+    optimize_database(con, skip_vacuum=incremental, progress=progress)
+    event = progress.done()
+    if incremental:
+        logger.info('%d tiles inserted, %d unchanged files skipped' % (event['count'], event.get('skipped', 0)))
+    logger.info('%d tiles inserted (%.1f tiles/sec)' % (event['count'], event['rate']))
 
-        for rowDir in getDirs(os.path.join(directory_path, zoomDir)):
-            if kwargs.get("scheme") == 'ags':
-                y = flip_y(z, int(rowDir.replace("R", ""), 16))
-            elif kwargs.get("scheme") == 'zyx':
-                y = flip_y(z, int(rowDir))
-            else:
-                x = int(rowDir)
-            for current_file in os.listdir(os.path.join(directory_path, zoomDir, rowDir)):
-                file_name, ext = current_file.split('.',1)
-                f = open(os.path.join(directory_path, zoomDir, rowDir, current_file), 'rb')
-                file_content = f.read()
-                f.close()
-                if kwargs.get('scheme') == 'xyz':
-                    y = flip_y(int(z), int(file_name))
-                elif kwargs.get("scheme") == 'ags':
-                    x = int(file_name.replace("C", ""), 16)
-                elif kwargs.get("scheme") == 'zyx':
-                    x = int(file_name)
-                else:
-                    y = int(file_name)
-
-                if tile_range:
-                    r = tile_range[z]
-                    if x < r['x'][0] or x > r['x'][1] or y < r['y'][0] or y > r['y'][1]:
-                        logger.debug(' Skipping tile Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
-                        continue
-
-                if (ext == image_format):
-                    logger.debug(' Read tile from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
-                    cur.execute("""insert into tiles (zoom_level,
-                        tile_column, tile_row, tile_data) values
-                        (?, ?, ?, ?);""",
-                        (z, x, y, sqlite3.Binary(file_content)))
-                    count = count + 1
-                    if (count % 100) == 0:
-                        for c in msg: sys.stdout.write(chr(8))
-                        msg = "%s tiles inserted (%d tiles/sec)" % (count, count / (time.time() - start_time))
-                        sys.stdout.write(msg)
-                elif (ext == 'grid.json'):
-                    logger.debug(' Read grid from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
-                    # Remove potential callback with regex
-                    file_content = file_content.decode('utf-8')
-                    has_callback = re.match(r'[\w\s=+-/]+\(({(.|\n)*})\);?', file_content)
-                    if has_callback:
-                        file_content = has_callback.group(1)
-                    utfgrid = json.loads(file_content)
-
-                    data = utfgrid.pop('data')
-                    compressed = zlib.compress(json.dumps(utfgrid).encode())
-                    cur.execute("""insert into grids (zoom_level, tile_column, tile_row, grid) values (?, ?, ?, ?) """, (z, x, y, sqlite3.Binary(compressed)))
-                    grid_keys = [k for k in utfgrid['keys'] if k != ""]
-                    for key_name in grid_keys:
-                        key_json = data[key_name]
-                        cur.execute("""insert into grid_data (zoom_level, tile_column, tile_row, key_name, key_json) values (?, ?, ?, ?, ?);""", (z, x, y, key_name, json.dumps(key_json)))
-
-    logger.debug('tiles (and grids) inserted.')
-    optimize_database(con)
+def iter_grids(con, where="1", params=()):
+    """
+    Yield (z, x, y, grid, data) for every UTFGrid, where data is the grid's
+    key dict rebuilt from grid_data. Both tables are read once, ordered by
+    tile, and merge-joined instead of querying grid_data for every grid.
+    """
+    grids = con.execute("""select zoom_level, tile_column, tile_row, grid
+        from grids where %s order by zoom_level, tile_column, tile_row;""" % where, params)
+    keys = con.execute("""select zoom_level, tile_column, tile_row, key_name,
+        key_json from grid_data where %s order by zoom_level, tile_column, tile_row;""" % where, params)
+    return merge_grid_data(grids, keys)
+
+def merge_grid_data(grids, keys):
+    key = keys.fetchone()
+    for z, x, y, grid in grids:
+        tile = (z, x, y)
+        while key and tuple(key[:3]) < tile:
+            key = keys.fetchone()
+        data = {}
+        while key and tuple(key[:3]) == tile:
+            data[key[3]] = json.loads(key[4])
+            key = keys.fetchone()
+        yield z, x, y, grid, data
 
 def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
+    """
+    Export mbtiles_file to directory_path, or into a tar or zip archive,
+    streamed in tile order, if directory_path ends with .tar, .tar.gz,
+    .tgz, .tar.bz2, .tbz2 or .zip.
+
+    Exports to a directory keep a checkpoint in it every batch_size
+    tiles; with resume, an interrupted export continues from there.
+    """
     logger.debug("Exporting MBTiles to disk")
     logger.debug("%s --> %s" % (mbtiles_file, directory_path))
     con = mbtiles_connect(mbtiles_file)
-    os.mkdir("%s" % directory_path)
-    metadata = dict(con.execute('select name, value from metadata;').fetchall())
-    json.dump(metadata, open(os.path.join(directory_path, 'metadata.json'), 'w'), indent=4)
-    count = con.execute('select count(zoom_level) from tiles;').fetchone()[0]
-    done = 0
-    msg = ''
+    resume = kwargs.get('resume', False)
+    link_duplicates = kwargs.get('link_duplicates')
+    if link_duplicates and (archive_kind(directory_path) or not image_key(con)):
+        logger.warning('--link-duplicates needs a compacted file and a directory to export to, writing every tile')
+        link_duplicates = None
+    # --link-duplicates exports go image by image, which has no resumable order
+    checkpointed = not archive_kind(directory_path) and not link_duplicates
+    if resume and not checkpointed:
+        logger.error("Only exports to a directory without --link-duplicates can be resumed")
+        sys.exit(1)
+    archive = None
+    position = None
+    if archive_kind(directory_path):
+        archive = ArchiveWriter(directory_path)
+    elif resume:
+        checkpoint = read_export_checkpoint(directory_path)
+        if checkpoint is None:
+            logger.error("%s has no export checkpoint to resume from" % directory_path)
+            sys.exit(1)
+        position = checkpoint['position']
+        logger.info("resuming after tile %s" % (position,))
+    else:
+        os.mkdir("%s" % directory_path)
+        if checkpointed:
+            write_export_checkpoint(directory_path, None)
     base_path = directory_path
-    if not os.path.isdir(base_path):
-        os.makedirs(base_path)
+    created_dirs = set()
+
+    def write_output(relpath, data):
+        if archive:
+            return archive.add(relpath, data)
+        path = os.path.join(base_path, relpath)
+        ensure_dir(os.path.dirname(path), created_dirs)
+        return write_file((path, data))
+
+    metadata = dict(con.execute('select name, value from metadata;').fetchall())
+    # statistics describe this file, not one the tiles are imported into
+    metadata.pop(STATS_KEY, None)
+    write_output('metadata.json', json.dumps(metadata, indent=4).encode('utf-8'))
+    count = count_tiles(con)
+    progress = make_progress('export', kwargs, count)
 
     # if interactivity
     formatter = metadata.get('formatter')
     if formatter:
-        layer_json = os.path.join(base_path,'layer.json')
         formatter_json = {"formatter":formatter}
-        open(layer_json,'w').write(json.dumps(formatter_json))
-
-    tiles = con.execute('select zoom_level, tile_column, tile_row, tile_data from tiles;')
-    t = tiles.fetchone()
-    while t:
-        z = t[0]
-        x = t[1]
-        y = t[2]
-        if kwargs.get('scheme') == 'xyz':
-            y = flip_y(z,y)
-            print('flipping')
-            tile_dir = os.path.join(base_path, str(z), str(x))
-        elif kwargs.get('scheme') == 'wms':
-            tile_dir = os.path.join(base_path,
-                "%02d" % (z),
-                "%03d" % (int(x) / 1000000),
-                "%03d" % ((int(x) / 1000) % 1000),
-                "%03d" % (int(x) % 1000),
-                "%03d" % (int(y) / 1000000),
-                "%03d" % ((int(y) / 1000) % 1000))
-        else:
-            tile_dir = os.path.join(base_path, str(z), str(x))
-        if not os.path.isdir(tile_dir):
-            os.makedirs(tile_dir)
-        if kwargs.get('scheme') == 'wms':
-            tile = os.path.join(tile_dir,'%03d.%s' % (int(y) % 1000, kwargs.get('format', 'png')))
-        else:
-            tile = os.path.join(tile_dir,'%s.%s' % (y, kwargs.get('format', 'png')))
-        f = open(tile, 'wb')
-        f.write(t[3])
-        f.close()
-        done = done + 1
-        for c in msg: sys.stdout.write(chr(8))
-        logger.info('%s / %s tiles exported' % (done, count))
-        t = tiles.fetchone()
+        write_output('layer.json', json.dumps(formatter_json).encode('utf-8'))
+
+    workers = kwargs.get('workers') or 1
+    coverage = kwargs.get('coverage')
+    scheme = kwargs.get('scheme')
+    image_format = kwargs.get('format') or 'png'
+    if archive:
+        tiles = ((None,) + tuple(row) for row in con.execute("""select zoom_level, tile_column,
+            tile_row, tile_data from tiles order by zoom_level, tile_column, tile_row;"""))
+    else:
+        tiles = resumable_tiles(con, position)
+
+    # the positions of the tiles being written, oldest first
+    positions = deque()
+    def tile_jobs():
+        for position, z, x, y, tile_data in progress.timed_iter('read', tiles):
+            if coverage and not coverage.contains(z, x, y):
+                continue
+            if checkpointed:
+                positions.append(position)
+            yield (tile_path(z, x, y, image_format, scheme), tile_data)
+
+    if archive:
+        # a single stream: written in order by this thread
+        add = progress.timed('write', archive.add)
+        written = (add(relpath, tile_data) for relpath, tile_data in tile_jobs())
+    elif link_duplicates:
+        def link_jobs():
+            for job in duplicate_tile_jobs(con, base_path, image_format, scheme, coverage):
+                ensure_dir(os.path.dirname(job[1]), created_dirs)
+                yield job
+        written = parallel_imap(progress.timed('write', DuplicateLinker(link_duplicates)),
+            link_jobs(), workers)
+    else:
+        def file_jobs():
+            for relpath, tile_data in tile_jobs():
+                path = os.path.join(base_path, relpath)
+                ensure_dir(os.path.dirname(path), created_dirs)
+                yield (path, tile_data)
+        # in order, so a checkpoint never passes a tile still being written
+        written = ordered_imap(progress.timed('write', write_file), file_jobs(), workers)
+    batch_size = kwargs.get('batch_size') or 1000
+    for size in written:
+        progress.update(1, size)
+        if checkpointed:
+            position = positions.popleft()
+            if progress.count % batch_size == 0:
+                write_export_checkpoint(directory_path, position)
+    if checkpointed:
+        # only grids are left to write again if this is interrupted
+        write_export_checkpoint(directory_path, position)
 
     # grids
     callback = kwargs.get('callback')
-    done = 0
-    msg = ''
     try:
-        count = con.execute('select count(zoom_level) from grids;').fetchone()[0]
-        grids = con.execute('select zoom_level, tile_column, tile_row, grid from grids;')
-        g = grids.fetchone()
+        grids = iter_grids(con)
     except sqlite3.OperationalError:
-        g = None # no grids table
-    while g:
-        zoom_level = g[0] # z
-        tile_column = g[1] # x
-        y = g[2] # y
-        grid_data_cursor = con.execute('''select key_name, key_json FROM
-            grid_data WHERE
-            zoom_level = %(zoom_level)d and
-            tile_column = %(tile_column)d and
-            tile_row = %(y)d;''' % locals() )
-        if kwargs.get('scheme') == 'xyz':
-            y = flip_y(zoom_level,y)
-        grid_dir = os.path.join(base_path, str(zoom_level), str(tile_column))
-        if not os.path.isdir(grid_dir):
-            os.makedirs(grid_dir)
-        grid = os.path.join(grid_dir,'%s.grid.json' % (y))
-        f = open(grid, 'w')
-        grid_json = json.loads(zlib.decompress(g[3]).decode('utf-8'))
-        # join up with the grid 'data' which is in pieces when stored in mbtiles file
-        grid_data = grid_data_cursor.fetchone()
-        data = {}
-        while grid_data:
-            data[grid_data[0]] = json.loads(grid_data[1])
-            grid_data = grid_data_cursor.fetchone()
+        grids = [] # no grids table
+    write_grid = progress.timed('write', write_output)
+    for zoom_level, tile_column, y, grid_blob, data in progress.timed_iter('read', grids):
+        if coverage and not coverage.contains(zoom_level, tile_column, y):
+            continue
+        start = time.time()
+        grid_json = json.loads(zlib.decompress(grid_blob).decode('utf-8'))
         grid_json['data'] = data
         if callback in (None, "", "false", "null"):
-            f.write(json.dumps(grid_json))
+            grid = json.dumps(grid_json)
         else:
-            f.write('%s(%s);' % (callback, json.dumps(grid_json)))
-        f.close()
-        done = done + 1
-        for c in msg: sys.stdout.write(chr(8))
-        logger.info('%s / %s grids exported' % (done, count))
-        g = grids.fetchone()
+            grid = '%s(%s);' % (callback, json.dumps(grid_json))
+        grid = grid.encode('utf-8')
+        progress.add_time('grid', time.time() - start)
+        write_grid(tile_path(zoom_level, tile_column, y, 'grid.json',
+            'xyz' if scheme == 'xyz' else None), grid)
+        progress.update(0, len(grid), grids=1)
+    if archive:
+        archive.close()
+    if checkpointed:
+        os.remove(os.path.join(directory_path, EXPORT_CHECKPOINT))
+    event = progress.done()
+    logger.info('%d / %d tiles and %d grids exported, %d bytes written (%.1f tiles/sec)' % (
+        event['count'], count, event.get('grids', 0), event['bytes'], event['rate']))
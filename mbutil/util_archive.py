@@ -0,0 +1,86 @@
+import os, time, tarfile, zipfile, logging
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+# (suffix, kind, tarfile compression) in the order they are matched
+ARCHIVE_SUFFIXES = [
+    ('.tar', 'tar', ''),
+    ('.tar.gz', 'tar', 'gz'),
+    ('.tgz', 'tar', 'gz'),
+    ('.tar.bz2', 'tar', 'bz2'),
+    ('.tbz2', 'tar', 'bz2'),
+    ('.zip', 'zip', None),
+]
+
+def archive_kind(path):
+    """ Returns ('tar', compression) or ('zip', None) from path's suffix, or None """
+    lower = path.lower()
+    for suffix, kind, compression in ARCHIVE_SUFFIXES:
+        if lower.endswith(suffix):
+            return (kind, compression)
+    return None
+
+class ArchiveWriter(object):
+    """
+    Write files into a new tar or zip archive, chosen by the suffix of
+    path. Tar archives are written sequentially and forget each member
+    once it is written, so memory stays bounded whatever the number of
+    files; zip keeps one small central directory entry per file. Entries
+    are stored without compression in zip files since tiles are compressed
+    images already.
+    """
+    def __init__(self, path):
+        self.kind, compression = archive_kind(path)
+        self.mtime = time.time()
+        if self.kind == 'tar':
+            self.archive = tarfile.open(path, 'w:%s' % compression)
+        else:
+            self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, True)
+
+    def add(self, name, data):
+        if self.kind == 'tar':
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = self.mtime
+            info.mode = 420 # 0644
+            self.archive.addfile(info, BytesIO(data))
+            # TarFile keeps every TarInfo it wrote, for getmembers()
+            self.archive.members = []
+        else:
+            info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+            info.external_attr = 420 << 16
+            self.archive.writestr(info, data)
+        return len(data)
+
+    def close(self):
+        self.archive.close()
+
+def archive_members(path):
+    """
+    Yield (name, data) for every regular file of a tar or zip archive, in
+    archive order. Tar archives are read one member at a time, without
+    extracting anything or keeping the members already read.
+    """
+    kind, compression = archive_kind(path)
+    if kind == 'tar':
+        archive = tarfile.open(path, 'r:*')
+        try:
+            member = archive.next()
+            while member is not None:
+                if member.isfile():
+                    f = archive.extractfile(member)
+                    yield member.name, f.read()
+                    f.close()
+                archive.members = []
+                member = archive.next()
+        finally:
+            archive.close()
+    else:
+        archive = zipfile.ZipFile(path, 'r')
+        try:
+            for info in archive.infolist():
+                if not info.filename.endswith('/'):
+                    yield info.filename, archive.read(info)
+        finally:
+            archive.close()
@@ -2,16 +2,27 @@ import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
 
 logger = logging.getLogger(__name__)
 
-from util import mbtiles_connect, optimize_connection, optimize_database
+from collections import deque
+from util import mbtiles_connect, optimize_connection, optimize_database, ordered_imap, \
+    process_chunks, table_exists, table_type, metadata_and_grids_setup, incremental_vacuum_setup, \
+    checkpoint_setup, read_checkpoints, write_checkpoint, clear_checkpoints, count_tiles, \
+    invalidate_stats, image_hash_function, record_hash_function, index_exists
+from util_progress import make_progress
+from util_transform import make_pipeline
+from util_order import reorder_tiles, ordered_tiles
 
 def compact_mbtiles(mbtiles_file, **kwargs):
+    """
+    Compact mbtiles_file in place. Every chunk of tiles is committed with
+    a checkpoint of the last rowid compacted, so with resume an interrupted
+    compaction continues after it.
+    """
     logger.info("Compacting database %s" % (mbtiles_file))
 
 
     wal_journal = kwargs.get('wal_journal', False)
     synchronous_off = kwargs.get('synchronous_off', False)
     tmp_dir = kwargs.get('tmp_dir', None)
-    print_progress = kwargs.get('progress', False)
 
     if tmp_dir and not os.path.isdir(tmp_dir):
         os.mkdir(tmp_dir)
@@ -22,84 +33,276 @@ def compact_mbtiles(mbtiles_file, **kwargs):
     optimize_connection(cur, wal_journal, synchronous_off)
 
     existing_mbtiles_is_compacted = (con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0)
-    if existing_mbtiles_is_compacted:
+    checkpoint = read_checkpoints(cur, 'compact')
+    if existing_mbtiles_is_compacted and not checkpoint:
         logger.info("The mbtiles file is already compacted")
         return
-
-
-    overlapping = 0
-    unique = 0
-    count = 0
-    chunk = 100
-    start_time = time.time()
-    total_tiles = con.execute("SELECT count(zoom_level) FROM tiles").fetchone()[0]
-    max_rowid = con.execute("SELECT max(rowid) FROM tiles").fetchone()[0]
-
+    if checkpoint and not kwargs.get('resume'):
+        logger.error("The compaction of %s was interrupted, continue it with --resume" % mbtiles_file)
+        con.close()
+        sys.exit(1)
+    last_rowid = checkpoint[0] if checkpoint else 0
+    if kwargs.get('tile_order') and not checkpoint:
+        # rowid chunks then follow the curve, and so do the images
+        reorder_tiles(cur, kwargs['tile_order'])
+
+
+    hash_function = checked_hash_function(kwargs)
+    if checkpoint:
+        # the images compacted already were hashed with the recorded digest
+        recorded = image_hash_function(cur)
+        if recorded != hash_function and kwargs.get('hash_function'):
+            logger.warning("resuming with %s, the digest the compaction started with" % recorded)
+        hash_function = recorded
+
+    chunk = kwargs.get('chunk_size') or 1000
+    workers = kwargs.get('workers') or 1
+    # an interruption while finalizing may have replaced the tiles table
+    # by the view already
+    tiles_left = table_type(cur, 'tiles') == 'table'
+    total_tiles = 0
+    max_rowid = last_rowid
+    if tiles_left:
+        max_rowid = con.execute("SELECT max(rowid) FROM tiles").fetchone()[0] or 0
+        if last_rowid:
+            total_tiles = con.execute("SELECT count(zoom_level) FROM tiles WHERE rowid > ?",
+                (last_rowid,)).fetchone()[0]
+        else:
+            total_tiles = count_tiles(cur)
+    progress = make_progress('compact', kwargs, total_tiles)
 
     logger.debug("%d total tiles" % total_tiles)
-    if print_progress:
-        sys.stdout.write("%d tiles tiles\n" % (total_tiles))
-        sys.stdout.write("0 tiles finished, 0 unique, 0 duplicates (0% @ 0 tiles/sec)")
-        sys.stdout.flush()
-
-
-    compaction_prepare(cur)
-
-    for i in range((max_rowid / chunk) + 1):
-        cur.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE rowid > ? AND rowid <= ?""",
-            ((i * chunk), ((i + 1) * chunk)))
-
-        rows = cur.fetchall()
-        for r in rows:
-            z = r[0]
-            x = r[1]
-            y = r[2]
-            tile_data = r[3]
-
-            # Execute commands
-            if kwargs.get('command_list'):
-                tile_data = execute_commands_on_tile(kwargs['command_list'], "png", tile_data, tmp_dir)
-
-            m = hashlib.md5()
-            m.update(tile_data)
-            tile_id = m.hexdigest()
-
-            try:
-                cur.execute("""INSERT INTO images (tile_id, tile_data) VALUES (?, ?)""",
-                    (tile_id, sqlite3.Binary(tile_data)))
-            except:
-                overlapping = overlapping + 1
-            else:
-                unique = unique + 1
-
-            cur.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
-                (z, x, y, tile_id))
 
+    seen = set()
+    if checkpoint:
+        logger.info("resuming after rowid %d" % last_rowid)
+        seen.update([row[0] for row in con.execute("SELECT tile_id FROM images")])
+    else:
+        # the checkpoint comes first, so a file with an images table and
+        # no checkpoint is always one whose compaction finished
+        metadata_and_grids_setup(cur)
+        checkpoint_setup(cur)
+        write_checkpoint(cur, 'compact', 0)
+        record_hash_function(cur, hash_function)
+        con.commit()
+        compaction_prepare(cur, image_index=False)
+
+    # the last rowid of each chunk being hashed, oldest first
+    chunk_ends = deque()
+    def chunks():
+        for low in range(last_rowid, max_rowid, chunk):
+            chunk_ends.append(min(low + chunk, max_rowid))
+            yield con.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE rowid > ? AND rowid <= ?""",
+                (low, low + chunk)).fetchall()
+
+    pipeline = make_pipeline(kwargs, tile_format(con, kwargs))
+    for rows in hashed_chunks(progress.timed_iter('read', chunks()), hash_function, pipeline,
+            workers, progress):
+        start = time.time()
+        images = []
+        for z, x, y, tile_id, tile_data in rows:
+            if tile_id not in seen:
+                seen.add(tile_id)
+                images.append((tile_id, sqlite3.Binary(tile_data)))
+        cur.executemany("""INSERT INTO images (tile_id, tile_data) VALUES (?, ?)""", images)
+        # files written by other tools may hold a tile more than once: the
+        # unique map_index keeps the last written, as tile_index_setup does
+        cur.executemany("""INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
+            [r[:4] for r in rows])
+        write_checkpoint(cur, 'compact', chunk_ends.popleft())
+        written = time.time()
+        con.commit()
+        progress.add_time('write', written - start)
+        progress.add_time('commit', time.time() - written)
+        progress.update(len(rows), sum([len(r[4]) for r in rows]),
+            unique=len(images), duplicates=len(rows) - len(images))
+
+    start = time.time()
+    compaction_finalize(cur)
+    invalidate_stats(cur)
+    clear_checkpoints(cur, 'compact')
+    con.commit()
+    progress.add_time('commit', time.time() - start)
+    con.close()
+    event = progress.done()
+    logger.info("%d tiles finished, %d unique, %d duplicates (%.1f tiles/sec)" % (event['count'],
+        event.get('unique', 0), event.get('duplicates', 0), event['rate']))
+
+
+def compact_mbtiles_to_file(mbtiles_file, output_file, **kwargs):
+    """
+    Write a compacted copy of mbtiles_file (flat or compacted) to the new
+    file output_file. Unique images get integer ids, map is a WITHOUT ROWID
+    table keyed by tile, and the hex digest is kept in images.tile_id only
+    when store_hashes is set (the default). The old file is left untouched,
+    so no VACUUM is needed afterwards.
+    """
+    logger.info("Compacting database %s into %s" % (mbtiles_file, output_file))
+
+    hash_function = checked_hash_function(kwargs)
+    store_hashes = kwargs.get('store_hashes', True)
+    chunk = kwargs.get('chunk_size') or 1000
+    workers = kwargs.get('workers') or 1
+
+    if os.path.exists(output_file):
+        logger.error("%s already exists" % output_file)
+        sys.exit(1)
+
+    con = mbtiles_connect(output_file)
+    cur = con.cursor()
+    optimize_connection(cur, kwargs.get('wal_journal', False), kwargs.get('synchronous_off', False))
+    compact_copy_prepare(cur)
+    cur.execute("ATTACH DATABASE ? AS source", (mbtiles_file,))
+
+    coverage = kwargs.get('coverage')
+    where = "1"
+    if coverage:
+        cur.connection.create_function("in_coverage", 3, lambda z, x, y: coverage.contains(z, x, y))
+        where = "in_coverage(zoom_level, tile_column, tile_row)"
+
+    cur.execute("""INSERT INTO metadata (name, value) SELECT name, value FROM source.metadata""")
+    invalidate_stats(cur)
+    record_hash_function(cur, hash_function)
+    if table_exists(cur, 'source.grids'):
+        cur.execute("""INSERT INTO grids (zoom_level, tile_column, tile_row, grid)
+            SELECT zoom_level, tile_column, tile_row, grid FROM source.grids WHERE %s""" % where)
+        cur.execute("""INSERT INTO grid_data (zoom_level, tile_column, tile_row, key_name, key_json)
+            SELECT zoom_level, tile_column, tile_row, key_name, key_json FROM source.grid_data
+            WHERE %s""" % where)
+
+    total_tiles = count_tiles(cur, 'source')
+    progress = make_progress('compact', kwargs, total_tiles)
+    tile_order = kwargs.get('tile_order')
+    if tile_order:
+        # image_ids, and the pages images land on, follow the curve
+        start = time.time()
+        tiles = ordered_tiles(cur, tile_order, 'source', where)
+        progress.add_time('order', time.time() - start)
+    else:
+        tiles = con.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM source.tiles
+            WHERE %s ORDER BY zoom_level, tile_column, tile_row""" % where)
+
+    def chunks():
+        rows = tiles.fetchmany(chunk)
+        while rows:
+            yield rows
+            rows = tiles.fetchmany(chunk)
+
+    pipeline = make_pipeline(kwargs, tile_format(con, kwargs))
+    image_ids = {}
+    for rows in hashed_chunks(progress.timed_iter('read', chunks()), hash_function, pipeline,
+            workers, progress):
+        start = time.time()
+        images = []
+        map_rows = []
+        for z, x, y, tile_id, tile_data in rows:
+            image_id = image_ids.get(tile_id)
+            if image_id is None:
+                image_id = len(image_ids) + 1
+                image_ids[tile_id] = image_id
+                images.append((image_id, sqlite3.Binary(tile_data), tile_id if store_hashes else None))
+            map_rows.append((z, x, y, image_id))
+        cur.executemany("""INSERT INTO images (image_id, tile_data, tile_id) VALUES (?, ?, ?)""", images)
+        cur.executemany("""INSERT INTO map (zoom_level, tile_column, tile_row, image_id) VALUES (?, ?, ?, ?)""", map_rows)
+        progress.add_time('write', time.time() - start)
+        progress.update(len(rows), sum([len(r[4]) for r in rows]),
+            unique=len(images), duplicates=len(rows) - len(images))
+
+    start = time.time()
+    con.commit()
+    cur.execute("DETACH DATABASE source")
+    compact_copy_finalize(cur, store_hashes)
+    con.commit()
+    progress.add_time('commit', time.time() - start)
+    optimize_database(cur, skip_vacuum=True, progress=progress)
+    con.close()
+    event = progress.done()
+    logger.info("%d tiles finished, %d unique, %d duplicates (%.1f tiles/sec)" % (event['count'],
+        event.get('unique', 0), event.get('duplicates', 0), event['rate']))
 
-            count = count + 1
-            if (count % 100) == 0:
-                logger.debug("%d tiles finished, %d unique, %d duplicates (%.1f%% @ %.1f tiles/sec)" %
-                    (count, unique, overlapping, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
-                if print_progress:
-                    sys.stdout.write("\r%d tiles finished, %d unique, %d duplicates (%.1f%% @ %.1f tiles/sec)" %
-                        (count, unique, overlapping, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
-                    sys.stdout.flush()
 
+def compact_copy_prepare(cur):
+    cur.execute("PRAGMA page_size = 4096")
+    incremental_vacuum_setup(cur)
+    cur.execute("""
+        CREATE TABLE images (
+        image_id INTEGER PRIMARY KEY,
+        tile_id TEXT,
+        tile_data BLOB)""")
+    cur.execute("""
+        CREATE TABLE map (
+        zoom_level INTEGER,
+        tile_column INTEGER,
+        tile_row INTEGER,
+        image_id INTEGER,
+        PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID""")
+    metadata_and_grids_setup(cur)
 
-    if print_progress:
-        sys.stdout.write('\n')
 
-    logger.info("%d tiles finished, %d unique, %d duplicates (100.0%% @ %.1f tiles/sec)" % (count, unique, overlapping, count / (time.time() - start_time)))
-    if print_progress:
-        sys.stdout.write("%d tiles finished, %d unique, %d duplicates (100.0%% @ %.1f tiles/sec)\n" % (count, unique, overlapping, count / (time.time() - start_time)))
-        sys.stdout.flush()
+def compact_copy_finalize(cur, store_hashes=True):
+    cur.execute("""
+        CREATE VIEW tiles AS
+        SELECT map.zoom_level AS zoom_level,
+        map.tile_column AS tile_column,
+        map.tile_row AS tile_row,
+        images.tile_data AS tile_data FROM
+        map JOIN images ON images.image_id = map.image_id""")
+    if store_hashes:
+        cur.execute("""
+              CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)""")
 
-    compaction_finalize(cur)
-    con.commit()
-    con.close()
 
+def tile_format(con, kwargs):
+    """ The format in the metadata of the file compacted, else the format option """
+    row = con.execute("SELECT value FROM metadata WHERE name = 'format'").fetchone()
+    return (row and row[0]) or kwargs.get('format') or 'png'
 
-def compaction_prepare(cur, create_unique_indexes=True):
+def checked_hash_function(kwargs):
+    """ The hash_function of kwargs, md5 by default; exits if hashlib lacks it """
+    hash_function = kwargs.get('hash_function') or 'md5'
+    try:
+        hashlib.new(hash_function)
+    except ValueError:
+        logger.error("Unsupported hash function %s, choose one of: %s" % (hash_function,
+            ", ".join(sorted(getattr(hashlib, 'algorithms_available', None) or hashlib.algorithms))))
+        sys.exit(1)
+    return hash_function
+
+def hashed_chunks(chunks, hash_function, pipeline, workers=1, progress=None):
+    """
+    Yield every chunk of tile rows as hash_tile rows, in order. Chunks are
+    hashed on worker threads, or in worker processes when tiles are
+    transformed.
+    """
+    if pipeline:
+        logger.info('transforming tiles with %s' % ', '.join([str(s) for s in pipeline.specs]))
+        # sqlite returns buffers on Python 2, which do not survive pickling
+        chunks = ([(z, x, y, bytes(data)) for z, x, y, data in rows] for rows in chunks)
+        return process_chunks(lambda row: hash_tile(row, hash_function, pipeline),
+            chunks, workers, progress, 'transform')
+    def hash_rows(rows):
+        return [hash_tile(r, hash_function) for r in rows]
+    if progress:
+        hash_rows = progress.timed('hash', hash_rows)
+    return ordered_imap(hash_rows, chunks, workers)
+
+def hash_tile(row, hash_function='md5', transform=None):
+    """
+    Returns (z, x, y, tile_id, tile_data) for a row of the tiles table,
+    where tile_id is the hex digest of the tile data. A transform (such as
+    a TilePipeline) is applied first, so duplicates are found among the
+    transformed tiles.
+    """
+    z, x, y, tile_data = row
+    if transform:
+        tile_data = transform(tile_data)
+
+    m = hashlib.new(hash_function)
+    m.update(tile_data)
+    return (z, x, y, m.hexdigest(), tile_data)
+
+
+def compaction_prepare(cur, image_index=True):
     cur.execute("PRAGMA page_size = 4096")
 
     cur.execute("""
@@ -112,10 +315,10 @@ def compaction_prepare(cur, create_unique_indexes=True):
         tile_column INTEGER,
         tile_row INTEGER,
         tile_id VARCHAR(256))""")
-    if create_unique_indexes:
-        cur.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map
-            (zoom_level, tile_column, tile_row)""")
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map
+        (zoom_level, tile_column, tile_row)""")
+    if image_index:
         cur.execute("""
               CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)""")
 
@@ -143,6 +346,11 @@ def compaction_finalize(cur):
         map.tile_row AS tile_row,
         images.tile_data AS tile_data FROM
         map JOIN images ON images.tile_id = map.tile_id""")
+    if not index_exists(cur, 'map_index'):
+        # compactions started before map_index was created up front may
+        # have mapped a tile more than once
+        cur.execute("""DELETE FROM map WHERE rowid NOT IN (SELECT max(rowid) FROM map
+            GROUP BY zoom_level, tile_column, tile_row)""")
     cur.execute("""
         CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map
         (zoom_level, tile_column, tile_row)""")
@@ -0,0 +1,203 @@
+import json, logging
+from bisect import bisect_right
+from math import pi, log, tan, cos, floor, ceil, radians
+
+from proj import MAX_LATITUDE, InvalidCoverageError
+
+logger = logging.getLogger(__name__)
+
+# Polygons are rasterized once at this zoom at most. Deeper tiles are
+# tested through their ancestor at the mask zoom.
+MAX_MASK_ZOOM = 16
+
+class TileCoverage(object):
+    """
+    Per-zoom tile masks of a set of (Multi)Polygons.
+
+    The polygons are rasterized once at the mask zoom: every tile that
+    intersects them is marked. Each lower zoom is derived by merging its
+    children. A mask is stored as sorted runs of tile columns per row, so
+    testing a tile is a dict lookup plus a bisect over a handful of runs.
+    Rows use the TMS orientation of MBTiles tile_row.
+    """
+    def __init__(self, polygons, zoom_range=None, mask_zoom=None):
+        if mask_zoom is None:
+            mask_zoom = max(zoom_range) if zoom_range else MAX_MASK_ZOOM
+        self.mask_zoom = min(mask_zoom, MAX_MASK_ZOOM)
+        self.levels = {}
+        self.columns = {}
+
+        n = 2 ** self.mask_zoom
+        cells = {}
+        for rings in polygons:
+            rings = [[lonlat_to_tile(p[0], p[1], n) for p in ring] for ring in rings if len(ring) > 2]
+            if rings:
+                rasterize_polygon(rings, n, cells)
+        # store rows flipped to TMS
+        rows = dict(((n - 1 - r), merge_spans(spans)) for r, spans in cells.items())
+        z = self.mask_zoom
+        while True:
+            self.set_level(z, rows)
+            if z == 0:
+                break
+            parents = {}
+            for r, spans in rows.items():
+                parents.setdefault(r >> 1, []).extend([(s >> 1, e >> 1) for s, e in spans])
+            rows = dict((r, merge_spans(spans)) for r, spans in parents.items())
+            z -= 1
+
+    @classmethod
+    def from_geojson(cls, geojson, zoom_range=None, mask_zoom=None):
+        """ geojson is a path, or an already parsed GeoJSON object """
+        if not isinstance(geojson, dict):
+            f = open(geojson, 'r')
+            geojson = json.load(f)
+            f.close()
+        polygons = geojson_polygons(geojson)
+        if not polygons:
+            raise InvalidCoverageError("No Polygon or MultiPolygon found in GeoJSON coverage")
+        return cls(polygons, zoom_range, mask_zoom)
+
+    def set_level(self, z, rows):
+        self.levels[z] = dict((r, ([s for s, e in spans], [e for s, e in spans]))
+            for r, spans in rows.items())
+        columns = []
+        for spans in rows.values():
+            columns.extend(spans)
+        columns = merge_spans(columns)
+        self.columns[z] = ([s for s, e in columns], [e for s, e in columns])
+
+    def contains(self, z, x, y):
+        """ True if tile z/x/y (TMS row) intersects the coverage """
+        if z > self.mask_zoom:
+            shift = z - self.mask_zoom
+            z, x, y = self.mask_zoom, x >> shift, y >> shift
+        runs = self.levels[z].get(y)
+        return runs is not None and in_runs(runs, x)
+
+    def covers_column(self, z, x):
+        """ True if any tile of column x at zoom z intersects the coverage """
+        if z > self.mask_zoom:
+            z, x = self.mask_zoom, x >> (z - self.mask_zoom)
+        return in_runs(self.columns[z], x)
+
+    def covers_row(self, z, y):
+        """ True if any tile of (TMS) row y at zoom z intersects the coverage """
+        if z > self.mask_zoom:
+            z, y = self.mask_zoom, y >> (z - self.mask_zoom)
+        return y in self.levels[z]
+
+    def count(self, z):
+        """ Number of tiles covered at zoom z (z <= mask_zoom) """
+        total = 0
+        for starts, ends in self.levels[z].values():
+            total += sum([e - s + 1 for s, e in zip(starts, ends)])
+        return total
+
+def in_runs(runs, x):
+    starts, ends = runs
+    i = bisect_right(starts, x) - 1
+    return i >= 0 and x <= ends[i]
+
+def merge_spans(spans):
+    """ Sort inclusive (start, end) spans and merge overlapping or adjacent ones """
+    merged = []
+    for s, e in sorted(spans):
+        if merged and s <= merged[-1][1] + 1:
+            if e > merged[-1][1]:
+                merged[-1] = (merged[-1][0], e)
+        else:
+            merged.append((s, e))
+    return merged
+
+def geojson_polygons(obj):
+    """ Returns the polygons (lists of rings) of a GeoJSON object """
+    kind = obj.get('type')
+    if kind == 'FeatureCollection':
+        polygons = []
+        for feature in obj.get('features', []):
+            polygons.extend(geojson_polygons(feature))
+        return polygons
+    if kind == 'Feature':
+        return geojson_polygons(obj.get('geometry') or {})
+    if kind == 'GeometryCollection':
+        polygons = []
+        for geometry in obj.get('geometries', []):
+            polygons.extend(geojson_polygons(geometry))
+        return polygons
+    if kind == 'Polygon':
+        return [obj['coordinates']]
+    if kind == 'MultiPolygon':
+        return list(obj['coordinates'])
+    return []
+
+def lonlat_to_tile(lng, lat, n):
+    """ Fractional XYZ tile coordinates of a WGS84 point on an n x n grid """
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    x = (lng + 180.0) / 360.0 * n
+    y = (1.0 - log(tan(radians(lat)) + 1.0 / cos(radians(lat))) / pi) / 2.0 * n
+    return (x, y)
+
+def rasterize_polygon(rings, n, cells):
+    """
+    Add to cells ({row: [(start, end), ...]}) every tile of an n x n grid
+    that intersects the polygon: tiles whose center is inside it (even-odd
+    scanline over all rings) plus every tile its edges pass through.
+    """
+    edges = []
+    for ring in rings:
+        if ring[0] != ring[-1]:
+            ring = ring + [ring[0]]
+        for i in range(len(ring) - 1):
+            edges.append((ring[i], ring[i + 1]))
+
+    # scanline through tile centers, with edges bucketed by first row
+    starting = {}
+    for (x0, y0), (x1, y1) in edges:
+        if y0 == y1:
+            continue
+        first = max(int(ceil(min(y0, y1) - 0.5)), 0)
+        last = min(int(ceil(max(y0, y1) - 0.5)) - 1, n - 1)
+        if first <= last:
+            starting.setdefault(first, []).append((x0, y0, x1, y1, last))
+    active = []
+    last_row = -1
+    for bucket in starting.values():
+        last_row = max([last_row] + [e[4] for e in bucket])
+    for r in range(min(starting.keys()) if starting else 0, last_row + 1):
+        active = [e for e in active if e[4] >= r] + starting.get(r, [])
+        yc = r + 0.5
+        xs = sorted([x0 + (yc - y0) * (x1 - x0) / (y1 - y0) for x0, y0, x1, y1, last in active])
+        for a, b in zip(xs[0::2], xs[1::2]):
+            start = max(int(ceil(a - 0.5)), 0)
+            end = min(int(floor(b - 0.5)), n - 1)
+            if start <= end:
+                cells.setdefault(r, []).append((start, end))
+
+    # supercover of the edges, for tiles the boundary crosses
+    for (x0, y0), (x1, y1) in edges:
+        for cx, cy in segment_cells(x0, y0, x1, y1):
+            if 0 <= cx < n and 0 <= cy < n:
+                cells.setdefault(cy, []).append((cx, cx))
+
+def segment_cells(x0, y0, x1, y1):
+    """ Yield every grid cell a segment passes through (Amanatides & Woo) """
+    cx, cy = int(floor(x0)), int(floor(y0))
+    ex, ey = int(floor(x1)), int(floor(y1))
+    dx, dy = x1 - x0, y1 - y0
+    step_x = 1 if dx > 0 else -1
+    step_y = 1 if dy > 0 else -1
+    inf = float('inf')
+    t_max_x = ((cx + (step_x > 0)) - x0) / dx if dx else inf
+    t_max_y = ((cy + (step_y > 0)) - y0) / dy if dy else inf
+    t_delta_x = abs(1.0 / dx) if dx else inf
+    t_delta_y = abs(1.0 / dy) if dy else inf
+    yield (cx, cy)
+    for i in range(abs(ex - cx) + abs(ey - cy)):
+        if t_max_x < t_max_y:
+            cx += step_x
+            t_max_x += t_delta_x
+        else:
+            cy += step_y
+            t_max_y += t_delta_y
+        yield (cx, cy)
@@ -0,0 +1,161 @@
+import sqlite3, sys, logging, time, os, hashlib
+
+logger = logging.getLogger(__name__)
+
+from util import mbtiles_connect, optimize_connection, optimize_database, ordered_imap, \
+    image_key, has_image_hashes, tile_filter, invalidate_stats, image_hash_function, \
+    record_hash_function
+from util_compact import compact_copy_prepare, compact_copy_finalize
+from util_merge import stored_images, fetch_images
+from util_progress import make_progress
+
+def hashed_tiles(con, where, params, hash_function='md5', use_tile_ids=False,
+        chunk_size=1000, workers=1):
+    """
+    Yield (z, x, y, tile_id, tile_data) for every tile of con ordered by
+    zoom_level, tile_column and tile_row, which the tile index or the map
+    primary key delivers without sorting. With use_tile_ids the hashes kept
+    in a compacted file are used and tile_data is None; otherwise chunks of
+    tiles are hashed on worker threads.
+    """
+    if use_tile_ids:
+        if image_key(con) == 'tile_id':
+            rows = con.execute("""SELECT zoom_level, tile_column, tile_row, tile_id, NULL
+                FROM map WHERE tile_id IS NOT NULL AND %s
+                ORDER BY zoom_level, tile_column, tile_row""" % where, params)
+        else:
+            rows = con.execute("""SELECT zoom_level, tile_column, tile_row, tile_id, NULL
+                FROM map JOIN images ON images.image_id = map.image_id WHERE %s
+                ORDER BY zoom_level, tile_column, tile_row""" % where, params)
+        for row in rows:
+            yield row
+        return
+
+    tiles = con.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles
+        WHERE %s ORDER BY zoom_level, tile_column, tile_row""" % where, params)
+    def hash_rows(rows):
+        return [(z, x, y, hashlib.new(hash_function, data).hexdigest(), data)
+            for z, x, y, data in rows]
+    for rows in ordered_imap(hash_rows, iter(lambda: tiles.fetchmany(chunk_size), []), workers):
+        for row in rows:
+            yield row
+
+def diff_tiles(old_tiles, new_tiles):
+    """
+    Merge two ordered streams of hashed tiles. Yields ('added', row),
+    ('changed', row) and ('unchanged', row) with the row of new_tiles, and
+    ('deleted', row) with the row of old_tiles.
+    """
+    end = (sys.maxsize,)
+    old = next(old_tiles, end)
+    new = next(new_tiles, end)
+    while old is not end or new is not end:
+        if old[:3] == new[:3]:
+            yield ('changed' if old[3] != new[3] else 'unchanged', new)
+            old = next(old_tiles, end)
+            new = next(new_tiles, end)
+        elif new is end or (old is not end and old[:3] < new[:3]):
+            yield ('deleted', old)
+            old = next(old_tiles, end)
+        else:
+            yield ('added', new)
+            new = next(new_tiles, end)
+
+def patch_setup(cur):
+    """ A compacted file whose deleted_tiles table lists the tiles to remove """
+    compact_copy_prepare(cur)
+    compact_copy_finalize(cur, store_hashes=True)
+    cur.execute("""
+        CREATE TABLE deleted_tiles (
+        zoom_level INTEGER,
+        tile_column INTEGER,
+        tile_row INTEGER,
+        PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID""")
+
+def diff_mbtiles(old_file, new_file, patch_file, **kwargs):
+    """
+    Write the tiles added or changed from old_file to new_file into the
+    new compacted file patch_file, and the tiles new_file no longer has
+    into its deleted_tiles table. Both inputs are read in index order and
+    merged, so memory does not grow with their size. Tiles are compared by
+    the image hashes of compacted files when both inputs keep them, made
+    with the same digest, and by hash_function digests of their data
+    otherwise. hash_function defaults to the digest of old_file and is
+    recorded in the patch, so that merging the patch into old_file
+    (merge_mbtiles) turns it into new_file. UTFGrids are not compared.
+    """
+    logger.info("Comparing %s to %s" % (old_file, new_file))
+    if os.path.exists(patch_file):
+        logger.error("%s already exists" % patch_file)
+        sys.exit(1)
+
+    chunk_size = kwargs.get('chunk_size') or 1000
+    batch_size = kwargs.get('batch_size') or 1000
+    workers = kwargs.get('workers') or 1
+    where, params = tile_filter(kwargs.get('bbox'), kwargs.get('zoom_range'))
+
+    old = mbtiles_connect(old_file)
+    new = mbtiles_connect(new_file)
+    old_hash = has_image_hashes(old) and image_hash_function(old)
+    new_hash = has_image_hashes(new) and image_hash_function(new)
+    # the patch is merged into old_file, so its tile_ids use the digest of old_file
+    hash_function = kwargs.get('hash_function') or old_hash or new_hash or 'md5'
+    use_tile_ids = old_hash == new_hash == hash_function
+    if not use_tile_ids:
+        if old_hash and new_hash and old_hash != new_hash:
+            logger.info("the files hash their images with %s and %s" % (old_hash, new_hash))
+        logger.info("hashing tiles with %s" % hash_function)
+
+    con = mbtiles_connect(patch_file)
+    cur = con.cursor()
+    optimize_connection(cur)
+    patch_setup(cur)
+    cur.executemany("""INSERT INTO metadata (name, value) VALUES (?, ?)""",
+        new.execute("""SELECT name, value FROM metadata""").fetchall())
+    invalidate_stats(cur)
+    record_hash_function(cur, hash_function)
+
+    progress = make_progress('diff', kwargs)
+
+    def write(tiles, deleted):
+        start = time.time()
+        if tiles:
+            ids = set([r[3] for r in tiles])
+            missing = ids - stored_images(cur, ids)
+            blobs = dict([(r[3], r[4]) for r in tiles if r[4] is not None and r[3] in missing])
+            if len(blobs) < len(missing):
+                blobs.update(fetch_images(new, missing - set(blobs)))
+            cur.executemany("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
+                [(tile_id, sqlite3.Binary(data)) for tile_id, data in blobs.items()])
+            cur.executemany("""INSERT INTO map (zoom_level, tile_column, tile_row, image_id)
+                SELECT ?, ?, ?, image_id FROM images WHERE tile_id = ?""", [r[:4] for r in tiles])
+        cur.executemany("""INSERT INTO deleted_tiles (zoom_level, tile_column, tile_row)
+            VALUES (?, ?, ?)""", deleted)
+        con.commit()
+        progress.add_time('write', time.time() - start)
+
+    old_tiles = progress.timed_iter('read', hashed_tiles(old, where, params, hash_function,
+        use_tile_ids, chunk_size, workers))
+    new_tiles = progress.timed_iter('read', hashed_tiles(new, where, params, hash_function,
+        use_tile_ids, chunk_size, workers))
+    tiles = []
+    deleted = []
+    for change, row in diff_tiles(old_tiles, new_tiles):
+        if change == 'deleted':
+            deleted.append(row[:3])
+        elif change != 'unchanged':
+            tiles.append(row)
+        progress.update(0 if change == 'deleted' else 1, **{change: 1})
+        if len(tiles) + len(deleted) >= batch_size:
+            write(tiles, deleted)
+            tiles = []
+            deleted = []
+    write(tiles, deleted)
+    old.close()
+    new.close()
+
+    optimize_database(cur, skip_vacuum=True, progress=progress)
+    con.close()
+    event = progress.done()
+    logger.info("%d tiles added, %d changed, %d deleted" % (event.get('added', 0),
+        event.get('changed', 0), event.get('deleted', 0)))
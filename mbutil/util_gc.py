@@ -0,0 +1,73 @@
+import logging, time
+
+logger = logging.getLogger(__name__)
+
+from util import mbtiles_connect, optimize_connection, image_key, invalidate_stats, map_key_index
+from util_progress import make_progress
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+def gc_mbtiles(mbtiles_file, **kwargs):
+    """
+    Delete the images of a compacted file that no map row references, in
+    batches of batch_size rowids, each its own transaction. Unreferenced
+    images are found with an anti-join driven by an index on map's image
+    column, built for the run if the file has none (keep_index keeps it).
+    In files with auto_vacuum=INCREMENTAL, which mb-util creates, the freed
+    pages are returned to the file system batch by batch with
+    incremental_vacuum; elsewhere they are reused by later writes. Returns
+    the number of deleted images.
+    """
+    logger.info("Collecting unreferenced images of %s" % mbtiles_file)
+    batch_size = kwargs.get('batch_size') or 10000
+    con = mbtiles_connect(mbtiles_file)
+    cur = con.cursor()
+    optimize_connection(cur, kwargs.get('wal_journal', False))
+    key = image_key(cur)
+    if key is None:
+        logger.info("%s is not compacted, there are no images to collect" % mbtiles_file)
+        con.close()
+        return 0
+
+    index = map_key_index(cur, key)
+    incremental = cur.execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL
+    low, high = cur.execute("SELECT min(rowid), max(rowid) FROM images").fetchone()
+    progress = make_progress('gc', kwargs, (high - low + 1) if low is not None else 0)
+    page_size = cur.execute("PRAGMA page_size").fetchone()[0]
+    freed = 0
+    for start in range(low or 0, (high or -1) + 1, batch_size):
+        started = time.time()
+        cur.execute("""DELETE FROM images WHERE rowid BETWEEN ? AND ? AND NOT EXISTS
+            (SELECT 1 FROM map WHERE map.%(key)s = images.%(key)s)""" % {'key': key},
+            (start, start + batch_size - 1))
+        deleted = cur.rowcount
+        con.commit()
+        progress.add_time('delete', time.time() - started)
+        if deleted and incremental:
+            started = time.time()
+            pages = cur.execute("PRAGMA freelist_count").fetchone()[0]
+            cur.execute("PRAGMA incremental_vacuum")
+            cur.fetchall()
+            freed += pages * page_size
+            progress.add_time('vacuum', time.time() - started)
+        progress.update(min(batch_size, high - start + 1), deleted=deleted)
+
+    if progress.counters.get('deleted'):
+        invalidate_stats(cur)
+    if index and not kwargs.get('keep_index'):
+        cur.execute("DROP INDEX %s" % index)
+    con.commit()
+    if incremental:
+        cur.execute("PRAGMA incremental_vacuum")
+        cur.fetchall()
+    else:
+        free = cur.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+        if free:
+            logger.info("%d bytes are free for reuse inside the file; it does not use "
+                "auto_vacuum=INCREMENTAL, so only a VACUUM (--compact output files, or "
+                "optimize) would shrink it" % free)
+    con.close()
+    event = progress.done()
+    logger.info("%d unreferenced images deleted, %d bytes returned to the file system" %
+        (event.get('deleted', 0), freed))
+    return event.get('deleted', 0)
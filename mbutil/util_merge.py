@@ -0,0 +1,119 @@
+import sqlite3, sys, logging, time, os, json
+
+logger = logging.getLogger(__name__)
+
+from util import mbtiles_connect, mbtiles_setup, optimize_connection, table_exists, \
+    image_key, has_image_hashes, metadata_and_grids_setup, tile_index_setup, tile_filter, \
+    iter_grids, check_hash_functions, TileBatchWriter, remove_orphan_images
+from util_progress import make_progress
+
+def merge_mbtiles(source_file, dest_file, **kwargs):
+    """
+    Copy the tiles and grids of source_file into dest_file, replacing tiles
+    that already exist there. Either file may be flat or compacted. Images
+    a compacted destination already holds are not copied again, and images
+    left unreferenced by replaced tiles are deleted (keep_index keeps the
+    index on map built to find them). The tiles listed in
+    the deleted_tiles table of a patch written by diff_mbtiles are removed
+    from dest_file.
+    """
+    logger.info("Merging %s into %s" % (source_file, dest_file))
+    batch_size = kwargs.get('batch_size') or 1000
+
+    con = mbtiles_connect(dest_file)
+    cur = con.cursor()
+    optimize_connection(cur)
+    if not table_exists(cur, 'tiles'):
+        mbtiles_setup(cur)
+    else:
+        metadata_and_grids_setup(cur)
+        tile_index_setup(cur)
+    con.commit()
+
+    # read through a second connection: committing a batch on con would
+    # otherwise reset the cursor we are streaming the source from
+    source = mbtiles_connect(source_file)
+    where, params = tile_filter(kwargs.get('bbox'), kwargs.get('zoom_range'))
+    progress = make_progress('merge', kwargs)
+    writer = TileBatchWriter(con, batch_size, upsert=True, track_orphans=True, progress=progress)
+    dest_hashes = writer.compacted == 'tile_id' or writer.dedup
+    if dest_hashes:
+        # the tile_ids of the source are written into the destination as they are
+        check_hash_functions(source, con)
+
+    coverage = kwargs.get('coverage')
+    if has_image_hashes(source):
+        # stream the map only and fetch each image the destination lacks once
+        if image_key(source) == 'tile_id':
+            rows = source.execute("""SELECT zoom_level, tile_column, tile_row, tile_id
+                FROM map WHERE tile_id IS NOT NULL AND %s""" % where, params)
+        else:
+            rows = source.execute("""SELECT zoom_level, tile_column, tile_row, tile_id
+                FROM map JOIN images ON images.image_id = map.image_id WHERE %s""" % where, params)
+        batches = progress.timed_iter('read', iter(lambda: rows.fetchmany(batch_size), []))
+        for batch in batches:
+            if coverage:
+                batch = [r for r in batch if coverage.contains(r[0], r[1], r[2])]
+            ids = set([r[3] for r in batch])
+            if dest_hashes:
+                ids = ids - stored_images(cur, ids)
+            blobs = progress.timed('read', fetch_images)(source, ids)
+            for z, x, y, tile_id in batch:
+                writer.add_tile(z, x, y, blobs.get(tile_id), tile_id)
+            progress.update(len(batch), sum([len(b) for b in blobs.values()]), copied=len(blobs))
+    else:
+        rows = source.execute("""SELECT zoom_level, tile_column, tile_row, tile_data
+            FROM tiles WHERE %s""" % where, params)
+        for z, x, y, tile_data in progress.timed_iter('read', rows):
+            if coverage and not coverage.contains(z, x, y):
+                continue
+            writer.add_tile(z, x, y, tile_data)
+            progress.update(1, len(tile_data), copied=1)
+
+    if table_exists(source, 'grids') and table_exists(source, 'grid_data'):
+        for z, x, y, grid, data in iter_grids(source, where, params):
+            if coverage and not coverage.contains(z, x, y):
+                continue
+            writer.add_grid(z, x, y, grid, [(k, json.dumps(v)) for k, v in data.items()])
+            progress.update(grids=1)
+    writer.flush()
+    if table_exists(source, 'deleted_tiles'):
+        rows = source.execute("""SELECT zoom_level, tile_column, tile_row FROM deleted_tiles
+            WHERE %s""" % where, params)
+        for batch in iter(lambda: rows.fetchmany(batch_size), []):
+            if coverage:
+                batch = [r for r in batch if coverage.contains(r[0], r[1], r[2])]
+            writer.delete_tiles(batch)
+            progress.update(deleted=len(batch))
+    source.close()
+
+    removed = 0
+    if writer.orphans:
+        removed = remove_orphan_images(cur, writer.compacted, writer.orphans,
+            kwargs.get('keep_index'))
+        con.commit()
+    con.close()
+    event = progress.done()
+    logger.info("%d tiles merged, %d deleted, %d images copied, %d orphaned images removed (%.1f tiles/sec)" %
+        (event['count'], event.get('deleted', 0), event.get('copied', 0), removed, event['rate']))
+
+def stored_images(cur, tile_ids):
+    """ Returns the subset of tile_ids already present in images """
+    found = set()
+    tile_ids = list(tile_ids)
+    for i in range(0, len(tile_ids), 500):
+        chunk = tile_ids[i:i + 500]
+        found.update([r[0] for r in cur.execute("""SELECT tile_id FROM images
+            WHERE tile_id IN (%s)""" % ",".join("?" * len(chunk)), chunk)])
+    return found
+
+def fetch_images(con, tile_ids):
+    """ Returns a {tile_id: tile_data} dict read from a compacted file """
+    blobs = {}
+    tile_ids = list(tile_ids)
+    for i in range(0, len(tile_ids), 500):
+        chunk = tile_ids[i:i + 500]
+        for tile_id, tile_data in con.execute("""SELECT tile_id, tile_data FROM images
+                WHERE tile_id IN (%s)""" % ",".join("?" * len(chunk)), chunk):
+            blobs[tile_id] = tile_data
+    return blobs
@@ -0,0 +1,119 @@
+import logging, time
+
+logger = logging.getLogger(__name__)
+
+# curve positions of a zoom level take up to 2 * z bits, so zoom levels
+# up to 28 fit in a 64 bit key with the zoom level in the top bits
+MAX_ZOOM = 28
+
+def hilbert_index(z, x, y):
+    """ Position of tile x, y along the Hilbert curve filling zoom level z """
+    n = 1 << z
+    d = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve continues where it left off
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+def zorder_index(z, x, y):
+    """ Position of tile x, y along the Z-order (Morton) curve of zoom level z """
+    d = 0
+    for bit in range(z):
+        d |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+    return d
+
+TILE_ORDERS = {
+    'hilbert': hilbert_index,
+    'zorder': zorder_index,
+}
+
+def curve_key(tile_order):
+    """
+    The function sorting tiles by zoom level, then along the tile_order
+    curve, so tiles near each other on the map are near each other in the
+    file.
+    """
+    index = TILE_ORDERS[tile_order]
+    def key(z, x, y):
+        if z > MAX_ZOOM:
+            return (MAX_ZOOM + 1) << (2 * MAX_ZOOM)
+        return (z << (2 * MAX_ZOOM)) | index(z, x, y)
+    return key
+
+def prepare_tile_order(cur, tile_order, schema='main', where='1', params=()):
+    """
+    Fill temp.tile_order with the (key, z, x, y) of the tiles of schema
+    matching where, indexed by curve key. Only the tile index is read.
+    """
+    cur.connection.create_function('curve_key', 3, curve_key(tile_order))
+    cur.execute("DROP TABLE IF EXISTS temp.tile_order")
+    cur.execute("""CREATE TEMP TABLE tile_order (key INTEGER, zoom_level INTEGER,
+        tile_column INTEGER, tile_row INTEGER)""")
+    cur.execute("""INSERT INTO temp.tile_order SELECT curve_key(zoom_level, tile_column, tile_row),
+        zoom_level, tile_column, tile_row FROM %s.tiles WHERE %s""" % (schema, where), params)
+    cur.execute("CREATE INDEX temp.tile_order_key ON tile_order (key)")
+
+def ordered_tiles(cur, tile_order, schema='main', where='1', params=()):
+    """
+    (z, x, y, tile_data) of the tiles of schema matching where, ordered
+    by tile_order. The keys are sorted first, then every tile is looked up
+    in that order, so tile data never goes through a sort.
+    """
+    prepare_tile_order(cur, tile_order, schema, where, params)
+    # CROSS JOIN keeps tile_order the outer loop, scanned in key order; the
+    # rows come from a cursor of their own, so cur stays free for writes
+    return cur.connection.execute("""SELECT t.zoom_level, t.tile_column, t.tile_row, t.tile_data
+        FROM temp.tile_order o CROSS JOIN %s.tiles t ON t.zoom_level = o.zoom_level
+        AND t.tile_column = o.tile_column AND t.tile_row = o.tile_row
+        ORDER BY o.key""" % schema)
+
+def reorder_tiles(cur, tile_order, progress=None):
+    """
+    Rewrite the tiles table of a flat file in tile_order, so its rowids,
+    and the pages a VACUUM lays them out on, follow the curve. Compacted
+    files are left as they are: copy them with compact_mbtiles_to_file and
+    tile_order instead.
+    """
+    if not cur.execute("""SELECT count(*) FROM sqlite_master
+            WHERE type = 'table' AND name = 'tiles'""").fetchone()[0]:
+        logger.warning("tiles is not a table, the file is not reordered")
+        return
+    start = time.time()
+    logger.info("ordering tiles along the %s curve" % tile_order)
+    con = cur.connection
+    con.commit()
+    prepare_tile_order(cur, tile_order)
+    # the sqlite3 module commits before DDL statements, so the table swap
+    # runs in a transaction of its own: an interrupted rewrite leaves the
+    # file as it was
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+    try:
+        cur.execute("BEGIN")
+        cur.execute("""CREATE TABLE tiles_ordered (zoom_level integer, tile_column integer,
+            tile_row integer, tile_data blob)""")
+        cur.execute("""INSERT INTO tiles_ordered SELECT t.zoom_level, t.tile_column, t.tile_row,
+            t.tile_data FROM temp.tile_order o CROSS JOIN tiles t ON t.zoom_level = o.zoom_level
+            AND t.tile_column = o.tile_column AND t.tile_row = o.tile_row ORDER BY o.key""")
+        cur.execute("DROP TABLE tiles")
+        cur.execute("ALTER TABLE tiles_ordered RENAME TO tiles")
+        cur.execute("""CREATE UNIQUE INDEX tile_index ON tiles
+            (zoom_level, tile_column, tile_row)""")
+        cur.execute("DROP TABLE temp.tile_order")
+        cur.execute("COMMIT")
+    except:
+        cur.execute("ROLLBACK")
+        raise
+    finally:
+        con.isolation_level = isolation_level
+    if progress:
+        progress.add_time('order', time.time() - start)
@@ -0,0 +1,155 @@
+import sys, time, json, threading, logging
+
+logger = logging.getLogger(__name__)
+
+class Progress(object):
+    """
+    Counts, bytes and per-stage timings of one operation (import, export,
+    compact, merge, optimize), reported to callback(event) at most once
+    every interval seconds and once more when the operation is done.
+
+    An event is a dict with the operation, the event kind ('progress' or
+    'done'), count, total (None when unknown), bytes, elapsed seconds,
+    rate in tiles/sec, eta in seconds (None when unknown), stages (seconds
+    spent in each stage, summed over worker threads) and any extra
+    counters of the operation, such as unique or skipped.
+    """
+    def __init__(self, operation, callback=None, total=None, interval=1.0):
+        self.operation = operation
+        self.callback = callback
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.bytes = 0
+        self.counters = {}
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.start = self.last = time.time()
+
+    def update(self, count=0, bytes=0, **counters):
+        """ Add to the counts, and report them if interval has passed """
+        self.count += count
+        self.bytes += bytes
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.callback is not None:
+            now = time.time()
+            if now - self.last >= self.interval:
+                self.last = now
+                self.callback(self.event('progress', now))
+
+    def add_time(self, stage, seconds):
+        """ Add seconds to a stage; safe to call from worker threads """
+        self.lock.acquire()
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.lock.release()
+
+    def timed(self, stage, func):
+        """ Wrap func so the time spent in it is added to stage """
+        def timed_func(*args):
+            start = time.time()
+            try:
+                return func(*args)
+            finally:
+                self.add_time(stage, time.time() - start)
+        return timed_func
+
+    def timed_iter(self, stage, iterable):
+        """ Yield from iterable, adding the time spent producing items to stage """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.time() - start)
+                return
+            self.add_time(stage, time.time() - start)
+            yield item
+
+    def event(self, kind, now=None):
+        elapsed = (now or time.time()) - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(self.total - self.count, 0) / rate
+        event = dict(self.counters)
+        event.update({'operation': self.operation, 'event': kind, 'count': self.count,
+            'total': self.total, 'bytes': self.bytes, 'elapsed': elapsed, 'rate': rate,
+            'eta': eta, 'stages': dict(self.stages)})
+        return event
+
+    def done(self):
+        """ Report the final counts and log the stage breakdown; returns the last event """
+        event = self.event('done')
+        if self.stages:
+            logger.info('%s took %.2fs: %s' % (self.operation, event['elapsed'],
+                format_stages(self.stages)))
+        if self.callback is not None:
+            self.callback(event)
+        return event
+
+def make_progress(operation, kwargs, total=None):
+    """
+    The Progress of an operation called with kwargs: progress_callback is
+    called with every event, or progress=True renders a progress line;
+    progress_interval is the least number of seconds between events.
+    """
+    callback = kwargs.get('progress_callback')
+    if callback is None and kwargs.get('progress') is True:
+        callback = ProgressLine()
+    interval = kwargs.get('progress_interval')
+    return Progress(operation, callback, total, 1.0 if interval is None else interval)
+
+def format_stages(stages):
+    """
+    'read 1.20s (60%), write 0.80s (40%)', slowest stage first. Shares are
+    of the summed stage times, which exceed the elapsed time when workers
+    run stages concurrently.
+    """
+    total = sum(stages.values()) or 1.0
+    return ', '.join(['%s %.2fs (%.0f%%)' % (stage, seconds, 100.0 * seconds / total)
+        for seconds, stage in sorted([(v, k) for k, v in stages.items()], reverse=True)])
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '%d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+    return '%d:%02d' % (seconds // 60, seconds % 60)
+
+class ProgressLine(object):
+    """ Renders events as a single progress line rewritten in place """
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self.width = 0
+
+    def __call__(self, event):
+        if event['total']:
+            text = '%s: %d / %d tiles (%.1f%%)' % (event['operation'], event['count'],
+                event['total'], 100.0 * event['count'] / event['total'])
+        else:
+            text = '%s: %d tiles' % (event['operation'], event['count'])
+        # optimize has stages but no tiles to count
+        if event['count']:
+            text += ', %.0f tiles/sec' % event['rate']
+        if event['bytes']:
+            text += ', %.1f MB' % (event['bytes'] / 1e6)
+        if event['event'] == 'done':
+            text += ', %s elapsed' % format_duration(event['elapsed'])
+        elif event['eta'] is not None:
+            text += ', ETA %s' % format_duration(event['eta'])
+        self.stream.write('\r' + text.ljust(self.width))
+        self.width = len(text)
+        if event['event'] == 'done':
+            self.stream.write('\n')
+            self.width = 0
+        self.stream.flush()
+
+class JSONLines(object):
+    """ Writes every event as a line of JSON, for job schedulers """
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+
+    def __call__(self, event):
+        self.stream.write(json.dumps(event, sort_keys=True) + '\n')
+        self.stream.flush()
@@ -0,0 +1,266 @@
+import sqlite3, os, logging, threading, hashlib
+
+try:
+    from urllib import pathname2url
+except ImportError:
+    from urllib.request import pathname2url
+
+logger = logging.getLogger(__name__)
+
+from util import table_type, image_key, image_hash_function
+
+TILE_QUERIES = {
+    None: """SELECT NULL, tile_data FROM tiles
+        WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?""",
+    'tile_id': """SELECT images.tile_id, images.tile_data FROM map
+        JOIN images ON images.tile_id = map.tile_id
+        WHERE map.zoom_level = ? AND map.tile_column = ? AND map.tile_row = ?""",
+    'image_id': """SELECT images.tile_id, images.tile_data FROM map
+        JOIN images ON images.image_id = map.image_id
+        WHERE map.zoom_level = ? AND map.tile_column = ? AND map.tile_row = ?""",
+}
+
+# lookups of the image hash alone, which do not read the tile_data blob
+TILE_ID_QUERIES = {
+    'tile_id': """SELECT tile_id FROM map
+        WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?""",
+    'image_id': """SELECT images.tile_id FROM map
+        JOIN images ON images.image_id = map.image_id
+        WHERE map.zoom_level = ? AND map.tile_column = ? AND map.tile_row = ?""",
+}
+
+def uri_filenames_supported():
+    """ True if the linked SQLite opens file: URIs passed as plain filenames """
+    con = sqlite3.connect(':memory:')
+    options = [row[0] for row in con.execute("PRAGMA compile_options")]
+    con.close()
+    return 'USE_URI' in options or 'USE_URI=1' in options
+
+def read_only_connect(mbtiles_file, immutable=False):
+    """
+    Open mbtiles_file read-only through a mode=ro URI, with immutable=1 when
+    the file is known not to change while it is open (SQLite then skips
+    locking and change detection entirely).
+    """
+    path = pathname2url(os.path.abspath(mbtiles_file))
+    uri = 'file:%s?mode=ro' % path
+    if immutable:
+        uri += '&immutable=1'
+    try:
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+    except TypeError:
+        # Python 2: uri is not a connect() argument, SQLite may still
+        # understand URI filenames if it was built with SQLITE_USE_URI
+        if uri_filenames_supported():
+            return sqlite3.connect(uri, check_same_thread=False)
+    con = sqlite3.connect(mbtiles_file, check_same_thread=False)
+    con.execute("PRAGMA query_only = 1")
+    return con
+
+class LRUCache(object):
+    """
+    A thread-safe least recently used cache holding at most size entries,
+    kept as a dict of entries linked in a circular list (newest last).
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.entries.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            # move to the most recently used end
+            prev, next = link[0], link[1]
+            prev[1] = next
+            next[0] = prev
+            last = self.root[0]
+            last[1] = self.root[0] = link
+            link[0], link[1] = last, self.root
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def peek(self, key, default=None):
+        """ Look key up without counting a hit or miss or reordering """
+        link = self.entries.get(key)
+        return default if link is None else link[3]
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.lock.acquire()
+        try:
+            link = self.entries.get(key)
+            if link is not None:
+                link[3] = value
+                return
+            if len(self.entries) >= self.size:
+                oldest = self.root[1]
+                self.root[1] = oldest[1]
+                oldest[1][0] = self.root
+                del self.entries[oldest[2]]
+            last = self.root[0]
+            link = [last, self.root, key, value]
+            last[1] = self.root[0] = self.entries[key] = link
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.root[:] = [self.root, self.root, None, None]
+            self.hits = self.misses = 0
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.entries)
+
+class MBTilesReader(object):
+    """
+    Read tiles from an MBTiles file, flat or compacted.
+
+    Every thread gets its own read-only connection, opened on first use and
+    reused afterwards, so the tile lookup stays a prepared statement in the
+    connection's statement cache. Tiles, including missing ones, are kept
+    in an LRU cache of cache_size entries. Rows are TMS, like tile_row.
+    """
+    def __init__(self, mbtiles_file, cache_size=1024, immutable=False,
+            mmap_size=256 * 1024 * 1024, page_cache_size=2000):
+        if not os.path.isfile(mbtiles_file):
+            raise IOError("No such MBTiles file: %s" % mbtiles_file)
+        self.mbtiles_file = mbtiles_file
+        self.immutable = immutable
+        self.mmap_size = mmap_size
+        self.page_cache_size = page_cache_size
+        self.cache = LRUCache(cache_size)
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+        cur = self.connection().cursor()
+        self.layout = image_key(cur) if table_type(cur, 'tiles') == 'view' else None
+        # images without a stored tile_id are hashed the way the stored ones were
+        self.hash_function = image_hash_function(cur) if self.layout else 'md5'
+        self.tile_query = TILE_QUERIES[self.layout]
+
+    def connection(self):
+        """ The calling thread's connection """
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = read_only_connect(self.mbtiles_file, self.immutable)
+            con.execute("PRAGMA mmap_size = %d" % self.mmap_size)
+            con.execute("PRAGMA cache_size = %d" % self.page_cache_size)
+            self.local.con = con
+            self.lock.acquire()
+            self.connections.append(con)
+            self.lock.release()
+        return con
+
+    def get_tile_and_id(self, z, x, y):
+        """
+        Returns (tile_id, tile_data) for tile z/x/y, where tile_id is the
+        image hash of a compacted file (None for a flat file or when the
+        hash was not stored), or (None, None) if the tile does not exist.
+        """
+        key = (z, x, y)
+        found = self.cache.get(key)
+        if found is None:
+            found = self.connection().execute(self.tile_query, key).fetchone()
+            if found is None:
+                found = (None, None)
+            else:
+                found = (found[0], bytes(found[1]) if found[1] is not None else None)
+            self.cache.put(key, found)
+        return found
+
+    def get_tile_id(self, z, x, y):
+        """
+        Returns a hash identifying the image of tile z/x/y, or None if the
+        tile does not exist: the tile_id of a compacted file, read without
+        touching the image, else the digest of the image by hash_function.
+        """
+        cached = self.cache.peek((z, x, y))
+        if cached is None and self.layout:
+            row = self.connection().execute(TILE_ID_QUERIES[self.layout], (z, x, y)).fetchone()
+            if row is None:
+                return None
+            if row[0] is not None:
+                return row[0]
+        tile_id, tile_data = cached or self.get_tile_and_id(z, x, y)
+        if tile_id is None and tile_data is not None:
+            tile_id = hashlib.new(self.hash_function, tile_data).hexdigest()
+        return tile_id
+
+    def get_tile(self, z, x, y):
+        """ Returns the image of tile z/x/y, or None if it does not exist """
+        return self.get_tile_and_id(z, x, y)[1]
+
+    def get_tiles(self, tiles):
+        """
+        Yield (z, x, y, tile_data) for every (z, x, y) of tiles, in order.
+        Uncached tiles are looked up in (z, x, y) order on one connection,
+        which keeps consecutive reads close together in the file.
+        """
+        tiles = [tuple(t) for t in tiles]
+        found = {}
+        missing = []
+        for key in tiles:
+            if key in found:
+                continue
+            cached = self.cache.get(key)
+            if cached is None:
+                missing.append(key)
+            else:
+                found[key] = cached[1]
+        con = self.connection()
+        for key in sorted(set(missing)):
+            row = con.execute(self.tile_query, key).fetchone()
+            if row is None or row[1] is None:
+                self.cache.put(key, (None, None))
+                found[key] = None
+            else:
+                found[key] = bytes(row[1])
+                self.cache.put(key, (row[0], found[key]))
+        for z, x, y in tiles:
+            yield z, x, y, found[(z, x, y)]
+
+    def metadata(self):
+        """ Returns the metadata table as a dict """
+        return dict(self.connection().execute("SELECT name, value FROM metadata").fetchall())
+
+    def cache_info(self):
+        """ Returns a dict of cache hits, misses, current and maximum size """
+        return {'hits': self.cache.hits, 'misses': self.cache.misses,
+            'size': len(self.cache), 'max_size': self.cache.size}
+
+    def close(self):
+        """ Close the connections of every thread and drop the cache """
+        self.lock.acquire()
+        try:
+            # each connection is only ever used by its own thread, but
+            # check_same_thread is off so that they can be closed here
+            for con in self.connections:
+                con.close()
+            self.connections = []
+        finally:
+            self.lock.release()
+        self.local = threading.local()
+        self.cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
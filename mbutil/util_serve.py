@@ -0,0 +1,151 @@
+import logging, json, re, socket, threading, hashlib
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+logger = logging.getLogger(__name__)
+
+from util import flip_y
+from util_reader import MBTilesReader
+
+TILE_PATH = re.compile(r'^/(\d+)/(\d+)/(\d+)\.(\w+)$')
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'pbf': 'application/x-protobuf',
+}
+
+class PooledHTTPServer(HTTPServer):
+    """
+    An HTTPServer handing requests to a fixed pool of threads. Unlike
+    ThreadingMixIn, which starts a thread per connection, the threads live
+    as long as the server, so each keeps its MBTilesReader connection.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler, threads=8):
+        HTTPServer.__init__(self, server_address, handler)
+        self.requests = Queue(threads * 4)
+        for i in range(threads):
+            t = threading.Thread(target=self.process_requests)
+            t.daemon = True
+            t.start()
+
+    def process_requests(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            # shutdown_request is new in Python 2.7
+            getattr(self, 'shutdown_request', self.close_request)(request)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /z/x/y.ext returns a tile, GET /metadata.json the metadata table.
+    The ETag of a tile is its image hash, so a conditional request that
+    matches is answered with a 304 without reading the image. The reader
+    and settings are attributes of the server.
+    """
+    protocol_version = 'HTTP/1.1'
+    # buffer the headers and body of a response into as few writes as
+    # possible, handle_one_request flushes after every request
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # without this, a keep-alive client waits out the delayed ACK of
+        # every response
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?', 1)[0]
+        if path == '/metadata.json':
+            return self.respond(200, server.metadata.encode('utf-8'), 'application/json')
+        match = TILE_PATH.match(path)
+        if not match:
+            return self.respond(404)
+        z, x, y = int(match.group(1)), int(match.group(2)), int(match.group(3))
+        if server.scheme == 'xyz':
+            y = flip_y(z, y)
+
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tile_id = server.reader.get_tile_id(z, x, y)
+            if tile_id is not None and ('"%s"' % tile_id) in [
+                    tag.strip() for tag in if_none_match.split(',')]:
+                return self.respond(304, etag=tile_id)
+
+        tile_id, tile_data = server.reader.get_tile_and_id(z, x, y)
+        if tile_data is None:
+            return self.respond(404)
+        if tile_id is None:
+            tile_id = hashlib.new(server.reader.hash_function, tile_data).hexdigest()
+        self.respond(200, tile_data, server.content_type, etag=tile_id)
+
+    def respond(self, status, body=b'', content_type=None, etag=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+            # vector tiles are usually stored gzipped
+            if body[:2] == b'\x1f\x8b':
+                self.send_header('Content-Encoding', 'gzip')
+        if etag:
+            self.send_header('ETag', '"%s"' % etag)
+            if self.server.max_age is not None:
+                self.send_header('Cache-Control', 'max-age=%d' % self.server.max_age)
+        if status != 304:
+            # a 304 has no body, and its headers describe the cached one
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+
+def make_tile_server(mbtiles_file, host='127.0.0.1', port=8080, **kwargs):
+    """
+    Returns a PooledHTTPServer serving the tiles of mbtiles_file. y is
+    flipped for the default xyz scheme and used as is for tms.
+    """
+    reader = MBTilesReader(mbtiles_file, cache_size=kwargs.get('cache_size', 4096),
+        immutable=kwargs.get('immutable', False))
+    metadata = reader.metadata()
+    image_format = kwargs.get('format') or metadata.get('format', 'png')
+
+    server = PooledHTTPServer((host, port), TileRequestHandler, kwargs.get('workers') or 8)
+    server.reader = reader
+    server.scheme = 'tms' if kwargs.get('scheme') == 'tms' else 'xyz'
+    server.content_type = CONTENT_TYPES.get(image_format, 'application/octet-stream')
+    server.max_age = kwargs.get('max_age')
+    server.metadata = json.dumps(metadata)
+    return server
+
+def serve_mbtiles(mbtiles_file, host='127.0.0.1', port=8080, **kwargs):
+    server = make_tile_server(mbtiles_file, host, port, **kwargs)
+    logger.info("Serving %s on http://%s:%d/{z}/{x}/{y} (%s)" % (mbtiles_file,
+        host, server.server_address[1], server.scheme))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    server.reader.close()
@@ -0,0 +1,275 @@
+import sqlite3, sys, logging, time, os
+
+logger = logging.getLogger(__name__)
+
+from util import mbtiles_connect, mbtiles_setup, optimize_connection, optimize_database, \
+    process_imap, image_key, index_exists, table_exists, tile_filter, flip_y, invalidate_stats, \
+    check_hash_functions
+from util_compact import compact_copy_prepare, compact_copy_finalize
+from util_merge import merge_mbtiles
+from proj import GoogleProjection
+
+def parse_zoom_bands(text):
+    """ [(0, 5), (6, 10)] from '0-5,6-10'; a single zoom may be given as '11' """
+    bands = []
+    for band in text.split(','):
+        low, sep, high = band.strip().partition('-')
+        bands.append((int(low), int(high) if sep else int(low)))
+    return bands
+
+def quadtree_where(z, x, y, max_zoom):
+    """
+    (where, params) selecting tile (z, x, y) (TMS row) and its descendants
+    down to max_zoom, as one index range per zoom level.
+    """
+    clauses = []
+    params = []
+    for zoom in range(z, max_zoom + 1):
+        d = zoom - z
+        clauses.append("""(zoom_level = ? AND tile_column BETWEEN ? AND ?
+            AND tile_row BETWEEN ? AND ?)""")
+        params.extend([zoom, x << d, ((x + 1) << d) - 1, y << d, ((y + 1) << d) - 1])
+    return "(%s)" % " OR ".join(clauses), params
+
+def shard_specs(con, table, zoom_bands=None, prefix_zoom=None, bboxes=None, zoom_range=None):
+    """
+    Returns (label, where, params) for every shard: one per zoom band, one
+    per tile at prefix_zoom that has tiles (plus one for the zooms above
+    it), or one per W,S,E,N bbox.
+    """
+    if zoom_bands:
+        return [('z%d-%d' % band, "zoom_level BETWEEN ? AND ?", list(band)) for band in zoom_bands]
+    if bboxes:
+        return [('bbox%d' % (i + 1),) + tile_filter(bbox, zoom_range) for i, bbox in enumerate(bboxes)]
+    max_zoom = con.execute("SELECT max(zoom_level) FROM %s" % table).fetchone()[0]
+    if max_zoom is None or max_zoom < prefix_zoom:
+        return []
+    specs = []
+    if prefix_zoom > 0:
+        specs.append(('z0-%d' % (prefix_zoom - 1), "zoom_level BETWEEN ? AND ?", [0, prefix_zoom - 1]))
+    # a shard per tile at prefix_zoom that has tiles somewhere below it
+    prefixes = con.execute("""SELECT DISTINCT tile_column >> (zoom_level - ?), tile_row >> (zoom_level - ?)
+        FROM %s WHERE zoom_level >= ?""" % table, (prefix_zoom, prefix_zoom, prefix_zoom)).fetchall()
+    for x, y in sorted(prefixes):
+        where, params = quadtree_where(prefix_zoom, x, y, max_zoom)
+        specs.append(('%d-%d-%d' % (prefix_zoom, x, flip_y(prefix_zoom, y)), where, params))
+    return specs
+
+def tile_extent_bounds(z, x0, x1, y0, y1):
+    """ (west, south, east, north) of the tiles x0-x1, y0-y1 (TMS rows) of zoom z """
+    proj = GoogleProjection(256, [z])
+    west, north = proj.tile_bbox((z, x0, flip_y(z, y1)))[0::3]
+    east, south = proj.tile_bbox((z, x1, flip_y(z, y0)))[2:0:-1]
+    return west, south, east, north
+
+def update_extent_metadata(cur, table):
+    """
+    Set minzoom, maxzoom and bounds (and center, if present) from the tiles
+    of table. Returns the number of tiles.
+    """
+    count, min_zoom, max_zoom = cur.execute("""SELECT count(*), min(zoom_level), max(zoom_level)
+        FROM %s""" % table).fetchone()
+    if not count:
+        return 0
+    x0, x1, y0, y1 = cur.execute("""SELECT min(tile_column), max(tile_column),
+        min(tile_row), max(tile_row) FROM %s WHERE zoom_level = ?""" % table, (max_zoom,)).fetchone()
+    west, south, east, north = tile_extent_bounds(max_zoom, x0, x1, y0, y1)
+    values = {'minzoom': str(min_zoom), 'maxzoom': str(max_zoom),
+        'bounds': '%.6f,%.6f,%.6f,%.6f' % (west, south, east, north)}
+    center = cur.execute("SELECT value FROM metadata WHERE name = 'center'").fetchone()
+    if center:
+        parts = center[0].split(',')
+        zoom = min_zoom
+        if len(parts) == 3:
+            try:
+                zoom = max(min_zoom, min(max_zoom, int(parts[2])))
+            except ValueError:
+                pass
+        values['center'] = '%.6f,%.6f,%d' % ((west + east) / 2.0, (south + north) / 2.0, zoom)
+    cur.executemany("REPLACE INTO metadata (name, value) VALUES (?, ?)", values.items())
+    invalidate_stats(cur)
+    return count
+
+def write_shard(job):
+    """
+    Copy the tiles matching where from source_file into the new file
+    shard_file with INSERT ... SELECT over the attached source, so rows are
+    read by index range and never pass through Python. Returns
+    (shard_file, number of tiles).
+    """
+    source_file, shard_file, where, params, layout, hashes = job
+    con = mbtiles_connect(shard_file)
+    cur = con.cursor()
+    optimize_connection(cur, exclusive_lock=False)
+    cur.execute("ATTACH DATABASE ? AS source", (source_file,))
+    if layout is None:
+        mbtiles_setup(cur)
+        cur.execute("""INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data)
+            SELECT zoom_level, tile_column, tile_row, tile_data FROM source.tiles
+            WHERE %s""" % where, params)
+        table = 'tiles'
+    else:
+        compact_copy_prepare(cur)
+        compact_copy_finalize(cur, hashes)
+        if layout == 'image_id':
+            cur.execute("""INSERT INTO map (zoom_level, tile_column, tile_row, image_id)
+                SELECT zoom_level, tile_column, tile_row, image_id FROM source.map
+                WHERE %s""" % where, params)
+            cur.execute("""INSERT INTO images (image_id, tile_id, tile_data)
+                SELECT image_id, tile_id, tile_data FROM source.images
+                WHERE image_id IN (SELECT image_id FROM main.map)""")
+        else:
+            # node-mbtiles layout: give the images integer ids
+            cur.execute("""INSERT INTO images (tile_id, tile_data)
+                SELECT tile_id, tile_data FROM source.images WHERE tile_id IN
+                (SELECT tile_id FROM source.map WHERE %s)""" % where, params)
+            cur.execute("""INSERT INTO map (zoom_level, tile_column, tile_row, image_id)
+                SELECT zoom_level, tile_column, tile_row, images.image_id FROM source.map
+                JOIN main.images ON images.tile_id = map.tile_id WHERE %s""" % where, params)
+        table = 'map'
+    if table_exists(cur, 'source.grids') and table_exists(cur, 'source.grid_data'):
+        cur.execute("""INSERT INTO grids (zoom_level, tile_column, tile_row, grid)
+            SELECT zoom_level, tile_column, tile_row, grid FROM source.grids
+            WHERE %s""" % where, params)
+        cur.execute("""INSERT INTO grid_data (zoom_level, tile_column, tile_row, key_name, key_json)
+            SELECT zoom_level, tile_column, tile_row, key_name, key_json FROM source.grid_data
+            WHERE %s""" % where, params)
+    cur.execute("""INSERT INTO metadata (name, value) SELECT name, value FROM source.metadata""")
+    count = update_extent_metadata(cur, table)
+    con.commit()
+    cur.execute("DETACH DATABASE source")
+    optimize_database(cur, skip_vacuum=True)
+    con.close()
+    return shard_file, count
+
+def split_mbtiles(mbtiles_file, output_dir, zoom_bands=None, prefix_zoom=None, bboxes=None, **kwargs):
+    """
+    Shard mbtiles_file into output_dir: by zoom_bands [(min, max), ...], by
+    the tile at prefix_zoom tiles fall under, or by W,S,E,N bboxes (which
+    may overlap). Shards keep the layout of the input, flat or compacted,
+    and get their own minzoom, maxzoom and bounds. Every shard is written by
+    one of workers processes; shards without tiles are not kept. Returns
+    the paths of the shards.
+    """
+    if len([s for s in (zoom_bands, prefix_zoom, bboxes) if s is not None]) != 1:
+        raise ValueError("split by exactly one of zoom_bands, prefix_zoom or bboxes")
+    logger.info("Splitting %s into %s" % (mbtiles_file, output_dir))
+    start_time = time.time()
+
+    con = mbtiles_connect(mbtiles_file)
+    layout = image_key(con)
+    hashes = layout == 'tile_id' or (layout == 'image_id' and index_exists(con, 'images_id'))
+    specs = shard_specs(con, 'map' if layout else 'tiles', zoom_bands, prefix_zoom, bboxes,
+        kwargs.get('zoom_range'))
+    con.close()
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    stem = os.path.splitext(os.path.basename(mbtiles_file))[0]
+    jobs = []
+    for label, where, params in specs:
+        shard_file = os.path.join(output_dir, '%s-%s.mbtiles' % (stem, label))
+        if os.path.exists(shard_file):
+            logger.error("%s already exists" % shard_file)
+            sys.exit(1)
+        jobs.append((os.path.abspath(mbtiles_file), shard_file, where, params, layout, hashes))
+
+    workers = min(kwargs.get('workers') or 1, len(jobs))
+    shards = []
+    total = 0
+    for shard_file, count in process_imap(write_shard, jobs, workers):
+        if count:
+            logger.info("%s: %d tiles" % (shard_file, count))
+            shards.append(shard_file)
+            total += count
+        else:
+            os.remove(shard_file)
+    logger.info("%d tiles written into %d shards (%.1fs)" % (total, len(shards), time.time() - start_time))
+    return shards
+
+def merge_shards(shard_files, output_file, **kwargs):
+    """
+    Join shards into the new file output_file. Flat shards and shards
+    compacted with integer image ids are copied with INSERT ... SELECT, one
+    attached shard at a time; images are deduplicated across shards when
+    the shards keep image hashes, and renumbered otherwise. Other layouts
+    fall back to merge_mbtiles. bbox, zoom_range and coverage restrict the
+    tiles copied, as they do for merge_mbtiles.
+    """
+    if os.path.exists(output_file):
+        logger.error("%s already exists" % output_file)
+        sys.exit(1)
+    logger.info("Joining %d shards into %s" % (len(shard_files), output_file))
+    start_time = time.time()
+    layouts = set()
+    hashes = True
+    shards = [mbtiles_connect(shard_file) for shard_file in shard_files]
+    for con in shards:
+        layouts.add(image_key(con))
+        hashes = hashes and index_exists(con, 'images_id')
+    # images are deduplicated across shards by tile_id
+    check_hash_functions(*shards)
+    for con in shards:
+        con.close()
+    if len(layouts) != 1 or layouts == set(['tile_id']):
+        for shard_file in shard_files:
+            merge_mbtiles(shard_file, output_file, **kwargs)
+        return
+    layout = layouts.pop()
+
+    con = mbtiles_connect(output_file)
+    cur = con.cursor()
+    optimize_connection(cur)
+    if layout is None:
+        mbtiles_setup(cur)
+    else:
+        compact_copy_prepare(cur)
+        compact_copy_finalize(cur, hashes)
+    where, params = tile_filter(kwargs.get('bbox'), kwargs.get('zoom_range'))
+    coverage = kwargs.get('coverage')
+    if coverage:
+        con.create_function("in_coverage", 3, lambda z, x, y: coverage.contains(z, x, y))
+        where += " AND in_coverage(zoom_level, tile_column, tile_row)"
+    # only the images of the tiles copied, when not all of them are
+    image_where, image_params = "1", []
+    if where != "1":
+        image_where = "image_id IN (SELECT image_id FROM shard.map WHERE %s)" % where
+        image_params = list(params)
+    for i, shard_file in enumerate(shard_files):
+        cur.execute("ATTACH DATABASE ? AS shard", (shard_file,))
+        if i == 0:
+            cur.execute("""INSERT INTO metadata (name, value) SELECT name, value FROM shard.metadata""")
+        if layout is None:
+            cur.execute("""REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data)
+                SELECT zoom_level, tile_column, tile_row, tile_data FROM shard.tiles
+                WHERE %s""" % where, params)
+        elif hashes:
+            cur.execute("""INSERT OR IGNORE INTO images (tile_id, tile_data)
+                SELECT tile_id, tile_data FROM shard.images WHERE %s""" % image_where, image_params)
+            cur.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, image_id)
+                SELECT zoom_level, tile_column, tile_row, main.images.image_id FROM shard.map
+                JOIN shard.images ON shard.images.image_id = shard.map.image_id
+                JOIN main.images ON main.images.tile_id = shard.images.tile_id
+                WHERE %s""" % where, params)
+        else:
+            offset = cur.execute("SELECT coalesce(max(image_id), 0) FROM main.images").fetchone()[0]
+            cur.execute("""INSERT INTO images (image_id, tile_id, tile_data)
+                SELECT image_id + ?, tile_id, tile_data FROM shard.images
+                WHERE %s""" % image_where, [offset] + image_params)
+            cur.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, image_id)
+                SELECT zoom_level, tile_column, tile_row, image_id + ? FROM shard.map
+                WHERE %s""" % where, [offset] + list(params))
+        if table_exists(cur, 'shard.grids') and table_exists(cur, 'shard.grid_data'):
+            cur.execute("""REPLACE INTO grids (zoom_level, tile_column, tile_row, grid)
+                SELECT zoom_level, tile_column, tile_row, grid FROM shard.grids
+                WHERE %s""" % where, params)
+            cur.execute("""REPLACE INTO grid_data (zoom_level, tile_column, tile_row, key_name, key_json)
+                SELECT zoom_level, tile_column, tile_row, key_name, key_json FROM shard.grid_data
+                WHERE %s""" % where, params)
+        con.commit()
+        cur.execute("DETACH DATABASE shard")
+    count = update_extent_metadata(cur, 'tiles' if layout is None else 'map')
+    con.commit()
+    optimize_database(cur, skip_vacuum=True)
+    con.close()
+    logger.info("%d tiles joined from %d shards (%.1fs)" % (count, len(shard_files), time.time() - start_time))
@@ -0,0 +1,147 @@
+import sqlite3, logging, json, hashlib, time, math
+
+logger = logging.getLogger(__name__)
+
+from util import mbtiles_connect, image_key, table_exists, cached_stats, STATS_KEY
+from util_split import tile_extent_bounds
+from util_progress import make_progress
+
+PERCENTILES = (50, 90, 99)
+
+def size_percentiles(sizes, count):
+    """
+    Nearest-rank percentiles of the tile sizes in sizes, a histogram
+    {size in bytes: number of tiles} of count tiles. Tiles come in few
+    distinct sizes, so the histogram stays small however many tiles there
+    are.
+    """
+    ranks = [(p, max(1, int(math.ceil(count * p / 100.0)))) for p in PERCENTILES]
+    result = {}
+    seen = 0
+    for size in sorted(sizes):
+        seen += sizes[size]
+        while ranks and seen >= ranks[0][1]:
+            result['p%d' % ranks[0][0]] = size
+            ranks.pop(0)
+    return result
+
+def zoom_extents(con, key):
+    """
+    [(z, tiles, min x, max x, min y, max y)] per zoom level, read from the
+    (zoom_level, tile_column, tile_row) index of the tiles table, or of the
+    map of a compacted file, alone.
+    """
+    if key:
+        # map rows of node-mbtiles files may hold a grid and no tile
+        return con.execute("""SELECT zoom_level, count(*), min(tile_column), max(tile_column),
+            min(tile_row), max(tile_row) FROM map WHERE %s IS NOT NULL
+            GROUP BY zoom_level""" % key).fetchall()
+    return con.execute("""SELECT zoom_level, count(*), min(tile_column), max(tile_column),
+        min(tile_row), max(tile_row) FROM tiles GROUP BY zoom_level""").fetchall()
+
+def scan_sizes(con, key, zooms, progress, chunk_size=1000):
+    """
+    Read the size of every tile in one pass and add the bytes, smallest
+    and largest size of each zoom level to zooms, {z: dict}. In a flat file the
+    tiles are hashed on the way to count the unique ones: the digests go to
+    a temp table that count(DISTINCT) sorts in temporary files, so memory
+    does not grow with the file. Returns the size histogram and the number
+    of unique tiles of a flat file.
+    """
+    if key:
+        # length() of a blob is known without reading its overflow pages
+        rows = con.execute("""SELECT map.zoom_level, length(images.tile_data) FROM map
+            JOIN images ON images.%(key)s = map.%(key)s""" % {'key': key})
+    else:
+        con.execute("PRAGMA temp_store = file")
+        con.execute("CREATE TEMP TABLE tile_digests (digest BLOB)")
+        rows = con.execute("""SELECT zoom_level, tile_data FROM tiles""")
+    sizes = {}
+    for batch in progress.timed_iter('read', iter(lambda: rows.fetchmany(chunk_size), [])):
+        start = time.time()
+        if not key:
+            # the first 8 bytes of the md5 tell tiles apart well enough to count them
+            con.executemany("INSERT INTO temp.tile_digests (digest) VALUES (?)",
+                [(sqlite3.Binary(hashlib.md5(data).digest()[:8]),) for z, data in batch])
+            batch = [(z, len(data)) for z, data in batch]
+            progress.add_time('hash', time.time() - start)
+            start = time.time()
+        total = 0
+        for z, size in batch:
+            zoom = zooms[z]
+            zoom['bytes'] += size
+            zoom['min_size'] = min(zoom.get('min_size', size), size)
+            zoom['max_size'] = max(zoom.get('max_size', size), size)
+            sizes[size] = sizes.get(size, 0) + 1
+            total += size
+        progress.add_time('count', time.time() - start)
+        progress.update(len(batch), total)
+    if key:
+        return sizes, None
+    start = time.time()
+    unique = con.execute("SELECT count(DISTINCT digest) FROM temp.tile_digests").fetchone()[0]
+    con.rollback()
+    con.execute("DROP TABLE temp.tile_digests")
+    progress.add_time('count', time.time() - start)
+    return sizes, unique
+
+def mbtiles_stats(mbtiles_file, **kwargs):
+    """
+    Statistics of mbtiles_file: tiles, bytes, size percentiles, unique
+    tiles and the duplicate ratio, minzoom, maxzoom, the bounds of the
+    highest zoom and per-zoom counts, bytes and tile ranges. Sizes come
+    from one pass over the tiles, which hashes them in a flat file; with
+    counts_only, only the tile index is read and sizes are left out.
+
+    With write_stats the statistics are stored in metadata, where
+    mbtiles_to_disk and compaction take their tile counts from instead of
+    counting again. mbutil drops them whenever it changes the tiles of
+    the file; other tools changing the file do not.
+    """
+    logger.info("Collecting statistics of %s" % mbtiles_file)
+    counts_only = kwargs.get('counts_only', False)
+    con = mbtiles_connect(mbtiles_file)
+    key = image_key(con)
+    previous = cached_stats(con)
+    progress = make_progress('stats', kwargs, previous and previous.get('tiles'))
+
+    start = time.time()
+    zooms = {}
+    for z, count, x0, x1, y0, y1 in zoom_extents(con, key):
+        zooms[z] = {'tiles': count, 'bytes': 0, 'x': [x0, x1], 'y': [y0, y1]}
+    progress.add_time('index', time.time() - start)
+    tiles = sum([zoom['tiles'] for zoom in zooms.values()])
+    stats = {'tiles': tiles}
+    if zooms:
+        max_zoom = max(zooms)
+        x, y = zooms[max_zoom]['x'], zooms[max_zoom]['y']
+        stats.update({'minzoom': min(zooms), 'maxzoom': max_zoom,
+            'bounds': [round(v, 6) for v in tile_extent_bounds(max_zoom, x[0], x[1], y[0], y[1])]})
+    if key:
+        stats['images'] = con.execute("SELECT count(*) FROM images").fetchone()[0]
+    if table_exists(con, 'grids'):
+        stats['grids'] = con.execute("SELECT count(*) FROM grids").fetchone()[0]
+
+    if not counts_only and tiles:
+        sizes, unique = scan_sizes(con, key, zooms, progress, kwargs.get('chunk_size') or 1000)
+        if key:
+            unique = con.execute("SELECT count(DISTINCT %s) FROM map" % key).fetchone()[0]
+        total = sum([zoom['bytes'] for zoom in zooms.values()])
+        stats['bytes'] = total
+        stats['sizes'] = size_percentiles(sizes, tiles)
+        stats['sizes'].update({'min': min(sizes), 'max': max(sizes), 'mean': total // tiles})
+        stats['unique'] = unique
+        stats['duplicate_ratio'] = round(1.0 - float(unique) / tiles, 6)
+    else:
+        for zoom in zooms.values():
+            del zoom['bytes']
+    stats['zooms'] = dict([(str(z), zoom) for z, zoom in zooms.items()])
+
+    if kwargs.get('write_stats'):
+        con.execute("REPLACE INTO metadata (name, value) VALUES (?, ?)",
+            (STATS_KEY, json.dumps(stats, sort_keys=True)))
+        con.commit()
+        logger.info("statistics stored in the metadata of %s" % mbtiles_file)
+    con.close()
+    progress.done()
+    return stats
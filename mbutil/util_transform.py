@@ -0,0 +1,166 @@
+import os, zlib, shlex, logging, tempfile, subprocess
+
+logger = logging.getLogger(__name__)
+
+# what --transform auto means for each image format: vector tiles are
+# stored gzipped, raster images are compressed already
+FORMAT_TRANSFORMS = {
+    'pbf': ['gzip:9'],
+}
+
+class TransformError(Exception):
+    pass
+
+def is_gzipped(data):
+    return data[:2] == b'\x1f\x8b'
+
+def gzip_tile(level=6):
+    """ Gzip tiles at zlib level, recompressing tiles that are gzipped already """
+    def transform(data):
+        if is_gzipped(data):
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    return transform
+
+def ungzip_tile(data):
+    """ Decompress gzipped tiles, leaving other tiles as they are """
+    if is_gzipped(data):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    return data
+
+def import_callable(name):
+    """ The function named 'package.module:function' (or 'package.module.function') """
+    if ':' in name:
+        module_name, attribute = name.split(':', 1)
+    else:
+        module_name, attribute = name.rsplit('.', 1)
+    module = __import__(module_name, fromlist=[attribute])
+    try:
+        return getattr(module, attribute)
+    except AttributeError:
+        raise TransformError('%s has no attribute %s' % (module_name, attribute))
+
+class ExternalCommand(object):
+    """
+    Run a command on every tile. By default the tile is written to the
+    command's stdin and replaced by its stdout. If an argument contains
+    {}, the tile is written to a temporary file instead, {} is replaced by
+    its path, and the file is read back once the command exits, which suits
+    tools that optimize files in place.
+    """
+    def __init__(self, command, extension='png', tmp_dir=None):
+        self.command = command
+        self.args = shlex.split(command)
+        self.extension = extension
+        self.tmp_dir = tmp_dir
+        self.in_place = any(['{}' in arg for arg in self.args])
+
+    def __call__(self, data):
+        if not self.in_place:
+            return self.run(self.args, data)
+        fd, path = tempfile.mkstemp('.' + self.extension, dir=self.tmp_dir)
+        try:
+            f = os.fdopen(fd, 'wb')
+            f.write(data)
+            f.close()
+            self.run([arg.replace('{}', path) for arg in self.args], None)
+            f = open(path, 'rb')
+            data = f.read()
+            f.close()
+            return data
+        finally:
+            os.remove(path)
+
+    def run(self, args, data):
+        try:
+            process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            raise TransformError('cannot run %s: %s' % (self.command, e))
+        out, err = process.communicate(data)
+        if process.returncode != 0:
+            raise TransformError('%s exited with status %d: %s' % (self.command,
+                process.returncode, err.decode('utf-8', 'replace').strip()))
+        return out
+
+def parse_transform(spec, image_format='png', tmp_dir=None):
+    """
+    The function for one --transform: gzip or gzip:LEVEL, ungzip,
+    cmd:COMMAND, python:MODULE:FUNCTION. Callables are returned as they are.
+    """
+    if callable(spec):
+        return spec
+    name, arg = spec, None
+    if ':' in spec:
+        name, arg = spec.split(':', 1)
+    if name == 'gzip':
+        try:
+            level = int(arg) if arg else 6
+        except ValueError:
+            level = -1
+        if not 0 <= level <= 9:
+            raise TransformError('gzip level must be between 0 and 9, not %s' % arg)
+        return gzip_tile(level)
+    if name == 'ungzip' and not arg:
+        return ungzip_tile
+    if name == 'cmd' and arg:
+        return ExternalCommand(arg, image_format, tmp_dir)
+    if name == 'python' and arg:
+        try:
+            return import_callable(arg)
+        except ImportError as e:
+            raise TransformError('cannot import %s: %s' % (arg, e))
+    raise TransformError('unknown transform %s' % spec)
+
+class TilePipeline(object):
+    """
+    The transforms applied, in order, to the data of every tile. Each
+    transform is a function taking and returning the tile's bytes. 'auto'
+    stands for the defaults of image_format in FORMAT_TRANSFORMS.
+    """
+    def __init__(self, transforms=None, image_format='png', tmp_dir=None):
+        specs = []
+        for spec in transforms or []:
+            if spec == 'auto':
+                defaults = FORMAT_TRANSFORMS.get(image_format, [])
+                if not defaults:
+                    logger.info('no default transforms for %s tiles' % image_format)
+                specs.extend(defaults)
+            else:
+                specs.append(spec)
+        self.specs = specs
+        self.steps = [parse_transform(spec, image_format, tmp_dir) for spec in specs]
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __call__(self, data):
+        for step in self.steps:
+            data = step(data)
+        return data
+
+    def transform_row(self, row):
+        """ (z, x, y, data) with data transformed """
+        z, x, y, data = row
+        return (z, x, y, self(data))
+
+    def transform_result(self, result):
+        """ A disk_to_mbtiles read result with the data of tiles transformed """
+        if result[0] != 'tile':
+            return result
+        return (result[0], self.transform_row(result[1])) + tuple(result[2:])
+
+def make_pipeline(kwargs, image_format='png'):
+    """ The TilePipeline of the transforms and tmp_dir in kwargs """
+    return TilePipeline(kwargs.get('transforms'), image_format, kwargs.get('tmp_dir'))
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
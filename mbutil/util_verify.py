@@ -0,0 +1,252 @@
+import logging, json, hashlib, threading
+
+logger = logging.getLogger(__name__)
+
+from util import mbtiles_connect, parallel_imap, image_key, has_image_hashes, \
+    image_hash_function
+from util_reader import read_only_connect
+from util_progress import make_progress
+
+# columns of a zoom level hashed per job when hashing tile data by zoom
+COLUMNS_PER_JOB = 64
+
+def tile_digest(z, x, y, tile_hash):
+    """ The contribution of one tile to the checksum of its zoom level """
+    return int(hashlib.md5(('%d/%d/%d/%s' % (z, x, y, tile_hash)).encode()).hexdigest(), 16)
+
+def format_checksum(total):
+    # sums of digests modulo 2 ** 128 do not depend on the order tiles are
+    # hashed in, so chunks hashed in parallel add up to the same checksum
+    return '%032x' % (total % (1 << 128))
+
+class ChunkHasher(object):
+    """
+    Hashes chunks of a file on worker threads, each reading through its
+    own read-only connection.
+    """
+    def __init__(self, mbtiles_file, hash_function='md5', id_hash_function=None):
+        self.mbtiles_file = mbtiles_file
+        self.hash_function = hash_function
+        # the digest tile_ids were made with, when checksums use another one
+        self.id_hash_function = id_hash_function or hash_function
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connection(self):
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = self.local.con = read_only_connect(self.mbtiles_file)
+            self.lock.acquire()
+            self.connections.append(con)
+            self.lock.release()
+        return con
+
+    def digest(self, data):
+        return hashlib.new(self.hash_function, data).hexdigest()
+
+    def id_digest(self, data, tile_hash):
+        if self.id_hash_function == self.hash_function:
+            return tile_hash
+        return hashlib.new(self.id_hash_function, data).hexdigest()
+
+    def check_images(self, job):
+        """ job is a rowid range of images; returns (images hashed, mismatched tile_ids) """
+        low, high = job
+        rows = self.connection().execute("""SELECT tile_id, tile_data FROM images
+            WHERE rowid BETWEEN ? AND ? AND tile_id IS NOT NULL""", (low, high)).fetchall()
+        return len(rows), [tile_id for tile_id, data in rows
+            if hashlib.new(self.id_hash_function, data).hexdigest() != tile_id]
+
+    def check_zoom_range(self, job):
+        """
+        job is (z, first column, last column, key); returns (z, tiles, sum of
+        tile digests, tile_ids of mismatched tiles). Tile data is hashed, and
+        compared with tile_id when the file is compacted with hashes (key is
+        set).
+        """
+        z, low, high = job[:3]
+        key = job[3]
+        if key:
+            rows = self.connection().execute("""SELECT map.zoom_level, map.tile_column,
+                map.tile_row, images.tile_id, images.tile_data FROM map
+                JOIN images ON images.%s = map.%s WHERE map.zoom_level = ?
+                AND map.tile_column BETWEEN ? AND ?""" % (key, key), (z, low, high))
+        else:
+            rows = self.connection().execute("""SELECT zoom_level, tile_column, tile_row,
+                NULL, tile_data FROM tiles WHERE zoom_level = ? AND tile_column BETWEEN ? AND ?""",
+                (z, low, high))
+        count = 0
+        total = 0
+        mismatched = []
+        for z, x, y, tile_id, data in rows:
+            tile_hash = self.digest(data)
+            if tile_id is not None and self.id_digest(data, tile_hash) != tile_id:
+                mismatched.append(tile_id)
+            total += tile_digest(z, x, y, tile_hash)
+            count += 1
+        return z, count, total, mismatched
+
+    def close(self):
+        for con in self.connections:
+            con.close()
+
+def check_references(con, key):
+    """ Problems with map rows pointing at missing images, and images no map row uses """
+    problems = []
+    dangling = con.execute("""SELECT count(*) FROM map LEFT JOIN images
+        ON images.%(key)s = map.%(key)s WHERE map.%(key)s IS NOT NULL
+        AND images.%(key)s IS NULL""" % {'key': key}).fetchone()[0]
+    if dangling:
+        problems.append('%d map rows reference missing images' % dangling)
+    orphans = con.execute("""SELECT count(*) FROM images WHERE %(key)s NOT IN
+        (SELECT %(key)s FROM map WHERE %(key)s IS NOT NULL)""" % {'key': key}).fetchone()[0]
+    if orphans:
+        problems.append('%d images are not referenced by any map row' % orphans)
+    return problems
+
+def zoom_checksums_from_ids(con, key):
+    """ {z: (tiles, checksum sum)} from the image hashes of a compacted file """
+    zooms = {}
+    if key == 'tile_id':
+        rows = con.execute("""SELECT zoom_level, tile_column, tile_row, tile_id FROM map
+            WHERE tile_id IS NOT NULL""")
+    else:
+        rows = con.execute("""SELECT zoom_level, tile_column, tile_row, tile_id FROM map
+            JOIN images ON images.image_id = map.image_id""")
+    for z, x, y, tile_id in rows:
+        count, total = zooms.get(z, (0, 0))
+        zooms[z] = (count + 1, total + tile_digest(z, x, y, tile_id))
+    return zooms
+
+def zoom_jobs(con, zooms, key):
+    """ (z, first column, last column, key) jobs covering the tiles of zooms """
+    for z in zooms:
+        low, high = con.execute("""SELECT min(tile_column), max(tile_column) FROM %s
+            WHERE zoom_level = ?""" % ('map' if key else 'tiles'), (z,)).fetchone()
+        if low is None:
+            continue
+        for column in range(low, high + 1, COLUMNS_PER_JOB):
+            yield (z, column, min(column + COLUMNS_PER_JOB - 1, high), key)
+
+def rowid_jobs(con, chunk_size):
+    low, high = con.execute("SELECT min(rowid), max(rowid) FROM images").fetchone()
+    if low is None:
+        return
+    for start in range(low, high + 1, chunk_size):
+        yield (start, start + chunk_size - 1)
+
+def verify_mbtiles(mbtiles_file, **kwargs):
+    """
+    Check mbtiles_file and return a list of problems, empty when it is
+    sound: PRAGMA quick_check, map rows of a compacted file referencing
+    missing images, images no map row references, and images whose data
+    no longer matches their tile_id hash, made with the digest recorded
+    when the file was compacted. Images are rehashed on worker threads
+    over rowid chunks.
+
+    A manifest of per-zoom checksums over (z, x, y, tile hash) is written
+    to write_manifest. Given check_manifest, zooms whose checksum differs
+    are reported; in a compacted file with hashes, the checksums come from
+    the stored hashes and only the data of those zooms is rehashed, so
+    zooms unchanged since the manifest was made are not read again.
+    """
+    logger.info("Verifying %s" % mbtiles_file)
+    workers = kwargs.get('workers') or 1
+    chunk_size = kwargs.get('chunk_size') or 1000
+    check_manifest = kwargs.get('check_manifest')
+    write_manifest = kwargs.get('write_manifest')
+
+    con = mbtiles_connect(mbtiles_file)
+    problems = []
+    for row in con.execute("PRAGMA quick_check"):
+        if row[0] != 'ok':
+            problems.append('quick_check: %s' % row[0])
+    if problems:
+        con.close()
+        for problem in problems:
+            logger.error(problem)
+        return problems
+
+    key = image_key(con)
+    hashes = has_image_hashes(con)
+    # tile_ids are checked against the digest the file was compacted with
+    id_hash_function = hashes and image_hash_function(con) or None
+    hash_function = kwargs.get('hash_function') or id_hash_function or 'md5'
+    if key:
+        problems.extend(check_references(con, key))
+
+    manifest = None
+    if check_manifest:
+        f = open(check_manifest)
+        manifest = json.load(f)
+        f.close()
+        if manifest.get('hash_function', 'md5') != hash_function:
+            hash_function = manifest.get('hash_function', 'md5')
+            logger.info("using the %s hashes of the manifest" % hash_function)
+
+    hasher = ChunkHasher(mbtiles_file, hash_function, id_hash_function)
+    mismatched_images = 0
+    mismatched_tiles = 0
+    zooms = {}
+    try:
+        if hashes and hash_function == id_hash_function:
+            zooms = zoom_checksums_from_ids(con, key)
+            if manifest is None:
+                total = con.execute("SELECT count(*) FROM images").fetchone()[0]
+                progress = make_progress('verify', kwargs, total)
+                for count, bad in parallel_imap(hasher.check_images, rowid_jobs(con, chunk_size), workers):
+                    mismatched_images += len(bad)
+                    progress.update(count, mismatched=len(bad))
+                progress.done()
+            else:
+                changed = [z for z in sorted(zooms) if format_checksum(zooms[z][1]) !=
+                    manifest['zooms'].get(str(z), {}).get('checksum')]
+                logger.info("rehashing zooms %s" % (', '.join([str(z) for z in changed]) or 'none'))
+                progress = make_progress('verify', kwargs, sum([zooms[z][0] for z in changed]))
+                for z, count, total, bad in parallel_imap(hasher.check_zoom_range,
+                        zoom_jobs(con, changed, key), workers):
+                    mismatched_tiles += len(bad)
+                    progress.update(count, mismatched=len(bad))
+                progress.done()
+        else:
+            # tile data has to be hashed for the checksums of flat files, and
+            # of compacted files whose tile_ids use another digest
+            all_zooms = [r[0] for r in con.execute("SELECT DISTINCT zoom_level FROM %s" %
+                ('map' if key else 'tiles'))]
+            progress = make_progress('verify', kwargs)
+            for z, count, total, bad in parallel_imap(hasher.check_zoom_range,
+                    zoom_jobs(con, all_zooms, key if hashes else None), workers):
+                previous = zooms.get(z, (0, 0))
+                zooms[z] = (previous[0] + count, previous[1] + total)
+                mismatched_tiles += len(bad)
+                progress.update(count, mismatched=len(bad))
+            progress.done()
+    finally:
+        hasher.close()
+        con.close()
+
+    if mismatched_images:
+        problems.append('%d images do not match their %s tile_id' % (mismatched_images,
+            id_hash_function))
+    if mismatched_tiles:
+        problems.append('%d tiles do not match the %s tile_id of their image' % (mismatched_tiles,
+            id_hash_function))
+
+    checksums = dict([(str(z), {'tiles': count, 'checksum': format_checksum(total)})
+        for z, (count, total) in zooms.items()])
+    if manifest is not None:
+        for z in sorted(set(checksums) | set(manifest['zooms']), key=int):
+            if checksums.get(z) != manifest['zooms'].get(z):
+                problems.append('zoom %s differs from the manifest' % z)
+    if write_manifest:
+        f = open(write_manifest, 'w')
+        json.dump({'hash_function': hash_function, 'zooms': checksums}, f, indent=4, sort_keys=True)
+        f.close()
+        logger.info("manifest written to %s" % write_manifest)
+
+    for problem in problems:
+        logger.error(problem)
+    if not problems:
+        logger.info("%s is sound" % mbtiles_file)
+    return problems
@@ -1,7 +1,23 @@
 import os, shutil
 import json
+import zlib
+import threading
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
 from nose import with_setup
-from mbutil import mbtiles_to_disk, disk_to_mbtiles
+import sqlite3
+from mbutil import mbtiles_to_disk, disk_to_mbtiles, mbtiles_setup, iter_grids, tile_path, \
+    DuplicateLinker, ordered_imap
+from mbutil.util_compact import compact_mbtiles, compact_mbtiles_to_file
+from mbutil import merge_mbtiles, diff_mbtiles, split_mbtiles, merge_shards, \
+    verify_mbtiles, gc_mbtiles, mbtiles_stats, MBTilesReader
+from mbutil.proj import GoogleProjection
+from mbutil.util_coverage import TileCoverage
+from mbutil.util_serve import make_tile_server
+from mbutil.util_transform import TilePipeline
+from mbutil.util_order import hilbert_index, zorder_index
 
 def clear_data():
     try: shutil.rmtree('test/output')
@@ -49,3 +65,706 @@ def test_mbtiles_to_disk_utfgrid_callback():
         f.close()
     assert callback['foo'] == 'foo('
     assert callback['null'] == ''
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_parallel():
+    os.mkdir('test/output')
+    mbtiles_to_disk('test/data/utf8grid.mbtiles', 'test/output/original', callback=None)
+    disk_to_mbtiles('test/output/original/', 'test/output/imported.mbtiles', workers=4, batch_size=1)
+    con = sqlite3.connect('test/output/imported.mbtiles')
+    assert con.execute('select count(*) from tiles').fetchone()[0] == 1
+    assert con.execute('select count(*) from grids').fetchone()[0] == 1
+    assert con.execute('select count(*) from grid_data').fetchone()[0] > 0
+    con.close()
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_parallel():
+    mbtiles_to_disk('test/data/utf8grid.mbtiles', 'test/output', workers=4)
+    assert os.path.exists('test/output/0/0/0.png')
+    assert os.path.exists('test/output/0/0/0.grid.json')
+
+def test_iter_grids_merges_grid_data():
+    con = sqlite3.connect(':memory:')
+    mbtiles_setup(con.cursor())
+    for z, x, y in [(1, 1, 0), (0, 0, 0), (1, 0, 1)]:
+        con.execute('insert into grids values (?, ?, ?, ?)', (z, x, y, 'g%d%d%d' % (z, x, y)))
+    con.execute('insert into grid_data values (1, 1, 0, ?, ?)', ('a', '{"n": 1}'))
+    con.execute('insert into grid_data values (1, 1, 0, ?, ?)', ('b', '{"n": 2}'))
+    con.execute('insert into grid_data values (0, 0, 0, ?, ?)', ('c', '{"n": 3}'))
+    grids = list(iter_grids(con))
+    assert [g[:4] for g in grids] == [(0, 0, 0, 'g000'), (1, 0, 1, 'g101'), (1, 1, 0, 'g110')]
+    assert [g[4] for g in grids] == [{'c': {'n': 3}}, {}, {'a': {'n': 1}, 'b': {'n': 2}}]
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_incremental():
+    os.mkdir('test/output')
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output/tiles')
+    disk_to_mbtiles('test/output/tiles/', 'test/output/out.mbtiles', format='png', incremental=True)
+    os.makedirs('test/output/tiles/3/0')
+    open('test/output/tiles/3/0/0.png', 'wb').write(b'new')
+    open('test/output/tiles/0/0/0.png', 'wb').write(b'changed')
+    disk_to_mbtiles('test/output/tiles/', 'test/output/out.mbtiles', format='png', incremental=True)
+    con = sqlite3.connect('test/output/out.mbtiles')
+    tiles = con.execute('select zoom_level, tile_column, tile_row, tile_data from tiles order by zoom_level').fetchall()
+    assert [t[:3] for t in tiles] == [(0, 0, 0), (1, 0, 1), (3, 0, 0)]
+    assert bytes(tiles[0][3]) == b'changed' and bytes(tiles[2][3]) == b'new'
+    assert con.execute('select count(*) from import_manifest').fetchone()[0] == 3
+    con.close()
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_incremental_compacted():
+    os.mkdir('test/output')
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output/tiles')
+    # one_tile.mbtiles is already compacted by node-mbtiles
+    shutil.copy('test/data/one_tile.mbtiles', 'test/output/out.mbtiles')
+    os.makedirs('test/output/tiles/2/1')
+    shutil.copy('test/output/tiles/0/0/0.png', 'test/output/tiles/2/1/1.png')
+    disk_to_mbtiles('test/output/tiles/', 'test/output/out.mbtiles', format='png', incremental=True, manifest='hash')
+    con = sqlite3.connect('test/output/out.mbtiles')
+    assert con.execute('select count(*) from map').fetchone()[0] == 3
+    assert con.execute('select count(*) from images').fetchone()[0] == 2
+    con.close()
+    # a changed tile replaces its image instead of adding one every import
+    for data in (b'changed', b'changed again'):
+        open('test/output/tiles/2/1/1.png', 'wb').write(data)
+        disk_to_mbtiles('test/output/tiles/', 'test/output/out.mbtiles', format='png', incremental=True)
+    con = sqlite3.connect('test/output/out.mbtiles')
+    assert con.execute('select count(*) from map').fetchone()[0] == 3
+    images = [bytes(r[0]) for r in con.execute('select tile_data from images')]
+    assert len(images) == 3 and b'changed again' in images and b'changed' not in images
+    con.close()
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_incremental_grid_views():
+    os.mkdir('test/output')
+    mbtiles_to_disk('test/data/utf8grid.mbtiles', 'test/output/tiles', callback=None)
+    shutil.copy('test/data/utf8grid.mbtiles', 'test/output/out.mbtiles')
+    os.makedirs('test/output/tiles/1/0')
+    shutil.copy('test/output/tiles/0/0/0.grid.json', 'test/output/tiles/1/0/0.grid.json')
+    disk_to_mbtiles('test/output/tiles/', 'test/output/out.mbtiles', format='png', incremental=True)
+    con = sqlite3.connect('test/output/out.mbtiles')
+    assert con.execute('select count(*) from grids').fetchone()[0] == 2
+    assert con.execute('select count(*) from tiles').fetchone()[0] == 1
+    con.close()
+    mbtiles_to_disk('test/output/out.mbtiles', 'test/output/exported', callback=None)
+    grid = json.load(open('test/output/exported/1/0/0.grid.json'))
+    assert grid['data']['77'] == {u'ISO_A2': u'FR'}
+
+@with_setup(clear_data, clear_data)
+def test_compact_mbtiles_parallel():
+    os.mkdir('test/output')
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    mbtiles_setup(con.cursor())
+    for i in range(250):
+        con.execute('insert into tiles values (?, ?, ?, ?)', (8, i, 0, sqlite3.Binary(b'tile %d' % (i % 7))))
+    con.commit()
+    con.close()
+    compact_mbtiles('test/output/flat.mbtiles', workers=4, chunk_size=10, hash_function='sha1')
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert con.execute('select count(*) from images').fetchone()[0] == 7
+    assert con.execute('select count(*) from map').fetchone()[0] == 250
+    assert bytes(con.execute('select tile_data from tiles where tile_column = 15').fetchone()[0]) == b'tile 1'
+    assert con.execute("select value from metadata where name = 'mbutil_hash'").fetchone()[0] == 'sha1'
+    con.close()
+    # later writers hash with the digest the file was compacted with
+    make_flat_mbtiles('test/output/update.mbtiles', [(8, 300, 0, b'tile 1')])
+    merge_mbtiles('test/output/update.mbtiles', 'test/output/flat.mbtiles')
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert con.execute('select count(*) from images').fetchone()[0] == 7
+    con.close()
+    compact_mbtiles_to_file('test/output/update.mbtiles', 'test/output/md5.mbtiles')
+    try:
+        merge_mbtiles('test/output/md5.mbtiles', 'test/output/flat.mbtiles')
+        assert False, 'tile_ids of different digests cannot be merged'
+    except SystemExit:
+        pass
+
+@with_setup(clear_data, clear_data)
+def test_compact_mbtiles_to_file():
+    os.mkdir('test/output')
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    mbtiles_setup(con.cursor())
+    for i in range(50):
+        con.execute('insert into tiles values (?, ?, ?, ?)', (6, i, 1, sqlite3.Binary(b'tile %d' % (i % 3))))
+    con.execute('insert into metadata values (?, ?)', ('name', 'flat'))
+    con.commit()
+    con.close()
+    compact_mbtiles_to_file('test/output/flat.mbtiles', 'test/output/compact.mbtiles', workers=2, chunk_size=7)
+    con = sqlite3.connect('test/output/compact.mbtiles')
+    assert con.execute('select count(*) from images').fetchone()[0] == 3
+    assert con.execute('select count(*) from map').fetchone()[0] == 50
+    assert con.execute('select typeof(image_id) from map limit 1').fetchone()[0] == 'integer'
+    assert bytes(con.execute('select tile_data from tiles where tile_column = 4').fetchone()[0]) == b'tile 1'
+    assert con.execute('select value from metadata where name = ?', ('name',)).fetchone()[0] == 'flat'
+    con.close()
+    os.makedirs('test/output/tiles/6/60')
+    open('test/output/tiles/6/60/1.png', 'wb').write(b'tile 2')
+    disk_to_mbtiles('test/output/tiles/', 'test/output/compact.mbtiles', format='png', incremental=True)
+    con = sqlite3.connect('test/output/compact.mbtiles')
+    assert con.execute('select count(*) from images').fetchone()[0] == 3
+    assert bytes(con.execute('select tile_data from tiles where tile_column = 60').fetchone()[0]) == b'tile 2'
+    con.close()
+
+def make_flat_mbtiles(path, tiles):
+    con = sqlite3.connect(path)
+    mbtiles_setup(con.cursor())
+    for z, x, y, data in tiles:
+        con.execute('insert into tiles values (?, ?, ?, ?)', (z, x, y, sqlite3.Binary(data)))
+    con.commit()
+    con.close()
+
+@with_setup(clear_data, clear_data)
+def test_merge_mbtiles_into_compacted():
+    os.mkdir('test/output')
+    make_flat_mbtiles('test/output/dest_flat.mbtiles', [(1, 0, 0, b'a'), (1, 0, 1, b'b'), (1, 1, 1, b'a')])
+    compact_mbtiles('test/output/dest_flat.mbtiles')
+    make_flat_mbtiles('test/output/update_flat.mbtiles', [(1, 0, 1, b'c'), (1, 1, 0, b'a'), (5, 0, 0, b'd')])
+    compact_mbtiles_to_file('test/output/update_flat.mbtiles', 'test/output/update.mbtiles')
+    merge_mbtiles('test/output/update.mbtiles', 'test/output/dest_flat.mbtiles', zoom_range=range(0, 2))
+    con = sqlite3.connect('test/output/dest_flat.mbtiles')
+    tiles = con.execute('select zoom_level, tile_column, tile_row, tile_data from tiles order by 1, 2, 3').fetchall()
+    assert [(t[0], t[1], t[2], bytes(t[3])) for t in tiles] == \
+        [(1, 0, 0, b'a'), (1, 0, 1, b'c'), (1, 1, 0, b'a'), (1, 1, 1, b'a')]
+    # b is no longer referenced, c was copied and a was not copied again
+    assert sorted([bytes(r[0]) for r in con.execute('select tile_data from images')]) == [b'a', b'c']
+    con.close()
+    # map of files with integer image ids is indexed for the orphan lookups,
+    # and the index is dropped afterwards unless keep_index is set
+    make_flat_mbtiles('test/output/replace.mbtiles', [(1, 0, 1, b'a')])
+    merge_mbtiles('test/output/replace.mbtiles', 'test/output/update.mbtiles')
+    con = sqlite3.connect('test/output/update.mbtiles')
+    assert sorted([bytes(r[0]) for r in con.execute('select tile_data from images')]) == [b'a', b'd']
+    assert con.execute("select count(*) from sqlite_master where name = 'map_image_id_gc'").fetchone()[0] == 0
+    con.close()
+    make_flat_mbtiles('test/output/replace_again.mbtiles', [(5, 0, 0, b'a')])
+    merge_mbtiles('test/output/replace_again.mbtiles', 'test/output/update.mbtiles', keep_index=True)
+    con = sqlite3.connect('test/output/update.mbtiles')
+    assert [bytes(r[0]) for r in con.execute('select tile_data from images')] == [b'a']
+    assert con.execute("select count(*) from sqlite_master where name = 'map_image_id_gc'").fetchone()[0] == 1
+    con.close()
+
+@with_setup(clear_data, clear_data)
+def test_merge_mbtiles_into_flat():
+    os.mkdir('test/output')
+    make_flat_mbtiles('test/output/dest.mbtiles', [(0, 0, 0, b'a')])
+    merge_mbtiles('test/data/one_tile.mbtiles', 'test/output/dest.mbtiles')
+    con = sqlite3.connect('test/output/dest.mbtiles')
+    assert con.execute('select count(*) from tiles').fetchone()[0] == 2
+    assert len(con.execute('select tile_data from tiles where zoom_level = 0').fetchone()[0]) == 70734
+    con.close()
+    # files from other tools may lack tile_index, and hold duplicates
+    con = sqlite3.connect('test/output/plain.mbtiles')
+    con.execute('create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+    con.executemany('insert into tiles values (?, ?, ?, ?)', [(1, 0, 0, b'old'), (1, 0, 0, b'older'),
+        (1, 1, 0, b'b')])
+    con.commit()
+    con.close()
+    make_flat_mbtiles('test/output/update.mbtiles', [(1, 0, 0, b'new')])
+    merge_mbtiles('test/output/update.mbtiles', 'test/output/plain.mbtiles')
+    assert flat_tiles('test/output/plain.mbtiles') == [(1, 0, 0, b'new'), (1, 1, 0, b'b')]
+
+def test_projection_batch_matches_scalar():
+    proj = GoogleProjection(256, range(0, 9), 'tms')
+    lngs = [-179.5, -71.06, 0.0, 2.35, 139.7]
+    lats = [-84.0, 42.36, 0.0, 48.86, 35.7]
+    for z in (0, 5, 8):
+        xs, ys = proj.project_pixels_many(lngs, lats, z)
+        assert [(float(x), float(y)) for x, y in zip(xs, ys)] == \
+            [proj.project_pixels(ll, z) for ll in zip(lngs, lats)]
+        cols, rows = proj.tiles_at_many(lngs, lats, z)
+        assert [(z, int(c), int(r)) for c, r in zip(cols, rows)] == \
+            [proj.tile_at(z, ll) for ll in zip(lngs, lats)]
+
+def test_projection_tileschunks():
+    proj = GoogleProjection(256, range(0, 9), 'tms')
+    bbox = (-10.5, 35.2, 4.3, 44.1)
+    tiles = proj.tileslist(bbox)
+    assert len(tiles) == len(set(tiles)) > 100
+    chunked = []
+    for chunk in proj.tileschunks(bbox, chunk_size=17):
+        assert len(chunk) <= 17
+        chunked.extend([tuple(int(v) for v in t) for t in chunk])
+    assert chunked == tiles
+    # the --bbox filters pad the ranges by a tile east and south (a lower tms row)
+    ranges = proj.tileranges(bbox)
+    for z in range(0, 9):
+        xs = [x for tz, x, y in tiles if tz == z]
+        ys = [y for tz, x, y in tiles if tz == z]
+        assert ranges[z]['x'] == (min(xs), max(xs) + 1)
+        assert ranges[z]['y'] == [min(ys) - 1, max(ys)]
+
+def test_tile_coverage_masks():
+    square = {'type': 'Polygon', 'coordinates': [[[10, -20], [20, -20], [20, -10], [10, -10], [10, -20]]]}
+    coverage = TileCoverage.from_geojson({'type': 'Feature', 'geometry': square}, range(0, 9))
+    proj = GoogleProjection(256, range(0, 9), 'tms')
+    for z in range(0, 9):
+        assert coverage.count(z) == len([t for t in proj.tileslist((10, -20, 20, -10)) if t[0] == z])
+    assert coverage.contains(0, 0, 0) and coverage.contains(1, 1, 0)
+    assert not coverage.contains(1, 0, 1)
+    assert coverage.contains(12, 2218, 1875) and not coverage.contains(12, 2218, 1754)
+    assert coverage.covers_column(1, 1) and not coverage.covers_column(1, 0)
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_coverage():
+    square = {'type': 'Polygon', 'coordinates': [[[10, -20], [20, -20], [20, -10], [10, -10], [10, -20]]]}
+    coverage = TileCoverage.from_geojson(square, range(0, 2))
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output', coverage=coverage)
+    assert os.path.exists('test/output/0/0/0.png')
+    assert not os.path.exists('test/output/1')
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_reader_layouts():
+    os.mkdir('test/output')
+    make_flat_mbtiles('test/output/flat.mbtiles', [(0, 0, 0, b'a'), (1, 0, 1, b'b')])
+    compact_mbtiles_to_file('test/data/one_tile.mbtiles', 'test/output/image_id.mbtiles')
+    for path, layout in [('test/output/flat.mbtiles', None),
+            ('test/data/one_tile.mbtiles', 'tile_id'),
+            ('test/output/image_id.mbtiles', 'image_id')]:
+        reader = MBTilesReader(path)
+        assert reader.layout == layout
+        assert reader.get_tile(0, 0, 0) is not None
+        assert reader.get_tile(5, 0, 0) is None
+        tiles = list(reader.get_tiles([(1, 0, 1), (5, 0, 0), (0, 0, 0)]))
+        assert [t[:3] for t in tiles] == [(1, 0, 1), (5, 0, 0), (0, 0, 0)]
+        assert tiles[1][3] is None and tiles[2][3] == reader.get_tile(0, 0, 0)
+        reader.close()
+
+def test_mbtiles_reader_cache():
+    reader = MBTilesReader('test/data/one_tile.mbtiles', cache_size=1)
+    tile_id, tile_data = reader.get_tile_and_id(0, 0, 0)
+    assert len(tile_id) == 32 and len(tile_data) == 70734
+    reader.get_tile(0, 0, 0)
+    assert reader.cache_info()['hits'] == 1 and reader.cache_info()['misses'] == 1
+    reader.get_tile(1, 0, 1)
+    reader.get_tile(0, 0, 0)
+    assert reader.cache_info() == {'hits': 1, 'misses': 3, 'size': 1, 'max_size': 1}
+    reader.close()
+
+def test_serve_etags():
+    server = make_tile_server('test/data/one_tile.mbtiles', '127.0.0.1', 0, workers=2)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    con = HTTPConnection('127.0.0.1', server.server_address[1])
+    def get(path, headers={}):
+        con.request('GET', path, headers=headers)
+        response = con.getresponse()
+        return response.status, response.getheader('ETag'), response.read()
+    try:
+        status, etag, body = get('/1/0/0.png')
+        assert status == 200 and len(body) > 0
+        assert etag.strip('"') == server.reader.get_tile_id(1, 0, 1)
+        assert get('/1/0/0.png', {'If-None-Match': etag})[:2] == (304, etag)
+        con.request('GET', '/1/0/0.png', headers={'If-None-Match': etag})
+        response = con.getresponse()
+        response.read()
+        assert response.getheader('Content-Length') is None
+        assert get('/1/0/1.png')[0] == 404
+        assert get('/metadata.json')[0] == 200
+    finally:
+        con.close()
+        server.shutdown()
+        server.server_close()
+        server.reader.close()
+
+@with_setup(clear_data, clear_data)
+def test_archive_export_and_import():
+    os.mkdir('test/output')
+    for archive in ['tiles.tar', 'tiles.tar.gz', 'tiles.zip']:
+        path = 'test/output/%s' % archive
+        mbtiles_to_disk('test/data/utf8grid.mbtiles', path, callback=None)
+        assert os.path.isfile(path) and not os.path.exists('test/output/0')
+        disk_to_mbtiles(path, 'test/output/%s.mbtiles' % archive)
+        con = sqlite3.connect('test/output/%s.mbtiles' % archive)
+        assert con.execute('select count(*) from tiles').fetchone()[0] == 1
+        assert con.execute('select count(*) from grids').fetchone()[0] == 1
+        assert con.execute("select value from metadata where name = 'name'").fetchone() is not None
+        con.close()
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_link_duplicates():
+    os.mkdir('test/output')
+    make_flat_mbtiles('test/output/flat.mbtiles',
+        [(2, 0, 0, b'ocean'), (2, 1, 0, b'land'), (2, 2, 0, b'ocean'), (2, 3, 0, b'ocean')])
+    compact_mbtiles_to_file('test/output/flat.mbtiles', 'test/output/compact.mbtiles')
+    mbtiles_to_disk('test/output/compact.mbtiles', 'test/output/hard', link_duplicates='hard', workers=2)
+    ocean = [os.stat('test/output/hard/2/%d/0.png' % x) for x in (0, 2, 3)]
+    assert len(set([(st.st_dev, st.st_ino) for st in ocean])) == 1 and ocean[0].st_nlink == 3
+    assert os.stat('test/output/hard/2/1/0.png').st_nlink == 1
+    mbtiles_to_disk('test/output/compact.mbtiles', 'test/output/soft', link_duplicates='symlink')
+    links = [os.path.islink('test/output/soft/2/%d/0.png' % x) for x in (0, 2, 3)]
+    assert sorted(links) == [False, True, True]
+    assert open('test/output/soft/2/3/0.png', 'rb').read() == b'ocean'
+    # links waiting for an image whose write failed fail too, instead of waiting forever
+    linker = DuplicateLinker()
+    errors = []
+    def link():
+        try:
+            linker(('link', 'test/output/hard/link.png', 'test/output/missing/0.png'))
+        except OSError as e:
+            errors.append(e)
+    t = threading.Thread(target=link)
+    t.start()
+    try:
+        linker(('write', 'test/output/missing/0.png', b'ocean'))
+        assert False, 'the directory does not exist'
+    except (IOError, OSError):
+        pass
+    t.join(5)
+    assert not t.is_alive() and len(errors) == 1
+
+def test_ordered_imap_bounded():
+    # a slow first item holds up the input instead of buffering every result after it
+    release = threading.Event()
+    taken = []
+    def items():
+        for i in range(50):
+            taken.append(i)
+            yield i
+    def slow_first(i):
+        if i == 0:
+            release.wait(5)
+        return i * 2
+    results = []
+    t = threading.Thread(target=lambda: results.extend(ordered_imap(slow_first, items(), 4)))
+    t.start()
+    t.join(0.5)
+    assert len(taken) <= 8
+    release.set()
+    t.join(5)
+    assert results == [i * 2 for i in range(50)]
+
+@with_setup(clear_data, clear_data)
+def test_progress_callback():
+    events = []
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output', progress_callback=events.append)
+    done = events[-1]
+    assert done['operation'] == 'export' and done['event'] == 'done'
+    assert done['count'] == done['total'] == 2 and done['bytes'] > 70734
+    assert 'write' in done['stages']
+    disk_to_mbtiles('test/output', 'test/output/one.mbtiles', progress_callback=events.append,
+        progress_interval=0)
+    imported = [e for e in events if e['operation'] == 'import']
+    assert imported[-1]['event'] == 'done' and imported[-1]['count'] == 2
+    assert len(imported) > 1
+    for stage in ('scan', 'read', 'write', 'commit'):
+        assert stage in imported[-1]['stages']
+
+@with_setup(clear_data, clear_data)
+def test_transform_pipeline():
+    os.mkdir('test/output')
+    vector = b'{"layer": "roads"}' * 20
+    gzipped = TilePipeline(['gzip:1'])(vector)
+    make_flat_mbtiles('test/output/flat.mbtiles', [(1, 0, 0, vector), (1, 0, 1, gzipped), (1, 1, 1, b'x')])
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    con.execute("insert into metadata values ('format', 'pbf')")
+    con.commit()
+    con.close()
+    compact_mbtiles_to_file('test/output/flat.mbtiles', 'test/output/compact.mbtiles',
+        transforms=['auto'], workers=2)
+    con = sqlite3.connect('test/output/compact.mbtiles')
+    # both encodings of the vector tile are one image once recompressed
+    assert con.execute('select count(*) from images').fetchone()[0] == 2
+    data = con.execute('select tile_data from tiles where tile_row = 0').fetchone()[0]
+    con.close()
+    assert zlib.decompress(bytes(data), 16 + zlib.MAX_WBITS) == vector
+    mbtiles_to_disk('test/output/compact.mbtiles', 'test/output/tiles', format='pbf')
+    disk_to_mbtiles('test/output/tiles', 'test/output/plain.mbtiles', format='pbf',
+        transforms=['ungzip', 'cmd:tr a-z A-Z'], workers=2)
+    con = sqlite3.connect('test/output/plain.mbtiles')
+    tiles = dict(((r[0], r[1], r[2]), bytes(r[3])) for r in con.execute('select * from tiles'))
+    con.close()
+    assert tiles[(1, 0, 0)] == vector.upper() and tiles[(1, 1, 1)] == b'X'
+
+@with_setup(clear_data, clear_data)
+def test_diff_and_merge_patch():
+    os.mkdir('test/output')
+    old = [(1, 0, 0, b'a'), (1, 0, 1, b'b'), (1, 1, 0, b'c'), (2, 3, 3, b'd')]
+    new = [(0, 0, 0, b'z'), (1, 0, 0, b'a'), (1, 0, 1, b'B'), (2, 3, 3, b'd'), (3, 7, 7, b'a')]
+    make_flat_mbtiles('test/output/old.mbtiles', old)
+    make_flat_mbtiles('test/output/new.mbtiles', new)
+    for name in ('old', 'new'):
+        compact_mbtiles_to_file('test/output/%s.mbtiles' % name, 'test/output/%s_compact.mbtiles' % name)
+    # the stored hashes of files compacted with different digests are not compared
+    compact_mbtiles_to_file('test/output/old.mbtiles', 'test/output/old_mixed.mbtiles', hash_function='sha1')
+    compact_mbtiles_to_file('test/output/new.mbtiles', 'test/output/new_mixed.mbtiles')
+    for suffix in ('', '_compact', '_mixed'):
+        patch = 'test/output/patch%s.mbtiles' % suffix
+        diff_mbtiles('test/output/old%s.mbtiles' % suffix, 'test/output/new%s.mbtiles' % suffix,
+            patch, workers=2)
+        con = sqlite3.connect(patch)
+        assert sorted(con.execute('select * from deleted_tiles').fetchall()) == [(1, 1, 0)]
+        assert sorted([(r[0], r[1], r[2], bytes(r[3])) for r in con.execute('select * from tiles')]) == \
+            [(0, 0, 0, b'z'), (1, 0, 1, b'B'), (3, 7, 7, b'a')]
+        assert con.execute("select value from metadata where name = 'mbutil_hash'").fetchone()[0] == \
+            ('sha1' if suffix == '_mixed' else 'md5')
+        con.close()
+        merge_mbtiles(patch, 'test/output/old%s.mbtiles' % suffix)
+        con = sqlite3.connect('test/output/old%s.mbtiles' % suffix)
+        assert sorted([(r[0], r[1], r[2], bytes(r[3])) for r in con.execute('select * from tiles')]) == new
+        con.close()
+
+@with_setup(clear_data, clear_data)
+def test_split_and_merge_shards():
+    os.mkdir('test/output')
+    tiles = [(z, x, y, ('%d/%d/%d' % (z, x, y % 2)).encode())
+        for z in range(4) for x in range(2 ** z) for y in range(2 ** z)]
+    make_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    compact_mbtiles_to_file('test/output/flat.mbtiles', 'test/output/compact.mbtiles')
+    for name in ('flat', 'compact'):
+        source = 'test/output/%s.mbtiles' % name
+        shards = split_mbtiles(source, 'test/output/zooms_%s' % name, zoom_bands=[(0, 1), (2, 3)])
+        assert len(shards) == 2
+        con = sqlite3.connect(shards[1])
+        metadata = dict(con.execute('select name, value from metadata'))
+        assert con.execute('select count(*) from tiles').fetchone()[0] == 16 + 64
+        con.close()
+        assert (metadata['minzoom'], metadata['maxzoom']) == ('2', '3')
+        assert [round(float(v)) for v in metadata['bounds'].split(',')] == [-180, -85, 180, 85]
+        shards = split_mbtiles(source, 'test/output/quads_%s' % name, prefix_zoom=1, workers=2)
+        assert len(shards) == 5
+        con = sqlite3.connect([s for s in shards if s.endswith('-1-0-0.mbtiles')][0])
+        assert con.execute('select count(*) from tiles').fetchone()[0] == 1 + 4 + 16
+        # the north west quarter of the world
+        bounds = dict(con.execute('select name, value from metadata'))['bounds']
+        assert [round(float(v)) for v in bounds.split(',')] == [-180, 0, 0, 85]
+        con.close()
+        merge_shards(shards, 'test/output/joined_%s.mbtiles' % name)
+        con = sqlite3.connect('test/output/joined_%s.mbtiles' % name)
+        assert sorted([(r[0], r[1], r[2], bytes(r[3])) for r in con.execute('select * from tiles')]) == tiles
+        con.close()
+        merge_shards(shards, 'test/output/joined_%s_z2.mbtiles' % name, zoom_range=range(0, 3))
+        con = sqlite3.connect('test/output/joined_%s_z2.mbtiles' % name)
+        assert sorted([(r[0], r[1], r[2], bytes(r[3])) for r in con.execute('select * from tiles')]) == \
+            [t for t in tiles if t[0] <= 2]
+        if name == 'compact':
+            # images of the tiles left out are not copied either
+            assert con.execute('select count(*) from images').fetchone()[0] == \
+                len(set([t[3] for t in tiles if t[0] <= 2]))
+        con.close()
+
+@with_setup(clear_data, clear_data)
+def test_verify_mbtiles():
+    os.mkdir('test/output')
+    assert verify_mbtiles('test/data/one_tile.mbtiles') == []
+    tiles = [(z, x, 0, ('%d/%d' % (z, x % 3)).encode()) for z in range(4) for x in range(2 ** z)]
+    make_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    assert verify_mbtiles('test/output/flat.mbtiles', write_manifest='test/output/flat.json', workers=2) == []
+    compact_mbtiles_to_file('test/output/flat.mbtiles', 'test/output/compact.mbtiles')
+    # the checksums of the stored hashes match those of the flat file's data
+    assert verify_mbtiles('test/output/compact.mbtiles', check_manifest='test/output/flat.json') == []
+    # tile_ids are checked with the digest the file was compacted with
+    compact_mbtiles_to_file('test/output/flat.mbtiles', 'test/output/sha1.mbtiles', hash_function='sha1')
+    assert verify_mbtiles('test/output/sha1.mbtiles') == []
+    assert verify_mbtiles('test/output/sha1.mbtiles', check_manifest='test/output/flat.json') == []
+    con = sqlite3.connect('test/output/compact.mbtiles')
+    con.execute("update images set tile_data = ? where tile_id = (select tile_id from images limit 1)",
+        (sqlite3.Binary(b'corrupt'),))
+    con.execute("insert into images (tile_id, tile_data) values ('unused', ?)", (sqlite3.Binary(b'x'),))
+    con.execute("update map set image_id = 999 where zoom_level = 3 and tile_column = 7")
+    con.commit()
+    con.close()
+    problems = verify_mbtiles('test/output/compact.mbtiles', workers=2)
+    assert len(problems) == 3, problems
+    problems = verify_mbtiles('test/output/compact.mbtiles', check_manifest='test/output/flat.json')
+    assert 'zoom 3 differs from the manifest' in problems and 'zoom 0 differs from the manifest' not in problems
+
+@with_setup(clear_data, clear_data)
+def test_gc_mbtiles():
+    os.mkdir('test/output')
+    tiles = [(z, x, 0, ('%d/%d' % (z, x)).encode() * 500) for z in range(5) for x in range(2 ** z)]
+    make_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    compact_mbtiles_to_file('test/output/flat.mbtiles', 'test/output/compact.mbtiles')
+    con = sqlite3.connect('test/output/compact.mbtiles')
+    assert con.execute("pragma auto_vacuum").fetchone()[0] == 2
+    con.execute("delete from map where zoom_level = 4")
+    con.commit()
+    pages = con.execute("pragma page_count").fetchone()[0]
+    con.close()
+    assert gc_mbtiles('test/output/compact.mbtiles', batch_size=5) == 16
+    con = sqlite3.connect('test/output/compact.mbtiles')
+    assert con.execute("select count(*) from images").fetchone()[0] == 15
+    assert con.execute("pragma page_count").fetchone()[0] < pages
+    assert con.execute("pragma freelist_count").fetchone()[0] == 0
+    # the index built to find unreferenced images is dropped again
+    assert [r for r in con.execute("pragma index_list(map)") if r[1] == "map_image_id_gc"] == []
+    con.close()
+    assert verify_mbtiles('test/output/compact.mbtiles') == []
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_schemes():
+    os.mkdir('test/output')
+    tiles = [(z, x, y, ('%d/%d/%d' % (z, x, y)).encode()) for z in range(3)
+        for x in range(2 ** z) for y in range(2 ** z)]
+    make_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    # mbtiles_to_disk does not write the zyx and ags layouts
+    layouts = {'zyx': lambda z, x, y: '%d/%d/%d.png' % (z, 2 ** z - 1 - y, x),
+        'ags': lambda z, x, y: 'L%02d/R%08x/C%08x.png' % (z, 2 ** z - 1 - y, x)}
+    for scheme in ('tms', 'xyz', 'zyx', 'ags', 'wms'):
+        directory = 'test/output/%s' % scheme
+        if scheme in layouts:
+            for z, x, y, data in tiles:
+                path = os.path.join(directory, layouts[scheme](z, x, y))
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, 'wb').write(data)
+            stray = os.path.dirname(os.path.join(directory, layouts[scheme](2, 1, 1)))
+        else:
+            mbtiles_to_disk('test/output/flat.mbtiles', directory, scheme=scheme)
+            stray = os.path.dirname(os.path.join(directory, tile_path(2, 1, 1, 'png', scheme)))
+        # stray files are skipped rather than breaking the import
+        open(os.path.join(directory, 'README'), 'w').close()
+        open(os.path.join(stray, 'Thumbs'), 'w').close()
+        disk_to_mbtiles(directory, 'test/output/%s.mbtiles' % scheme, scheme=scheme)
+        con = sqlite3.connect('test/output/%s.mbtiles' % scheme)
+        rows = [(z, x, y, bytes(data)) for z, x, y, data in con.execute('select * from tiles')]
+        con.close()
+        assert sorted(rows) == sorted(tiles), scheme
+    # the walker prunes by bbox before listing directories
+    disk_to_mbtiles('test/output/wms', 'test/output/bbox.mbtiles', scheme='wms',
+        bbox=[0.1, 0.1, 179, 85], zoom_range=range(1, 3))
+    con = sqlite3.connect('test/output/bbox.mbtiles')
+    assert sorted(con.execute('select zoom_level, tile_column, tile_row from tiles').fetchall()) == \
+        sorted([(z, x, y) for z, x, y, data in tiles if z > 0 and x >= 2 ** (z - 1)])
+    con.close()
+
+class Interrupted(Exception):
+    pass
+
+def run_interrupted(func, *args, **kwargs):
+    """ Run func until progress reaches 10 tiles, as if it were killed there """
+    def callback(event):
+        if event['count'] >= 10:
+            raise Interrupted()
+    try:
+        func(*args, progress_callback=callback, progress_interval=0, **kwargs)
+    except Interrupted:
+        pass
+    else:
+        assert False, 'not interrupted'
+
+def flat_tiles(path):
+    con = sqlite3.connect(path)
+    rows = sorted([(z, x, y, bytes(data)) for z, x, y, data in con.execute('select * from tiles')])
+    con.close()
+    return rows
+
+@with_setup(clear_data, clear_data)
+def test_resume_interrupted():
+    os.mkdir('test/output')
+    tiles = [(z, x, y, ('%d' % (x % 2)).encode()) for z in range(3)
+        for x in range(2 ** z) for y in range(2 ** z)]
+    make_flat_mbtiles('test/output/flat.mbtiles', tiles)
+
+    run_interrupted(mbtiles_to_disk, 'test/output/flat.mbtiles', 'test/output/tiles', batch_size=4)
+    assert os.path.exists('test/output/tiles/.mbutil-checkpoint.json')
+    mbtiles_to_disk('test/output/flat.mbtiles', 'test/output/tiles', resume=True, batch_size=4)
+    assert not os.path.exists('test/output/tiles/.mbutil-checkpoint.json')
+
+    run_interrupted(disk_to_mbtiles, 'test/output/tiles', 'test/output/imported.mbtiles', batch_size=4)
+    con = sqlite3.connect('test/output/imported.mbtiles')
+    assert con.execute("select count(*) from checkpoints").fetchone()[0] > 0
+    con.close()
+    disk_to_mbtiles('test/output/tiles', 'test/output/imported.mbtiles', resume=True, batch_size=4)
+    assert flat_tiles('test/output/imported.mbtiles') == sorted(tiles)
+
+    run_interrupted(compact_mbtiles, 'test/output/imported.mbtiles', chunk_size=4)
+    try:
+        compact_mbtiles('test/output/imported.mbtiles')
+        assert False, 'an interrupted compaction needs resume'
+    except SystemExit:
+        pass
+    compact_mbtiles('test/output/imported.mbtiles', resume=True, chunk_size=4)
+    con = sqlite3.connect('test/output/imported.mbtiles')
+    assert con.execute("select count(*) from images").fetchone()[0] == 2
+    assert con.execute("select count(*) from sqlite_master where name = 'checkpoints'").fetchone()[0] == 0
+    con.close()
+    assert flat_tiles('test/output/imported.mbtiles') == sorted(tiles)
+
+@with_setup(clear_data, clear_data)
+def test_compact_mbtiles_duplicate_rows():
+    os.mkdir('test/output')
+    tiles = [(z, x, y, ('%d' % (x % 2)).encode()) for z in range(3)
+        for x in range(2 ** z) for y in range(2 ** z)]
+    # a file from another tool, without tile_index, holding tiles twice
+    rows = tiles[:3] + tiles + [(z, x, y, b'new') for z, x, y, data in tiles[-3:]]
+    expected = sorted(tiles[:-3] + [(z, x, y, b'new') for z, x, y, data in tiles[-3:]])
+    for name in ('fresh', 'resumed'):
+        path = 'test/output/%s.mbtiles' % name
+        con = sqlite3.connect(path)
+        con.execute('create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+        con.executemany('insert into tiles values (?, ?, ?, ?)', [(z, x, y, sqlite3.Binary(data))
+            for z, x, y, data in rows])
+        con.commit()
+        con.close()
+    compact_mbtiles('test/output/fresh.mbtiles', chunk_size=4)
+    assert flat_tiles('test/output/fresh.mbtiles') == expected
+    run_interrupted(compact_mbtiles, 'test/output/resumed.mbtiles', chunk_size=4)
+    compact_mbtiles('test/output/resumed.mbtiles', resume=True, chunk_size=4)
+    assert flat_tiles('test/output/resumed.mbtiles') == expected
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_stats():
+    os.mkdir('test/output')
+    tiles = [(z, x, y, b'x' * (x + 1)) for z in range(3) for x in range(2 ** z) for y in range(2 ** z)]
+    make_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    stats = mbtiles_stats('test/output/flat.mbtiles', write_stats=True)
+    assert stats['tiles'] == 21 and stats['unique'] == 4 and stats['bytes'] == 47
+    assert stats['minzoom'] == 0 and stats['maxzoom'] == 2
+    assert stats['sizes'] == {'min': 1, 'max': 4, 'mean': 2, 'p50': 2, 'p90': 4, 'p99': 4}
+    assert stats['zooms']['2'] == {'tiles': 16, 'bytes': 40, 'min_size': 1, 'max_size': 4,
+        'x': [0, 3], 'y': [0, 3]}
+    assert mbtiles_stats('test/output/flat.mbtiles', counts_only=True)['zooms']['1'] == \
+        {'tiles': 4, 'x': [0, 1], 'y': [0, 1]}
+    compact_mbtiles_to_file('test/output/flat.mbtiles', 'test/output/compact.mbtiles')
+    compacted = mbtiles_stats('test/output/compact.mbtiles')
+    assert compacted['images'] == 4 and compacted['unique'] == 4
+    for name in ('tiles', 'bytes', 'sizes', 'zooms', 'bounds'):
+        assert compacted[name] == stats[name], name
+    # the stored count is what exports count on, until the tiles change
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    con.execute("delete from tiles where zoom_level = 2")
+    con.commit()
+    con.close()
+    events = []
+    mbtiles_to_disk('test/output/flat.mbtiles', 'test/output/tiles', progress_callback=events.append)
+    assert events[-1]['total'] == 21 and events[-1]['count'] == 5
+    merge_mbtiles('test/output/compact.mbtiles', 'test/output/flat.mbtiles')
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert con.execute("select count(*) from metadata where name = 'mbutil_stats'").fetchone()[0] == 0
+    con.close()
+
+@with_setup(clear_data, clear_data)
+def test_tile_order():
+    assert [hilbert_index(1, x, y) for x, y in [(0, 0), (0, 1), (1, 1), (1, 0)]] == [0, 1, 2, 3]
+    assert [zorder_index(1, x, y) for x, y in [(0, 0), (1, 0), (0, 1), (1, 1)]] == [0, 1, 2, 3]
+    # every position of the curve is visited once
+    assert sorted([hilbert_index(3, x, y) for x in range(8) for y in range(8)]) == list(range(64))
+    os.mkdir('test/output')
+    tiles = [(z, x, y, ('%d/%d/%d' % (z, x, y)).encode()) for z in range(4)
+        for x in range(2 ** z) for y in range(2 ** z)]
+    make_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    def curve(index):
+        return [data for z, x, y, data in sorted(tiles, key=lambda t: (t[0], index(*t[:3])))]
+
+    compact_mbtiles_to_file('test/output/flat.mbtiles', 'test/output/hilbert.mbtiles', tile_order='hilbert')
+    con = sqlite3.connect('test/output/hilbert.mbtiles')
+    assert [bytes(r[0]) for r in con.execute("select tile_data from images order by image_id")] == \
+        curve(hilbert_index)
+    con.close()
+    assert flat_tiles('test/output/hilbert.mbtiles') == sorted(tiles)
+
+    mbtiles_to_disk('test/output/flat.mbtiles', 'test/output/tiles')
+    disk_to_mbtiles('test/output/tiles', 'test/output/imported.mbtiles', tile_order='zorder')
+    con = sqlite3.connect('test/output/imported.mbtiles')
+    assert [bytes(r[0]) for r in con.execute("select tile_data from tiles order by rowid")] == \
+        curve(zorder_index)
+    con.close()
+    assert flat_tiles('test/output/imported.mbtiles') == sorted(tiles)
+
+    compact_mbtiles('test/output/flat.mbtiles', tile_order='hilbert', chunk_size=8)
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert [bytes(r[0]) for r in con.execute("select tile_data from images order by rowid")] == \
+        curve(hilbert_index)
+    con.close()
+    assert flat_tiles('test/output/flat.mbtiles') == sorted(tiles)